@@ -0,0 +1,507 @@
+#   Domato - benchmarks
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from __future__ import print_function
+import argparse
+import contextlib
+import gc
+import io
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import generator
+import grammar
+import grammar_compiler
+from grammar import Grammar
+
+_GRAMMAR_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Grammars shipped with Domato, relative to the directory of this file.
+_SHIPPED_GRAMMARS = [
+    'rules/html.txt',
+    'rules/css.txt',
+    'rules/js.txt',
+    'mathml/mathml.txt',
+    'canvas/canvas.txt',
+    'webgl/webgl.txt',
+    'php/php.txt',
+    'jscript/jscript.txt',
+    'vbscript/vbscript.txt'
+]
+
+# Symbols of css.txt that html.txt and js.txt generate with <import>.
+_CACHED_CSS_SYMBOLS = ['declaration5', 'rule']
+
+
+def load_grammar(path):
+    """Parses a grammar from scratch, without any shared state."""
+    grammar.registry.clear()
+    g = Grammar()
+    if g.parse_from_file(path):
+        raise grammar.GrammarError('There were errors parsing ' + path)
+    return g
+
+
+def count_source_lines(g):
+    num_lines = 0
+    for path, _ in g._source_files:
+        with open(path) as f:
+            num_lines += f.read().count('\n')
+    return num_lines
+
+
+def benchmark_load(args):
+    """Measures how long it takes to parse each of the shipped grammars."""
+    print('%-22s %8s %10s %12s' % ('grammar', 'lines', 'best ms', 'lines/s'))
+    total_lines = 0
+    total_time = 0
+    for name in args.grammars:
+        path = os.path.join(_GRAMMAR_DIR, name)
+        num_lines = count_source_lines(load_grammar(path))
+        best = min(timeit.repeat(lambda: load_grammar(path),
+                                 number=1, repeat=args.repeat))
+        total_lines += num_lines
+        total_time += best
+        print('%-22s %8d %10.1f %12d' % (name, num_lines, best * 1000,
+                                         num_lines / best))
+    print('%-22s %8d %10.1f %12d' % ('total', total_lines, total_time * 1000,
+                                     total_lines / total_time))
+
+
+def measure_memory(path):
+    """Returns the number of bytes that stay allocated for a grammar.
+
+    This includes the parsed files kept by the registry and the tags that
+    are shared between rules, as both live as long as the grammar.
+    """
+    grammar.registry.clear()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        g = load_grammar(path)
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+    return g, size
+
+
+def benchmark_memory(args):
+    """Measures how much memory each of the shipped grammars occupies."""
+    print('%-22s %8s %10s %12s' % ('grammar', 'rules', 'KiB', 'bytes/rule'))
+    total_rules = 0
+    total_size = 0
+    for name in args.grammars:
+        path = os.path.join(_GRAMMAR_DIR, name)
+        g, size = measure_memory(path)
+        num_rules = len(g._all_rules)
+        total_rules += num_rules
+        total_size += size
+        print('%-22s %8d %10.1f %12d' % (name, num_rules, size / 1024.0,
+                                         size // max(num_rules, 1)))
+    print('%-22s %8d %10.1f %12d' % ('total', total_rules,
+                                     total_size / 1024.0,
+                                     total_size // max(total_rules, 1)))
+
+
+def load_template():
+    with open(os.path.join(_GRAMMAR_DIR, 'template.html')) as f:
+        return f.read()
+
+
+def load_html_grammars(image_dir=None, module_dir=None, optimize=False,
+                       cache=None):
+    """Loads the html, css and js grammars used by generator.py.
+
+    If image_dir is given, the grammars are saved as images in that
+    directory and loaded back from there. If module_dir is given, they
+    are compiled into Python modules in that directory instead. If cache
+    is a (size, refresh probability) tuple, the css symbols imported by
+    the html and js grammars are cached, see Grammar.cache_symbol().
+    """
+    grammar_dir = os.path.join(_GRAMMAR_DIR, 'rules')
+    grammars = grammar.load_grammars(
+        [os.path.join(grammar_dir, 'html.txt'),
+         os.path.join(grammar_dir, 'css.txt'),
+         os.path.join(grammar_dir, 'js.txt')],
+        processes=1)
+    if cache:
+        for symbol in _CACHED_CSS_SYMBOLS:
+            grammars[1].cache_symbol(symbol, *cache)
+    if optimize:
+        for g in grammars:
+            g.optimize()
+    if image_dir:
+        images = []
+        for name, g in zip(('html', 'css', 'js'), grammars):
+            path = os.path.join(image_dir, name + '.image')
+            g.save_image(path)
+            image = Grammar()
+            image.load_image(path)
+            images.append(image)
+        grammars = images
+        # The parsed files are not needed anymore.
+        grammar.registry.clear()
+    elif module_dir:
+        modules = []
+        for name, g in zip(('html', 'css', 'js'), grammars):
+            path = os.path.join(module_dir, name + '_grammar.py')
+            grammar_compiler.write_grammar_module(g, path)
+            modules.append(grammar_compiler.load_grammar_module(path))
+        grammars = modules
+    htmlgrammar, cssgrammar, jsgrammar = grammars
+    htmlgrammar.add_import('cssgrammar', cssgrammar)
+    jsgrammar.add_import('cssgrammar', cssgrammar)
+    return htmlgrammar, cssgrammar, jsgrammar
+
+
+def benchmark_generate(args):
+    """Measures how fast generator.py produces samples."""
+    template = load_template()
+    module_dir = tempfile.mkdtemp() if args.compiled else None
+    try:
+        htmlgrammar, cssgrammar, jsgrammar = load_html_grammars(
+            module_dir=module_dir, optimize=args.optimize,
+            cache=args.cache and (args.cache, args.refresh_prob))
+    finally:
+        if module_dir:
+            shutil.rmtree(module_dir)
+    if args.stack:
+        for g in (htmlgrammar, cssgrammar, jsgrammar):
+            g.use_explicit_stack()
+
+    random.seed(args.seed)
+
+    def generate():
+        generator.generate_new_sample(template, htmlgrammar, cssgrammar,
+                                      jsgrammar)
+
+    # Recursion warnings are printed to stdout, keep them out of the way.
+    with contextlib.redirect_stdout(io.StringIO()):
+        times = timeit.repeat(generate, number=args.samples,
+                              repeat=args.repeat)
+    best = min(times)
+    print('%d samples, best of %d: %.1f ms/sample, %.2f samples/s' % (
+        args.samples, args.repeat, best * 1000 / args.samples,
+        args.samples / best))
+    for symbol, stats in sorted(cssgrammar.cache_stats().items()):
+        print('%s: %d lookups, %.1f%% hits, %.1f%% distinct, reused up to '
+              '%d times' % (symbol, stats['lookups'], stats['hit_rate'] * 100,
+                            stats['distinct_rate'] * 100,
+                            stats['max_reuse']))
+
+
+def benchmark_lines(args):
+    """Measures how fast lines of code are generated."""
+    print('%-22s %12s %10s' % ('grammar', 'best us/line', 'lines/s'))
+    # js.txt generates css with <import>, like in generator.py.
+    cssgrammar = load_grammar(os.path.join(_GRAMMAR_DIR, 'rules', 'css.txt'))
+    for path in args.grammars:
+        g = load_grammar(os.path.join(_GRAMMAR_DIR, path))
+        g.add_import('cssgrammar', cssgrammar)
+        if args.pools:
+            g.use_random_pools()
+        random.seed(args.seed)
+        # Recursion warnings are printed to stdout, keep them out of the
+        # way.
+        with contextlib.redirect_stdout(io.StringIO()):
+            times = timeit.repeat(lambda: g._generate_code(args.lines),
+                                  number=1, repeat=args.repeat)
+        best = min(times)
+        print('%-22s %12.1f %10.0f' % (path, best * 1e6 / args.lines,
+                                        args.lines / best))
+
+
+def private_memory():
+    """Returns the memory of this process not shared with others, in KiB."""
+    size = 0
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                size += int(line.split()[1])
+    return size
+
+
+# Grammars loaded before the workers are forked, see benchmark_workers().
+_worker_grammars = None
+
+
+def generate_in_worker(num_samples):
+    template, grammars = _worker_grammars
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(num_samples):
+            generator.generate_new_sample(template, *grammars)
+    return private_memory()
+
+
+def benchmark_workers(args):
+    """Measures the private memory of forked generator processes.
+
+    Forked workers initially share all the memory of the parent. Pages
+    holding grammar objects gradually become private as reference counts
+    are updated, while mapped grammar images stay shared.
+    """
+    global _worker_grammars
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        print('Measuring memory is only supported on Linux')
+        return
+    image_dir = tempfile.mkdtemp() if args.image else None
+    try:
+        _worker_grammars = (load_template(), load_html_grammars(image_dir))
+        context = multiprocessing.get_context('fork')
+        with context.Pool(args.jobs) as pool:
+            sizes = pool.map(generate_in_worker,
+                             [args.samples] * args.jobs, chunksize=1)
+    finally:
+        _worker_grammars = None
+        if image_dir:
+            shutil.rmtree(image_dir)
+    print('%d workers, %d samples each: private memory %d KiB/worker on '
+          'average, %d KiB total' % (args.jobs, args.samples,
+                                     sum(sizes) // len(sizes), sum(sizes)))
+
+
+# A line printed by python -X importtime.
+_IMPORT_TIME_RE = re.compile(r'^import time:\s*(\d+) \|\s*(\d+) \| ( *)(\S+)')
+
+
+def time_command(command, repeat):
+    """Returns the best wall time of running a command, in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call(command, cwd=_GRAMMAR_DIR,
+                              stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def import_times(module, repeat):
+    """Measures importing a module with python -X importtime.
+
+    Returns:
+        A list of (name, seconds) pairs with the cumulative import time
+        of the module followed by the modules it imports directly, the
+        slowest first. Times are the best of all runs.
+    """
+    best = {}
+    children = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+            cwd=_GRAMMAR_DIR, stderr=subprocess.PIPE,
+            universal_newlines=True, check=True).stderr
+        entries = []
+        for line in output.splitlines():
+            match = _IMPORT_TIME_RE.match(line)
+            if match:
+                entries.append((len(match.group(3)) // 2, match.group(4),
+                                int(match.group(2)) / 1e6))
+        # Modules are listed after the modules they import, so the direct
+        # imports are the level 1 entries right before the module.
+        children = []
+        for i, (level, name, cumulative) in enumerate(entries):
+            if level == 0 and name == module:
+                j = i - 1
+                while j >= 0 and entries[j][0] > 0:
+                    if entries[j][0] == 1:
+                        children.append(entries[j][1])
+                    j -= 1
+        for level, name, cumulative in entries:
+            if level <= 1:
+                best[name] = min(best.get(name, cumulative), cumulative)
+    children.sort(key=lambda name: -best[name])
+    return [(module, best.get(module, 0))] + [(name, best[name])
+                                              for name in children]
+
+
+def benchmark_startup(args):
+    """Measures how long generator.py takes to start, phase by phase.
+
+    The interpreter, the imports and the full command line are timed in
+    new processes; loading the grammars and generating the first sample
+    are timed in this one, with the registry cleared before every load.
+    """
+    rows = []
+    python = sys.executable
+    rows.append(('python -c pass', time_command([python, '-c', 'pass'],
+                                                args.repeat)))
+    rows.append(('generator.py --help',
+                 time_command([python, 'generator.py', '--help'],
+                              args.repeat)))
+    imports = import_times('generator', args.repeat)
+    rows.append(('import generator', imports[0][1]))
+    rows.extend(('  ' + name, t) for name, t in imports[1:])
+
+    grammar_dir = os.path.join(_GRAMMAR_DIR, 'rules')
+    paths = [os.path.join(grammar_dir, name)
+             for name in ('html.txt', 'css.txt', 'js.txt')]
+    cache_dir = tempfile.mkdtemp()
+    try:
+        grammars = []
+        for path in paths:
+            best = min(timeit.repeat(lambda: load_grammar(path),
+                                     number=1, repeat=args.repeat))
+            rows.append(('parse ' + os.path.relpath(path, _GRAMMAR_DIR),
+                         best))
+            grammar.registry.clear()
+            g = Grammar()
+            g.parse_from_file(path, cache_dir)
+            grammars.append(g)
+
+        def load_cached():
+            grammar.registry.clear()
+            for path in paths:
+                Grammar().parse_from_file(path, cache_dir)
+        rows.append(('load 3 grammars from cache',
+                     min(timeit.repeat(load_cached, number=1,
+                                       repeat=args.repeat))))
+
+        with tempfile.NamedTemporaryFile(suffix='.html') as sample:
+            command = [python, 'generator.py', '--file', sample.name,
+                       '--cache_dir', cache_dir]
+            rows.append(('generator.py --file, cached',
+                         time_command(command, args.repeat)))
+    finally:
+        shutil.rmtree(cache_dir)
+
+    htmlgrammar, cssgrammar, jsgrammar = grammars
+    htmlgrammar.add_import('cssgrammar', cssgrammar)
+    jsgrammar.add_import('cssgrammar', cssgrammar)
+    template = load_template()
+    random.seed(args.seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        generator.generate_new_sample(template, htmlgrammar, cssgrammar,
+                                      jsgrammar)
+        rows.append(('first sample', time.perf_counter() - start))
+
+    print('%-32s %10s' % ('phase', 'best ms'))
+    for name, seconds in rows:
+        print('%-32s %10.1f' % (name, seconds * 1000))
+
+
+def get_argument_parser():
+
+    parser = argparse.ArgumentParser(description="DOMATO benchmarks")
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    load_parser = subparsers.add_parser(
+        'load', help='Time parsing of the shipped grammars')
+    load_parser.add_argument('-r', '--repeat', type=int, default=5,
+                             help='Number of measurements per grammar')
+    load_parser.add_argument('grammars', nargs='*', default=_SHIPPED_GRAMMARS,
+                             help='Grammar files, relative to ' + _GRAMMAR_DIR)
+    load_parser.set_defaults(func=benchmark_load)
+
+    memory_parser = subparsers.add_parser(
+        'memory', help='Measure memory used by the shipped grammars')
+    memory_parser.add_argument('grammars', nargs='*',
+                               default=_SHIPPED_GRAMMARS,
+                               help='Grammar files, relative to ' +
+                                    _GRAMMAR_DIR)
+    memory_parser.set_defaults(func=benchmark_memory)
+
+    generate_parser = subparsers.add_parser(
+        'generate', help='Time generation of HTML samples')
+    generate_parser.add_argument('-n', '--samples', type=int, default=5,
+                                 help='Number of samples per measurement')
+    generate_parser.add_argument('-r', '--repeat', type=int, default=3,
+                                 help='Number of measurements')
+    generate_parser.add_argument('-s', '--seed', type=int, default=1,
+                                 help='Random seed')
+    generate_parser.add_argument('--optimize', action='store_true',
+                                 help='Optimize the grammars first')
+    generate_parser.add_argument('--cache', type=int, default=0,
+                                 metavar='SIZE',
+                                 help='Cache SIZE expansions of the css '
+                                      'symbols used by html and js')
+    generate_parser.add_argument('--refresh-prob', type=float, default=0.1,
+                                 help='Probability of generating a fresh '
+                                      'expansion of a cached symbol')
+    engine_group = generate_parser.add_mutually_exclusive_group()
+    engine_group.add_argument('--compiled', action='store_true',
+                              help='Compile the grammars into Python '
+                                   'modules first')
+    engine_group.add_argument('--stack', action='store_true',
+                              help='Expand rules with the explicit-stack '
+                                   'engine')
+    generate_parser.set_defaults(func=benchmark_generate)
+
+    lines_parser = subparsers.add_parser(
+        'lines', help='Time generation of lines of code')
+    lines_parser.add_argument('-n', '--lines', type=int, default=1000,
+                              help='Number of lines per measurement')
+    lines_parser.add_argument('-r', '--repeat', type=int, default=3,
+                              help='Number of measurements per grammar')
+    lines_parser.add_argument('-s', '--seed', type=int, default=1,
+                              help='Random seed')
+    lines_parser.add_argument('--pools', action='store_true',
+                              help='Draw built-in values from NumPy random '
+                                   'pools')
+    lines_parser.add_argument('grammars', nargs='*',
+                              default=['rules/js.txt', 'webgl/webgl.txt',
+                                       'canvas/canvas.txt'],
+                              help='Grammar files, relative to ' +
+                                   _GRAMMAR_DIR)
+    lines_parser.set_defaults(func=benchmark_lines)
+
+    startup_parser = subparsers.add_parser(
+        'startup',
+        help='Time the startup of generator.py, from the interpreter and '
+             'imports to loading the grammars')
+    startup_parser.add_argument('-r', '--repeat', type=int, default=3,
+                                help='Number of measurements per phase')
+    startup_parser.add_argument('-s', '--seed', type=int, default=1,
+                                help='Random seed for the first sample')
+    startup_parser.set_defaults(func=benchmark_startup)
+
+    workers_parser = subparsers.add_parser(
+        'workers', help='Measure memory of forked generator processes')
+    workers_parser.add_argument('-j', '--jobs', type=int, default=4,
+                                help='Number of worker processes')
+    workers_parser.add_argument('-n', '--samples', type=int, default=3,
+                                help='Number of samples per worker')
+    workers_parser.add_argument('--image', action='store_true',
+                                help='Use mapped grammar images instead of '
+                                     'grammar objects')
+    workers_parser.set_defaults(func=benchmark_workers)
+
+    return parser
+
+
+def main():
+    parser = get_argument_parser()
+    args = parser.parse_args()
+    if not args.benchmark:
+        parser.print_help()
+        return
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,12 +21,14 @@ from __future__ import print_function
 import os
 import re
 import random
-import argparse
 
-from grammar import Grammar
 from svg_tags import _SVG_TYPES
 from html_tags import _HTML_TYPES
 
+# The grammar engine and argparse are imported where they are first
+# needed, so that --help and library users that only call
+# generate_new_sample() don't pay for them.
+
 _N_MAIN_LINES = 1000
 _N_EVENTHANDLER_LINES = 500
 
@@ -72,20 +74,15 @@ def generate_function_body(jsgrammar, htmlctx, num_lines):
     return js
 
 
-def check_grammar(grammar):
+def check_grammar(grammar, start_symbols=None):
     """Checks if grammar has errors and if so outputs them.
     Args:
       grammar: The grammar to check.
+      start_symbols: symbols generated directly by generate_new_sample().
     """
 
-    for rule in grammar._all_rules:
-        for part in rule['parts']:
-            if part['type'] == 'text':
-                continue
-            tagname = part['tagname']
-            # print tagname
-            if tagname not in grammar._creators:
-                print('No creators for type ' + tagname)
+    from grammar_analyzer import analyze_grammar, print_report
+    print_report(analyze_grammar(grammar, start_symbols))
 
 
 def generate_new_sample(template, htmlgrammar, cssgrammar, jsgrammar):
@@ -135,35 +132,83 @@ def generate_new_sample(template, htmlgrammar, cssgrammar, jsgrammar):
 
     return result
 
-def generate_samples(template, outfiles):
-    """Generates a set of samples and writes them to the output files.
+def load_fuzzer_grammars(cache_dir=None, processes=None):
+    """Loads the HTML, CSS and JS grammars.
     Args:
-      grammar_dir: directory to load grammar files from.
-      outfiles: A list of output filenames.
+      cache_dir: optional directory for the compiled grammar cache.
+      processes: maximum number of processes used to load the grammars.
+    Returns:
+      A tuple of the three grammars, or None if they couldn't be loaded.
     """
 
+    from grammar import GrammarError, load_grammars
+
     grammar_dir = os.path.join(os.path.dirname(__file__), 'rules')
-    htmlgrammar = Grammar()
 
-    err = htmlgrammar.parse_from_file(os.path.join(grammar_dir, 'html.txt'))
-    # CheckGrammar(htmlgrammar)
-    if err > 0:
-        print('There were errors parsing html grammar')
-        return
+    # The three grammars are independent of each other until the CSS
+    # grammar gets imported, so they can be loaded in parallel.
+    try:
+        return load_grammars(
+            [os.path.join(grammar_dir, 'html.txt'),
+             os.path.join(grammar_dir, 'css.txt'),
+             os.path.join(grammar_dir, 'js.txt')],
+            cache_dir,
+            processes
+        )
+    except GrammarError as e:
+        print(str(e))
+        return None
 
-    cssgrammar = Grammar()
-    err = cssgrammar.parse_from_file(os.path.join(grammar_dir ,'css.txt'))
-    # CheckGrammar(cssgrammar)
-    if err > 0:
-        print('There were errors parsing css grammar')
+def check_grammars(cache_dir=None, processes=None):
+    """Checks the HTML, CSS and JS grammars and reports their problems.
+    Args:
+      cache_dir: optional directory for the compiled grammar cache.
+      processes: maximum number of processes used to load the grammars.
+    """
+
+    grammars = load_fuzzer_grammars(cache_dir, processes)
+    if grammars is None:
         return
+    htmlgrammar, cssgrammar, jsgrammar = grammars
+
+    # The symbols generate_new_sample() generates directly. The JS grammar
+    # is only used for code lines, which are always checked.
+    for name, grammar, start_symbols in (
+            ('html.txt', htmlgrammar, ['bodyelements']),
+            ('css.txt', cssgrammar, ['rules']),
+            ('js.txt', jsgrammar, [])):
+        print('Checking ' + name)
+        check_grammar(grammar, start_symbols)
+
+def generate_samples(template, outfiles, cache_dir=None, processes=None,
+                     optimize=False, random_pools=False):
+    """Generates a set of samples and writes them to the output files.
+    Args:
+      grammar_dir: directory to load grammar files from.
+      outfiles: A list of output filenames.
+      cache_dir: optional directory for the compiled grammar cache.
+      processes: maximum number of processes used to load the grammars.
+      optimize: whether to optimize the grammars for generation speed.
+      random_pools: whether to draw built-in values from NumPy random pools.
+    """
+
+    from grammar import GrammarError
 
-    jsgrammar = Grammar()
-    err = jsgrammar.parse_from_file(os.path.join(grammar_dir,'js.txt'))
-    # CheckGrammar(jsgrammar)
-    if err > 0:
-        print('There were errors parsing js grammar')
+    grammars = load_fuzzer_grammars(cache_dir, processes)
+    if grammars is None:
         return
+    htmlgrammar, cssgrammar, jsgrammar = grammars
+
+    if optimize:
+        for grammar in (htmlgrammar, cssgrammar, jsgrammar):
+            grammar.optimize()
+    if random_pools:
+        try:
+            for grammar in (htmlgrammar, cssgrammar, jsgrammar):
+                grammar.use_random_pools()
+        except GrammarError as e:
+            print(str(e))
+            return
 
     # JS and HTML grammar need access to CSS grammar.
     # Add it as import
@@ -181,7 +226,8 @@ def generate_samples(template, outfiles):
                 print('Error writing to output')
 
 def get_argument_parser():
-    
+    import argparse
+
     parser = argparse.ArgumentParser(description="DOMATO (A DOM FUZZER)")
     
     parser.add_argument("-f", "--file", 
@@ -193,21 +239,51 @@ def get_argument_parser():
     parser.add_argument('-n', '--no_of_files', type=int,
                     help='number of files to be generated')
 
-    return parser
+    parser.add_argument('-c', '--cache_dir', type=str,
+                    help='Directory in which compiled grammars are cached '
+                         'between runs')
 
-def main():
+    parser.add_argument('-j', '--jobs', type=int,
+                    help='Maximum number of processes used to load the '
+                         'grammars, 0 for one per CPU (by default they are '
+                         'loaded in a single process, which is faster with '
+                         'a warm cache)')
+
+    parser.add_argument('--optimize', action='store_true',
+                    help='Optimize the grammars for generation speed. '
+                         'Samples follow the same distribution, but differ '
+                         'for a given random seed')
 
+    parser.add_argument('--random_pools', action='store_true',
+                    help='Draw numbers and strings in batches with NumPy '
+                         '(needs NumPy to be installed)')
+
+    parser.add_argument('--check', action='store_true',
+                    help='Report problems in the grammars, such as undefined '
+                         'or unreachable symbols, instead of generating '
+                         'samples')
+
+    return parser
+
+def read_template():
     fuzzer_dir = os.path.dirname(__file__)
 
     with open(os.path.join(fuzzer_dir, "template.html"), "r") as f:
-        template = f.read()
+        return f.read()
+
+def main():
 
     parser = get_argument_parser()
     
     args = parser.parse_args()
 
-    if args.file:
-        generate_samples(template, [args.file])
+    if args.check:
+        check_grammars(args.cache_dir, args.jobs)
+
+    elif args.file:
+        template = read_template()
+        generate_samples(template, [args.file], args.cache_dir, args.jobs,
+                         args.optimize, args.random_pools)
 
     elif args.output_dir:
         if not args.no_of_files:
@@ -222,11 +298,13 @@ def main():
             if not os.path.exists(out_dir):
                 os.mkdir(out_dir)
 
+            template = read_template()
             outfiles = []
             for i in range(nsamples):
                 outfiles.append(os.path.join(out_dir, 'fuzz-' + str(i).zfill(5) + '.html'))
             
-            generate_samples(template, outfiles)
+            generate_samples(template, outfiles, args.cache_dir,
+                             args.jobs, args.optimize, args.random_pools)
                 
 
     else:
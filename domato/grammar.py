@@ -19,15 +19,15 @@
 
 from __future__ import print_function
 
-import bisect
-try:
-    from html import escape as _escape
-except ImportError:
-    from cgi import escape as _escape
+# Modules that are only needed by some features (caching, images,
+# analysis, HTML escaping) are imported where they are used, which keeps
+# importing the engine cheap for short runs.
+import functools
 import os
 import random
 import re
 import struct
+import sys
 
 _INT_RANGES = {
     'int': [-2147483648, 2147483647],
@@ -53,6 +53,105 @@ _INT_FORMATS = {
     'uint64': 'Q'
 }
 
+# Bump whenever the layout of the cached grammar state changes.
+_CACHE_VERSION = 8
+
+_COMMAND_RE = re.compile(r'^!([a-z_]+)\s*(.*)$')
+_FUNCTION_RE = re.compile(r'^function\s*([a-zA-Z._0-9]+)$')
+_RULE_RE = re.compile(r'^<([^>]*)>\s*=\s*(.*)$')
+_TAG_SPLIT_RE = re.compile(r'<([^>)]*)>')
+
+# Layout of grammar images, see Grammar.save_image().
+_IMAGE_MAGIC = b'DOMATOIM'
+_IMAGE_VERSION = 6
+_IMAGE_HEADER_FORMAT = '=8sII'
+_IMAGE_ENTRY_FORMAT = '=QQ'
+_IMAGE_SECTIONS = (
+    'metadata', 'string_data', 'string_offsets', 'tag_offsets',
+    'tag_items', 'ops', 'inlined', 'rule_offsets', 'rule_code',
+    'creator_offsets', 'creator_rules', 'nonrecursive_offsets',
+    'nonrecursive_rules', 'cdf_offsets', 'cdfs', 'nonrecursive_cdf_offsets',
+    'nonrecursive_cdfs', 'alias_offsets', 'alias_thresholds',
+    'alias_indices', 'nonrecursive_alias_offsets',
+    'nonrecursive_alias_thresholds', 'nonrecursive_alias_indices',
+    'symbol_reusable', 'symbol_min_depths',
+    'symbol_max_depths', 'pool_offsets', 'pool_outputs',
+    'pool_alias_offsets', 'pool_alias_thresholds', 'pool_alias_indices',
+    'pool_depths', 'pool_symbol_offsets', 'pool_symbols',
+    'interesting_offsets', 'interesting_lines'
+)
+# Sections that are arrays, with their item types.
+_IMAGE_SECTION_TYPES = {
+    'string_offsets': 'I',
+    'tag_offsets': 'I',
+    'tag_items': 'I',
+    'ops': 'I',
+    'inlined': 'I',
+    'rule_offsets': 'I',
+    'rule_code': 'B',
+    'creator_offsets': 'I',
+    'creator_rules': 'I',
+    'nonrecursive_offsets': 'I',
+    'nonrecursive_rules': 'I',
+    'cdf_offsets': 'I',
+    'cdfs': 'd',
+    'nonrecursive_cdf_offsets': 'I',
+    'nonrecursive_cdfs': 'd',
+    'alias_offsets': 'I',
+    'alias_thresholds': 'd',
+    'alias_indices': 'I',
+    'nonrecursive_alias_offsets': 'I',
+    'nonrecursive_alias_thresholds': 'd',
+    'nonrecursive_alias_indices': 'I',
+    'symbol_reusable': 'B',
+    'symbol_min_depths': 'I',
+    'symbol_max_depths': 'I',
+    'pool_offsets': 'I',
+    'pool_outputs': 'I',
+    'pool_alias_offsets': 'I',
+    'pool_alias_thresholds': 'd',
+    'pool_alias_indices': 'I',
+    'pool_depths': 'I',
+    'pool_symbol_offsets': 'I',
+    'pool_symbols': 'I',
+    'interesting_offsets': 'I',
+    'interesting_lines': 'i'
+}
+# Marks a missing tag or a valueless tag attribute.
+_IMAGE_NONE = 0xffffffff
+# Number of decoded rules each process keeps per loaded image.
+_IMAGE_RULE_CACHE_SIZE = 1024
+# Above this !max_recursion the recursive expansion engine could run out of
+# Python stack frames (every level takes two or three of them), so the
+# explicit-stack engine is used instead.
+_MAX_RECURSIVE_DEPTH = 250
+# Depth needed by symbols and rules that can never be fully expanded.
+_UNBOUNDED_DEPTH = 0xffffffff
+# Largest number of outputs precomputed for a finite symbol, see
+# Grammar._lower_pools().
+_MAX_POOL_SIZE = 1024
+
+# Kinds of tokens produced by _tokenize().
+_TOKEN_RULE = 0
+_TOKEN_COMMAND = 1
+_TOKEN_FUNCTION = 2
+_TOKEN_ERROR = 3
+
+# Kinds of non-rule entries in a parsed grammar fragment.
+_COMMAND = 1
+_FUNCTION = 2
+
+# Opcodes of the operations in lowered rules, see Grammar._lower_part().
+_OP_TEXT = 0
+_OP_SYMBOL = 1
+_OP_BUILTIN = 2
+_OP_NEW = 3
+_OP_CONSTANT = 4
+_OP_CALL = 5
+# Symbols inlined by Grammar.optimize(), see _inline_symbols().
+_OP_INLINED_TEXT = 6
+_OP_INLINED_SYMBOL = 7
+
 _NONINTERESTING_TYPES = [
     'short',
     'long',
@@ -63,6 +162,81 @@ _NONINTERESTING_TYPES = [
 ]
 
 
+def _digest(content):
+    import hashlib
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+# html.escape(), imported when it is first needed because html imports
+# html.entities, which is much larger.
+_html_escape = None
+
+
+def _escape(string, quote=True):
+    global _html_escape
+    if _html_escape is None:
+        from html import escape
+        _html_escape = escape
+    return _html_escape(string, quote=quote)
+
+
+def _tokenize(grammar_str):
+    """Splits grammar source into tokens in a single pass.
+
+    Comments and empty lines are skipped. Lines between '!begin function'
+    and '!end function' are collected verbatim into a single token.
+
+    Yields:
+        (kind, lineno, value, line) tuples where line is the original
+        source line. value is the trimmed line for _TOKEN_RULE, a
+        (command, params) tuple for _TOKEN_COMMAND and a (name, body)
+        tuple for _TOKEN_FUNCTION.
+    """
+    function_name = None
+    function_body = []
+    function_lineno = 0
+    for lineno, line in enumerate(grammar_str.split('\n'), 1):
+        if function_name is not None:
+            match = _COMMAND_RE.match(line) if line[:1] == '!' else None
+            if match and match.group(1) == 'end' and match.group(2) == 'function':
+                yield (_TOKEN_FUNCTION, function_lineno,
+                       (function_name, ''.join(function_body)), line)
+                function_name = None
+            elif match and match.group(1) == 'begin':
+                yield (_TOKEN_ERROR, lineno, None, line)
+            else:
+                function_body.append(line + '\n')
+            continue
+
+        comment = line.find('#')
+        if comment >= 0:
+            cleanline = line[:comment].strip()
+        else:
+            cleanline = line.strip()
+        if not cleanline:
+            continue
+
+        if cleanline[0] != '!':
+            yield (_TOKEN_RULE, lineno, cleanline, line)
+            continue
+        match = _COMMAND_RE.match(cleanline)
+        if not match:
+            yield (_TOKEN_RULE, lineno, cleanline, line)
+            continue
+        command = match.group(1)
+        params = match.group(2)
+        if command == 'begin' and params.startswith('function'):
+            match = _FUNCTION_RE.match(params)
+            if match:
+                function_name = match.group(1)
+                function_body = []
+                function_lineno = lineno
+            else:
+                yield (_TOKEN_ERROR, lineno, None, line)
+            continue
+        yield (_TOKEN_COMMAND, lineno, (command, params), line)
+
+
 class Error(Exception):
     pass
 
@@ -77,6 +251,195 @@ class RecursionError(Error):
     pass
 
 
+class _GrammarRule(object):
+    """A rule of the form <symbol> = <parts>.
+
+    Rules are never modified after parsing. Their parts are strings for
+    constant text and attribute dictionaries for tags.
+    """
+
+    __slots__ = ('creates', 'parts', 'recursive')
+    type = 'grammar'
+
+    def __init__(self, creates, parts, recursive):
+        self.creates = creates
+        self.parts = parts
+        self.recursive = recursive
+
+
+class _CodeRule(object):
+    """A line of code from a !begin lines or !begin helperlines block.
+
+    creates holds the tags of the variables created by the line.
+    """
+
+    __slots__ = ('creates', 'parts', 'helper')
+    type = 'code'
+
+    def __init__(self, creates, parts, helper):
+        self.creates = creates
+        self.parts = parts
+        self.helper = helper
+
+
+def _rule_keys(rules):
+    """Returns values that compare equal for rules with equal contents."""
+    return [(rule.type, rule.creates, rule.parts,
+             rule.recursive if rule.type == 'grammar' else rule.helper)
+            for rule in rules or ()]
+
+
+def _is_decorated(tag):
+    """Checks if a tag has attributes that apply to any kind of part."""
+    return tag is not None and ('id' in tag or 'beforeoutput' in tag)
+
+
+def _cdf_probabilities(cdf):
+    """Returns the probabilities of the items of a non-empty CDF."""
+    return [cdf[0]] + [cdf[i] - cdf[i - 1] for i in range(1, len(cdf))]
+
+
+def _alias_table(probabilities):
+    """Builds an alias table for sampling with the given probabilities.
+
+    Uses Vose's variant of Walker's alias method. An item is drawn by
+    picking a column i uniformly and then taking i with the probability
+    of the column and aliases[i] otherwise, see _alias_index(). The
+    probability of column i is stored as the threshold i + probability,
+    so that a single random number in [0, n) picks both.
+
+    Returns:
+        A (thresholds, aliases) tuple, or None if all the probabilities
+        are 0.
+    """
+    n = len(probabilities)
+    total = float(sum(probabilities))
+    if total <= 0:
+        return None
+    scaled = [p * n / total for p in probabilities]
+    column_probabilities = [1.0] * n
+    aliases = list(range(n))
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        column_probabilities[less] = scaled[less]
+        aliases[less] = more
+        scaled[more] = (scaled[more] + scaled[less]) - 1.0
+        if scaled[more] < 1.0:
+            small.append(more)
+        else:
+            large.append(more)
+    # Whatever is left only differs from 1 by rounding errors and keeps
+    # its own column.
+    thresholds = tuple(i + column_probabilities[i] for i in range(n))
+    return thresholds, tuple(aliases)
+
+
+def _alias_index(table):
+    """Draws an index from an alias table with a single random number."""
+    thresholds, aliases = table
+    u = random.random() * len(aliases)
+    index = int(u)
+    if u >= thresholds[index]:
+        return aliases[index]
+    return index
+
+
+class _ExpansionCache(object):
+    """Recent expansions of a symbol, see Grammar.cache_symbol()."""
+
+    def __init__(self, size, refresh_prob):
+        self._size = size
+        self._refresh_prob = refresh_prob
+        # Least recently used first, with the number of times each
+        # expansion was returned and the recursion depth it was generated
+        # at. An expansion fits into the remaining depth there and at any
+        # depth above it.
+        self._expansions = []
+        self._uses = []
+        self._depths = []
+        self._max_uses = 0
+        self.lookups = 0
+        self.hits = 0
+
+    def get(self, depth):
+        """Returns a cached expansion that fits at depth, or None."""
+        self.lookups += 1
+        expansions = self._expansions
+        if (len(expansions) < self._size or
+                random.random() < self._refresh_prob):
+            return None
+        depths = self._depths
+        if depth <= min(depths):
+            index = random.randint(0, len(expansions) - 1)
+        else:
+            fitting = [i for i in range(len(depths)) if depths[i] >= depth]
+            if not fitting:
+                return None
+            index = fitting[random.randint(0, len(fitting) - 1)]
+        expansion = expansions.pop(index)
+        uses = self._uses.pop(index) + 1
+        expansions.append(expansion)
+        self._uses.append(uses)
+        depths.append(depths.pop(index))
+        self.hits += 1
+        return expansion
+
+    def add(self, expansion, depth, journal=None):
+        """Adds a fresh expansion, evicting the least recently used one.
+
+        Args:
+            expansion: The expansion.
+            depth: The recursion depth it was generated at.
+            journal: The journal of the context, if any. The addition is
+                recorded there so that _roll_back() can undo it.
+        """
+        evicted = None
+        if len(self._expansions) >= self._size:
+            evicted = (self._expansions.pop(0), self._uses.pop(0),
+                       self._depths.pop(0), self._max_uses)
+            self._max_uses = max(self._max_uses, evicted[1])
+        self._expansions.append(expansion)
+        self._uses.append(1)
+        self._depths.append(depth)
+        if journal is not None:
+            journal.append((self, expansion, evicted))
+
+    def undo_add(self, expansion, evicted):
+        """Removes an expansion again, restoring the one it evicted.
+
+        Additions have to be undone in reverse order, so the expansion is
+        still in the cache, though hits may have moved it.
+        """
+        expansions = self._expansions
+        index = len(expansions) - 1
+        while expansions[index] is not expansion:
+            index -= 1
+        del expansions[index]
+        del self._uses[index]
+        del self._depths[index]
+        if evicted is not None:
+            expansion, uses, depth, self._max_uses = evicted
+            expansions.insert(0, expansion)
+            self._uses.insert(0, uses)
+            self._depths.insert(0, depth)
+
+    def stats(self):
+        fresh = self.lookups - self.hits
+        return {
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'hit_rate': (float(self.hits) / self.lookups
+                         if self.lookups else 0.0),
+            'fresh': fresh,
+            'distinct_rate': (float(fresh) / self.lookups
+                              if self.lookups else 1.0),
+            'max_reuse': max([self._max_uses] + self._uses),
+        }
+
+
 class Grammar(object):
     """Parses grammar and generates corresponding languages.
 
@@ -100,13 +463,48 @@ class Grammar(object):
         self._creator_cdfs = {}
         self._nonrecursivecreator_cdfs = {}
 
+        # Lowered representation used for generation, see _lower().
+        self._symbol_ids = {}
+        self._symbol_names = []
+        self._reusable_symbols = []
+        self._lowered_alias_tables = []
+        self._lowered_nonrecursive_alias_tables = []
+        self._lowered_min_depths = []
+        self._lowered_max_depths = []
+        self._restricted_creators = {}
+        self._lowered_creators = []
+        self._lowered_nonrecursive = []
+        self._lowered_cdfs = []
+        self._lowered_nonrecursive_cdfs = []
+        self._lowered_pools = []
+        self._lowered_pool_alias_tables = []
+        self._lowered_pool_depths = []
+        self._lowered_pool_symbols = []
+        self._lowered_caches = []
+        self._variable_ancestors = {}
+        self._setter_templates = {}
+        self._line_id = None
+        self._optimized = False
+        self._explicit_stack = False
+        self._random_pools = None
+
         self._var_format = 'var%05d'
 
         self._definitions_dir = '.'
 
         self._imports = {}
+        # Paths of the grammars loaded with !import, by import name.
+        self._import_paths = {}
 
         self._functions = {}
+        self._function_sources = {}
+
+        # (path, sha1 digest) of every file the grammar was built from.
+        self._source_files = []
+        # Files passed to include_from_file(), used for reloading.
+        self._root_files = []
+        # Runs of rules in link order, see _link_fragment().
+        self._segments = []
 
         self._line_guard = ''
 
@@ -117,8 +515,21 @@ class Grammar(object):
 
         self._inheritance = {}
 
+        # Parsed tags by tag string, equal tags of the grammar share a
+        # single dictionary.
+        self._tag_cache = {}
+
+        # Symbols whose expansions are cached, mapped to (size, refresh
+        # probability) tuples, see cache_symbol().
+        self._cache_settings = {}
+
         self._cssgrammar = None
 
+        self._init_handlers()
+
+    def _init_handlers(self):
+        """Creates lookup tables that reference bound methods."""
+
         # Helper dictionaries for creating built-in types.
         self._constant_types = {
             'lt': '<',
@@ -132,23 +543,23 @@ class Grammar(object):
         }
 
         self._built_in_types = {
-            'int': self._generate_int,
-            'int32': self._generate_int,
-            'uint32': self._generate_int,
-            'int8': self._generate_int,
-            'uint8': self._generate_int,
-            'int16': self._generate_int,
-            'uint16': self._generate_int,
-            'int64': self._generate_int,
-            'uint64': self._generate_int,
-            'float': self._generate_float,
-            'double': self._generate_float,
-            'char': self._generate_char,
-            'string': self._generate_string,
-            'htmlsafestring': self._generate_html_string,
-            'hex': self._generate_hex,
-            'import': self._generate_import,
-            'lines': self._generate_lines
+            'int': self._int_generator,
+            'int32': self._int_generator,
+            'uint32': self._int_generator,
+            'int8': self._int_generator,
+            'uint8': self._int_generator,
+            'int16': self._int_generator,
+            'uint16': self._int_generator,
+            'int64': self._int_generator,
+            'uint64': self._int_generator,
+            'float': self._float_generator,
+            'double': self._float_generator,
+            'char': self._char_generator,
+            'string': self._string_generator,
+            'htmlsafestring': self._html_string_generator,
+            'hex': self._hex_generator,
+            'import': self._import_generator,
+            'lines': self._lines_generator
         }
 
         self._command_handlers = {
@@ -158,123 +569,278 @@ class Grammar(object):
             'lineguard': self._set_line_guard,
             'max_recursion': self._set_recursion_depth,
             'var_reuse_prob': self._set_var_reuse_probability,
-            'extends': self._set_extends
+            'extends': self._set_extends,
+            'cache': self._set_cache
         }
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Bound methods and code objects can't be pickled, they are
+        # recreated from the function sources in __setstate__.
+        for key in ('_constant_types', '_built_in_types',
+                    '_command_handlers', '_functions',
+                    '_restricted_creators', '_lowered_caches'):
+            del state[key]
+        # The lowered rules are kept, so that loading the state doesn't
+        # lower the grammar again, except for the specialized generators
+        # of built-in types, which are closures. They are replaced with
+        # None and their positions are recorded.
+        stripped = {}
+        built_ins = []
+        for key in ('_lowered_creators', '_lowered_nonrecursive'):
+            state[key] = self._strip_built_ins(
+                getattr(self, key), stripped, built_ins, key)
+        state['_built_in_rules'] = built_ins
+        # Setter templates are cheap to create when they are first needed.
+        state['_setter_templates'] = {}
+        # Only needed for parsing more rules.
+        state['_tag_cache'] = {}
+        # Segments reference parsed fragments, which are only valid within
+        # the process that parsed them.
+        state['_segments'] = []
+        # Pools would make loading the state depend on NumPy.
+        state['_random_pools'] = None
+        return state
+
+    def __setstate__(self, state):
+        built_ins = state.pop('_built_in_rules')
+        self.__dict__.update(state)
+        self._init_handlers()
+        self._functions = {}
+        for name, source in self._function_sources.items():
+            self._functions[name] = compile(source, name, 'exec')
+        self._restore_built_ins(built_ins)
+        self._restricted_creators = {}
+        self._create_caches()
+
+    @staticmethod
+    def _strip_built_ins(lowered, stripped, built_ins, key):
+        """Copies lowered creators without built-in generators.
+
+        Args:
+            lowered: list of lowered creators, indexed by symbol ID.
+            stripped: dictionary of rules that were already copied, by
+                the ID of the original rule, so that shared rules stay
+                shared.
+            built_ins: list that (key, symbol ID, index) positions of the
+                rules with built-in types are appended to.
+            key: name of the attribute the creators are stored in.
+
+        Returns:
+            The copied list.
+        """
+        copy = []
+        for symbol_id, creators in enumerate(lowered):
+            if creators is None:
+                copy.append(None)
+                continue
+            copied = []
+            for index, rule in enumerate(creators):
+                is_code, ops = rule
+                for op in ops:
+                    if op[0] == _OP_BUILTIN:
+                        built_ins.append((key, symbol_id, index))
+                        break
+                else:
+                    copied.append(rule)
+                    continue
+                copied_rule = stripped.get(id(rule))
+                if copied_rule is None:
+                    copied_rule = (is_code, tuple(
+                        (_OP_BUILTIN, None, op[2])
+                        if op[0] == _OP_BUILTIN else op for op in ops))
+                    stripped[id(rule)] = copied_rule
+                copied.append(copied_rule)
+            copy.append(copied)
+        return copy
+
+    def _restore_built_ins(self, built_ins):
+        """Specializes the built-in types removed by _strip_built_ins()."""
+        restored = {}
+        generators = {}
+        for key, symbol_id, index in built_ins:
+            creators = getattr(self, key)[symbol_id]
+            rule = creators[index]
+            restored_rule = restored.get(id(rule))
+            if restored_rule is None:
+                ops = []
+                for op in rule[1]:
+                    if op[0] == _OP_BUILTIN:
+                        tag = op[2]
+                        op = generators.get(id(tag))
+                        if op is None:
+                            op = (_OP_BUILTIN,
+                                  self._specialize_built_in(tag), tag)
+                            generators[id(tag)] = op
+                    ops.append(op)
+                restored_rule = (rule[0], tuple(ops))
+                restored[id(rule)] = restored_rule
+            creators[index] = restored_rule
+
     def _string_to_int(self, s):
         return int(s, 0)
 
-    def _generate_int(self, tag):
-        """Generates integer types."""
+    def _specialize_built_in(self, tag):
+        """Returns a function that generates values for a built-in tag.
+
+        The attributes of the tag are parsed and checked once, so the
+        returned function (which takes no arguments) only draws random
+        values and formats them.
+
+        Raises:
+            GrammarError: If the attributes of the tag are invalid.
+        """
         tag_name = tag['tagname']
-        default_range = _INT_RANGES[tag_name]
+        try:
+            return self._built_in_types[tag_name](tag)
+        except (TypeError, ValueError, OverflowError):
+            raise GrammarError('Invalid attribute in %s tag' % tag_name)
 
-        min_value = default_range[0]
+    def _int_generator(self, tag):
+        """Returns a function that generates integer types."""
+        tag_name = tag['tagname']
+        min_value, max_value = _INT_RANGES[tag_name]
         if 'min' in tag:
             min_value = self._string_to_int(tag['min'])
-
-        max_value = default_range[1]
         if 'max' in tag:
             max_value = self._string_to_int(tag['max'])
-
         if min_value > max_value:
             raise GrammarError('Range error in integer tag')
 
-        i = random.randint(min_value, max_value)
-
-        if 'b' in tag or 'be' in tag:
-            if 'be' in tag:
-                fmt = '>' + _INT_FORMATS[tag_name]
-            else:
-                fmt = '<' + _INT_FORMATS[tag_name]
-            return struct.pack(fmt, i)
+        if 'be' in tag:
+            pack = struct.Struct('>' + _INT_FORMATS[tag_name]).pack
+        elif 'b' in tag:
+            pack = struct.Struct('<' + _INT_FORMATS[tag_name]).pack
         else:
-            return str(i)
+            pack = str
+
+        def generate():
+            if self._random_pools is None:
+                return pack(random.randint(min_value, max_value))
+            return pack(self._random_pools.integer(min_value, max_value))
+        return generate
 
-    def _generate_float(self, tag):
-        """Generates floating point types."""
+    def _float_generator(self, tag):
+        """Returns a function that generates floating point types."""
         min_value = float(tag.get('min', '0'))
         max_value = float(tag.get('max', '1'))
         if min_value > max_value:
             raise GrammarError('Range error in a float tag')
-        f = min_value + random.random() * (max_value - min_value)
-        if 'b' in tag:
-            if tag['tagname'] == 'float':
-                return struct.pack('f', f)
-            else:
-                return struct.pack('d', f)
+        span = max_value - min_value
+
+        if 'b' not in tag:
+            pack = str
+        elif tag['tagname'] == 'float':
+            pack = struct.Struct('f').pack
         else:
-            return str(f)
+            pack = struct.Struct('d').pack
 
-    def _generate_char(self, tag):
-        """Generates a single character."""
+        def generate():
+            if self._random_pools is None:
+                return pack(min_value + random.random() * span)
+            return pack(min_value + self._random_pools.random() * span)
+        return generate
+
+    def _char_generator(self, tag):
+        """Returns a function that generates a single character."""
         if 'code' in tag:
-            return chr(self._string_to_int(tag['code']))
+            char = chr(self._string_to_int(tag['code']))
+            return lambda: char
 
         min_value = self._string_to_int(tag.get('min', '0'))
         max_value = self._string_to_int(tag.get('max', '255'))
         if min_value > max_value:
             raise GrammarError('Range error in char tag')
-        return chr(random.randint(min_value, max_value))
 
-    def _generate_string(self, tag):
-        """Generates a random string."""
+        def generate():
+            if self._random_pools is not None:
+                return self._random_pools.string(min_value, max_value, 1)
+            return chr(random.randint(min_value, max_value))
+        return generate
+
+    def _string_generator(self, tag):
+        """Returns a function that generates a random string."""
         min_value = self._string_to_int(tag.get('min', '0'))
         max_value = self._string_to_int(tag.get('max', '255'))
         if min_value > max_value:
             raise GrammarError('Range error in string tag')
         minlen = self._string_to_int(tag.get('minlength', '0'))
         maxlen = self._string_to_int(tag.get('maxlength', '20'))
-        length = random.randint(minlen, maxlen)
-        charset = range(min_value, max_value + 1)
-        ret_list = [chr(charset[int(random.random() * len(charset))])
-                    for _ in range(length)]
-        return ''.join(ret_list)
-
-    def _generate_html_string(self, tag):
-        return _escape(self._generate_string(tag), quote=True)
-
-    def _generate_hex(self, tag):
-        """Generates a single hex digit."""
-        digit = random.randint(0, 15)
-        if 'up' in tag:
-            return '%X' % digit
-        else:
-            return '%x' % digit
-
-    def _generate_import(self, tag):
-        """Expands a symbol from another (imported) grammar."""
+        if minlen > maxlen:
+            raise GrammarError('Length range error in string tag')
+        num_chars = max_value - min_value + 1
+
+        def generate():
+            if self._random_pools is not None:
+                length = self._random_pools.integer(minlen, maxlen)
+                return self._random_pools.string(min_value, max_value, length)
+            length = random.randint(minlen, maxlen)
+            rand = random.random
+            return ''.join([chr(min_value + int(rand() * num_chars))
+                            for _ in range(length)])
+        return generate
+
+    def _html_string_generator(self, tag):
+        """Returns a function that generates an HTML-escaped string."""
+        generate_string = self._string_generator(tag)
+        return lambda: _escape(generate_string(), quote=True)
+
+    def _hex_generator(self, tag):
+        """Returns a function that generates a single hex digit."""
+        fmt = '%X' if 'up' in tag else '%x'
+
+        def generate():
+            if self._random_pools is None:
+                return fmt % random.randint(0, 15)
+            return fmt % self._random_pools.integer(0, 15)
+        return generate
+
+    def _import_generator(self, tag):
+        """Returns a function that expands a symbol from another grammar.
+
+        Imports are only looked up when the symbol is generated, as they
+        can be added after the grammar is loaded.
+        """
         if 'from' not in tag:
             raise GrammarError('import tag without from attribute')
-
         grammarname = tag['from']
-        if grammarname not in self._imports:
-            raise GrammarError('unknown import ' + grammarname)
-
-        grammar = self._imports[grammarname]
-        if 'symbol' in tag:
-            symbol = tag['symbol']
+        symbol = tag.get('symbol')
+
+        def generate():
+            if grammarname not in self._imports:
+                raise GrammarError('unknown import ' + grammarname)
+            grammar = self._imports[grammarname]
+            if symbol is None:
+                return grammar.generate_root()
             return grammar.generate_symbol(symbol)
-        else:
-            return grammar.generate_root()
+        return generate
 
-    def _generate_lines(self, tag):
-        """Generates a given number of lines of code."""
+    def _lines_generator(self, tag):
+        """Returns a function that generates lines of code."""
         if 'count' not in tag:
             raise GrammarError('lines tag without count attribute')
-
         num_lines = self._string_to_int(tag['count'])
-        return self._generate_code(num_lines)
+        return lambda: self._generate_code(num_lines)
 
     def _generate_code(self, num_lines, initial_variables=[], last_var=0):
-        """Generates a given number of lines of code."""
+        """Generates a given number of lines of code.
+
+        Lines are generated into a single context. If a line fails, the
+        lines, variables and interesting lines it added are removed again
+        with _roll_back(), so nothing is copied for lines that succeed.
+        """
 
         context = {
             'lastvar': last_var,
             'lines': [],
             'variables': {},
             'interesting_lines': [],
-            'force_var_reuse': False
+            'interesting_line_set': set(),
+            'force_var_reuse': False,
+            # Variable types in the order _add_variable() appended to
+            # them and expansions added to caches, to undo the additions
+            # of failed lines.
+            'journal': []
         }
 
         for v in initial_variables:
@@ -282,19 +848,33 @@ class Grammar(object):
         self._add_variable('document', 'Document', context)
         self._add_variable('window', 'Window', context)
 
+        # Lines with a p attribute are selected according to their
+        # probabilities, interesting lines are always selected uniformly.
+        line_alias_table = None
+        if self._line_id is not None:
+            line_alias_table = self._lowered_alias_tables[self._line_id]
+
         while len(context['lines']) < num_lines:
-            tmp_context = context.copy()
+            save_point = self._save_point(context)
             try:
-                if (random.random() < self._interesting_line_prob) and (len(tmp_context['interesting_lines']) > 0):
-                    tmp_context['force_var_reuse'] = True
-                    lineno = random.choice(tmp_context['interesting_lines'])
-                else:
+                if (random.random() < self._interesting_line_prob) and (len(context['interesting_lines']) > 0):
+                    context['force_var_reuse'] = True
+                    lineno = random.choice(context['interesting_lines'])
+                elif line_alias_table is None:
                     lineno = random.choice(self._all_nonhelper_lines)
-                creator = self._creators['line'][lineno]
-                self._expand_rule('line', creator, tmp_context, 0, False)
-                context = tmp_context
+                else:
+                    lineno = _alias_index(line_alias_table)
+                creator = self._lowered_creators[self._line_id][lineno]
+                if (self._explicit_stack or
+                        self._recursion_max > _MAX_RECURSIVE_DEPTH):
+                    self._expand_rule_iteratively(
+                        self._line_id, creator, context, 0, False)
+                else:
+                    self._expand_rule(self._line_id, creator, context, 0,
+                                      False)
             except RecursionError as e:
                 print('Warning: ' + str(e))
+                self._roll_back(context, save_point)
         if not self._line_guard:
             guarded_lines = context['lines']
         else:
@@ -303,13 +883,49 @@ class Grammar(object):
                 guarded_lines.append(self._line_guard.replace('<line>', line))
         return '\n'.join(guarded_lines)
 
+    def _save_point(self, context):
+        """Returns the state of a context that _roll_back() restores."""
+        return (len(context['lines']), len(context['interesting_lines']),
+                len(context['journal']), context['lastvar'],
+                context['force_var_reuse'])
+
+    def _roll_back(self, context, save_point):
+        """Undoes the changes made to a context since a save point.
+
+        Expansions added to caches are removed again. Changes that
+        user-defined functions make to the context directly are not
+        undone.
+        """
+        (num_lines, num_interesting_lines, journal_size, context['lastvar'],
+         context['force_var_reuse']) = save_point
+        del context['lines'][num_lines:]
+        interesting_lines = context['interesting_lines']
+        context['interesting_line_set'].difference_update(
+            interesting_lines[num_interesting_lines:])
+        del interesting_lines[num_interesting_lines:]
+        variables = context['variables']
+        journal = context['journal']
+        while len(journal) > journal_size:
+            entry = journal.pop()
+            if isinstance(entry, tuple):
+                # An expansion added to a cache.
+                cache, expansion, evicted = entry
+                cache.undo_add(expansion, evicted)
+                continue
+            names = variables[entry]
+            names.pop()
+            if not names:
+                del variables[entry]
+
     def _exec_function(self, function_name, attributes, context, ret_val):
         """Executes user-defined python code."""
         if function_name not in self._functions:
             raise GrammarError('Unknown function ' + function_name)
         compiled_function = self._functions[function_name]
         args = {
-            'attributes': attributes,
+            # Tags are shared between rules, changes must not leak into
+            # other rules.
+            'attributes': dict(attributes),
             'context': context,
             'ret_val': ret_val
         }
@@ -320,51 +936,124 @@ class Grammar(object):
             raise GrammarError('Error in user-defined function: %s' % str(e))
         return args['ret_val']
 
-    def _select_creator(self, symbol, recursion_depth, force_nonrecursive):
+    def _select_creator(self, symbol_id, recursion_depth, force_nonrecursive):
         """Selects the creator for the given symbol.
 
         The creator is based on probabilities specified in the grammar or
         based on uniform distribution if no probabilities are specified.
 
+        Only creators that can be fully expanded within the maximum
+        recursion depth are considered, see _restrict_creators().
+
         Args:
-            symbol: The name of the symbol to get the creator rules for.
+            symbol_id: The ID of the symbol to get the creator rules for.
             recursion_depth: Current recursion depth
             force_nonrecursive: if True, only creators which are marked as
                 'nonrecursive' will be used (if available)
 
         Returns:
-            A dictionary describing a rule that can create a given symbol.
+            A lowered rule that can create a given symbol.
 
         Raises:
-            RecursionError: If maximum recursion level was reached.
+            RecursionError: If the symbol can't be expanded within the
+                maximum recursion depth.
             GrammarError: If there are no rules that create a given type.
         """
 
         # Do we even know how to create this type?
-        if symbol not in self._creators:
-            raise GrammarError('No creators for type ' + symbol)
-
-        if recursion_depth >= self._recursion_max:
-            raise RecursionError(
-                'Maximum recursion level reached while creating '
-                'object of type' + symbol
-            )
-        elif force_nonrecursive and symbol in self._nonrecursive_creators:
-            creators = self._nonrecursive_creators[symbol]
-            cdf = self._nonrecursivecreator_cdfs[symbol]
+        creators = self._lowered_creators[symbol_id]
+        if creators is None:
+            raise GrammarError('No creators for type ' +
+                               self._symbol_names[symbol_id])
+
+        if (recursion_depth + self._lowered_max_depths[symbol_id] >
+                self._recursion_max):
+            # Not every creator fits into the remaining depth.
+            creators, alias_table = self._restrict_creators(symbol_id,
+                                                            recursion_depth)
+            if creators is None:
+                raise RecursionError(
+                    'Maximum recursion level reached while creating '
+                    'object of type' + self._symbol_names[symbol_id]
+                )
+        elif (force_nonrecursive and
+              self._lowered_nonrecursive[symbol_id] is not None):
+            creators = self._lowered_nonrecursive[symbol_id]
+            alias_table = self._lowered_nonrecursive_alias_tables[symbol_id]
         else:
-            creators = self._creators[symbol]
-            cdf = self._creator_cdfs[symbol]
+            alias_table = self._lowered_alias_tables[symbol_id]
 
-        if not cdf:
+        if alias_table is None:
             # Uniform distribution, faster
             return creators[random.randint(0, len(creators) - 1)]
 
-        # Select a creator according to the cdf
-        idx = bisect.bisect_left(cdf, random.random(), 0, len(cdf))
-        return creators[idx]
+        # Select a creator according to the probabilities
+        return creators[_alias_index(alias_table)]
+
+    def _restrict_creators(self, symbol_id, recursion_depth):
+        """Selects the creators that fit into the remaining depth.
+
+        Only the creators that can't be fully expanded within the maximum
+        recursion depth are left out, the others keep the proportions of
+        their probabilities. The nonrecursive creators are among them, so
+        they are used as a fallback only when nothing else fits. The
+        result for each symbol and depth is computed once and cached.
+
+        Returns:
+            A (creators, alias table) tuple, where creators is None if no
+            creator fits and the alias table is None for uniform
+            selection.
+        """
+        key = (symbol_id, recursion_depth)
+        restricted = self._restricted_creators.get(key)
+        if restricted is not None:
+            return restricted
+
+        budget = self._recursion_max - recursion_depth
+        creators = self._lowered_creators[symbol_id]
+        cdf = self._lowered_cdfs[symbol_id]
+        if cdf:
+            probabilities = _cdf_probabilities(cdf)
+        else:
+            probabilities = [1.0] * len(creators)
+        fitting = []
+        fitting_probabilities = []
+        for i in range(len(creators)):
+            rule = creators[i]
+            if self._rule_depth(rule) <= budget:
+                fitting.append(rule)
+                fitting_probabilities.append(probabilities[i])
+        if not fitting:
+            restricted = (None, None)
+        else:
+            alias_table = None
+            if cdf:
+                alias_table = _alias_table(fitting_probabilities)
+            restricted = (fitting, alias_table)
+
+        self._restricted_creators[key] = restricted
+        return restricted
 
-    def _generate(self, symbol, context,
+    def _rule_depth(self, rule):
+        """Returns the recursion depth needed to fully expand a rule.
+
+        The depth of a rule without symbols is 1, a symbol needs its
+        minimum depth one level deeper and inlined operations also count
+        the levels they skip. A rule fits at recursion depth d if d plus
+        its depth does not exceed the maximum recursion depth.
+        """
+        min_depths = self._lowered_min_depths
+        depth = 1
+        for opcode, arg, _ in rule[1]:
+            if opcode == _OP_SYMBOL:
+                depth = max(depth, min_depths[arg] + 1)
+            elif opcode == _OP_INLINED_TEXT:
+                depth = max(depth, arg[1] + 1)
+            elif opcode == _OP_INLINED_SYMBOL:
+                depth = max(depth, min_depths[arg[0]] + arg[1] + 1)
+        return min(depth, _UNBOUNDED_DEPTH)
+
+    def _generate(self, symbol_id, context,
                   recursion_depth=0, force_nonrecursive=False):
         """Generates a user-defined symbol.
 
@@ -372,7 +1061,7 @@ class Grammar(object):
         of the rule.
 
         Args:
-            symbol: The name of the symbol that is being resolved.
+            symbol_id: The ID of the symbol that is being resolved.
             context: dictionary consisting of:
                 'lastvar': Index of last variable created.
                 'lines': Generated lines of code
@@ -392,49 +1081,69 @@ class Grammar(object):
             RecursionError: If maximum recursion level was reached.
         """
 
-        # print symbol
-
-        # print 'Expanding ' + symbol + ' in depth ' + str(recursion_depth)
-
         force_var_reuse = context['force_var_reuse']
 
         # Check if we already have a variable of the given type.
-        if (symbol in context['variables'] and
-                symbol not in _NONINTERESTING_TYPES):
-            # print symbol + ':' + str(len(context['variables'][symbol])) + ':' + str(force_var_reuse)
-            if (force_var_reuse or
+        if self._reusable_symbols[symbol_id]:
+            variables = context['variables'].get(
+                self._symbol_names[symbol_id])
+            if variables is not None and (
+                    force_var_reuse or
                     random.random() < self._var_reuse_prob or
-                    len(context['variables'][symbol]) > self._max_vars_of_same_type):
-                # print 'reusing existing var of type ' + symbol
+                    len(variables) > self._max_vars_of_same_type):
                 context['force_var_reuse'] = False
-                variables = context['variables'][symbol]
                 return variables[random.randint(0, len(variables) - 1)]
-                # print 'Not reusing existing var of type ' + symbol
+
+        cache = self._lowered_caches[symbol_id]
+        if cache is not None:
+            expanded = cache.get(recursion_depth)
+            if expanded is not None:
+                return expanded
+
+        if self._lowered_pools[symbol_id] is not None:
+            expanded = self._sample_pool(symbol_id, recursion_depth, context)
+            if expanded is not None:
+                return expanded
 
         creator = self._select_creator(
-            symbol,
-            recursion_depth,
-            force_nonrecursive
-        )
-        return self._expand_rule(
-            symbol,
-            creator,
-            context,
+            symbol_id,
             recursion_depth,
             force_nonrecursive
         )
+        if self._explicit_stack or self._recursion_max > _MAX_RECURSIVE_DEPTH:
+            # Only reached for the symbol generation starts from, the
+            # engine expands everything below it without calling back here.
+            expanded = self._expand_rule_iteratively(
+                symbol_id,
+                creator,
+                context,
+                recursion_depth,
+                force_nonrecursive
+            )
+        else:
+            expanded = self._expand_rule(
+                symbol_id,
+                creator,
+                context,
+                recursion_depth,
+                force_nonrecursive
+            )
+        if cache is not None:
+            cache.add(expanded, recursion_depth, context.get('journal'))
+        return expanded
 
-    def _expand_rule(self, symbol, rule, context,
+    def _expand_rule(self, symbol_id, rule, context,
                      recursion_depth, force_nonrecursive):
         """Expands a given rule.
 
-        Iterates through all the elements on right-hand side of the rule,
-        replacing them with their string representations or recursively
-        calling _Generate() for other non-terminal symbols.
+        Iterates through all the operations of the lowered rule, replacing
+        them with their string representations or recursively calling
+        _generate() for other non-terminal symbols.
 
         Args:
-            symbol: The name of the symbol that is being resolved.
-            rule: production rule that will be used to expand the symbol.
+            symbol_id: The ID of the symbol that is being resolved.
+            rule: lowered production rule (see _lower_rule()) that will be
+                used to expand the symbol.
             context: dictionary consisting of:
                 'lastvar': Index of last variable created.
                 'lines': Generated lines of code
@@ -453,47 +1162,27 @@ class Grammar(object):
                 some rules being impossible to resolve
             RecursionError: If maximum recursion level was reached.
         """
+        is_code, ops = rule
         variable_ids = {}
 
         # Resolve the right side of the rule
         new_vars = []
         ret_vars = []
         ret_parts = []
-        for part in rule['parts']:
-            if 'id' in part:
-                if part['id'] in variable_ids:
-                    ret_parts.append(variable_ids[part['id']])
+        for opcode, arg, tag in ops:
+            if opcode == _OP_TEXT:
+                ret_parts.append(arg)
+                continue
+
+            if tag is not None and 'id' in tag:
+                if tag['id'] in variable_ids:
+                    ret_parts.append(variable_ids[tag['id']])
                     continue
 
-            if part['type'] == 'text':
-                expanded = part['text']
-            elif rule['type'] == 'code' and 'new' in part:
-                var_type = part['tagname']
-                context['lastvar'] += 1
-                var_name = self._var_format % context['lastvar']
-                new_vars.append({'name': var_name, 'type': var_type})
-                # print var_name
-                # print context['lastvar']
-                if var_type == symbol:
-                    ret_vars.append(var_name)
-                expanded = '/* newvar{' + var_name + ':' + var_type + '} */ var ' + var_name
-            elif part['tagname'] in self._constant_types:
-                expanded = self._constant_types[part['tagname']]
-            elif part['tagname'] in self._built_in_types:
-                expanded = self._built_in_types[part['tagname']](part)
-            elif part['tagname'] == 'call':
-                if 'function' not in part:
-                    raise GrammarError('Call tag without a function attribute')
-                expanded = self._exec_function(
-                    part['function'],
-                    part,
-                    context,
-                    ''
-                )
-            else:
+            if opcode == _OP_SYMBOL:
                 try:
                     expanded = self._generate(
-                        part['tagname'],
+                        arg,
                         context,
                         recursion_depth + 1,
                         force_nonrecursive
@@ -501,59 +1190,388 @@ class Grammar(object):
                 except RecursionError as e:
                     if not force_nonrecursive:
                         expanded = self._generate(
-                            part['tagname'],
+                            arg,
                             context,
                             recursion_depth + 1,
                             True
                         )
                     else:
                         raise RecursionError(e)
-
-            if 'id' in part:
-                variable_ids[part['id']] = expanded
-
-            if 'beforeoutput' in part:
+            elif opcode == _OP_INLINED_TEXT:
+                text, levels, inlined_id = arg
+                if recursion_depth + levels >= self._recursion_max:
+                    raise RecursionError(
+                        'Maximum recursion level reached while creating '
+                        'object of type' + self._symbol_names[inlined_id]
+                    )
+                expanded = text
+            elif opcode == _OP_INLINED_SYMBOL:
+                expanded = self._expand_inlined_symbol(
+                    arg, context, recursion_depth, force_nonrecursive)
+            elif opcode == _OP_BUILTIN:
+                expanded = arg()
+            elif opcode == _OP_NEW:
+                context['lastvar'] += 1
+                var_name = self._var_format % context['lastvar']
+                new_vars.append({'name': var_name, 'type': arg})
+                if arg == self._symbol_names[symbol_id]:
+                    ret_vars.append(var_name)
+                expanded = '/* newvar{' + var_name + ':' + arg + '} */ var ' + var_name
+            elif opcode == _OP_CONSTANT:
+                expanded = arg
+            else:
+                if 'function' not in tag:
+                    raise GrammarError('Call tag without a function attribute')
                 expanded = self._exec_function(
-                    part['beforeoutput'],
-                    part,
+                    tag['function'],
+                    tag,
                     context,
-                    expanded
+                    ''
                 )
 
+            if tag is not None:
+                if 'id' in tag:
+                    variable_ids[tag['id']] = expanded
+
+                if 'beforeoutput' in tag:
+                    expanded = self._exec_function(
+                        tag['beforeoutput'],
+                        tag,
+                        context,
+                        expanded
+                    )
+
             ret_parts.append(expanded)
 
+        return self._finish_rule(symbol_id, is_code, ret_parts, new_vars,
+                                 ret_vars, context)
+
+    def _finish_rule(self, symbol_id, is_code, ret_parts, new_vars, ret_vars,
+                     context):
+        """Joins the expanded parts of a rule and returns the result.
+
+        For code rules the result is also added to the generated lines,
+        along with the lines that register the new variables, and the
+        return value is one of the created variables.
+        """
         # Add all newly created variables to the context
         additional_lines = []
         for v in new_vars:
             if v['type'] not in _NONINTERESTING_TYPES:
                 self._add_variable(v['name'], v['type'], context)
-                additional_lines.append("if (!" + v['name'] + ") { " + v['name'] + " = GetVariable(fuzzervars, '" + v['type'] + "'); } else { " + self._get_variable_setters(v['name'], v['type']) + " }")
+                template = self._setter_templates.get(v['type'])
+                if template is None:
+                    template = self._setter_template(v['type'])
+                additional_lines.append(v['name'].join(template))
 
         # Return the result.
         # In case of 'ordinary' grammar rules, return the filled rule.
         # In case of code, return just the variable name
         # and update the context
         filed_rule = ''.join(ret_parts)
-        if rule['type'] == 'grammar':
+        if not is_code:
             return filed_rule
         else:
             context['lines'].append(filed_rule)
             context['lines'].extend(additional_lines)
-            if symbol == 'line':
+            if symbol_id == self._line_id:
                 return filed_rule
             else:
                 return ret_vars[random.randint(0, len(ret_vars) - 1)]
 
+    def _expand_rule_iteratively(self, symbol_id, rule, context,
+                                 recursion_depth, force_nonrecursive):
+        """Expands a given rule without recursing for nested symbols.
+
+        Produces the same result as _expand_rule() and draws the same
+        random numbers in the same order, but keeps the rules that are
+        being expanded on an explicit stack instead of in Python frames,
+        so the recursion depth is only limited by !max_recursion.
+
+        Every entry of the stack is the saved state of a partially
+        expanded rule whose current operation waits for the expansion
+        of a symbol. A RecursionError raised while expanding a rule
+        discards the rule, like an exception unwinding its frame, and is
+        handled by the operation waiting for it: it either retries the
+        symbol with only nonrecursive rules, like _expand_rule() and
+        _expand_inlined_symbol() do, or fails as well.
+
+        Args and return value are the same as for _expand_rule().
+        """
+        lowered_creators = self._lowered_creators
+        lowered_nonrecursive = self._lowered_nonrecursive
+        alias_tables = self._lowered_alias_tables
+        pools = self._lowered_pools
+        caches = self._lowered_caches
+        reusable_symbols = self._reusable_symbols
+        symbol_names = self._symbol_names
+        max_depths = self._lowered_max_depths
+        recursion_max = self._recursion_max
+        randint = random.randint
+
+        stack = []
+        is_code, ops = rule
+        pos = 0
+        parts = []
+        variable_ids = None
+        new_vars = None
+        ret_vars = None
+        depth = recursion_depth
+        force = force_nonrecursive
+        # Number of failed attempts of the operation at pos.
+        attempt = 0
+        error = None
+        start_symbol = False
+
+        while True:
+            if error is None and not start_symbol:
+                # Expand the operations of the current rule up to the end
+                # or up to the next symbol.
+                try:
+                    num_ops = len(ops)
+                    while pos < num_ops:
+                        opcode, arg, tag = ops[pos]
+                        if opcode == _OP_TEXT:
+                            parts.append(arg)
+                            pos += 1
+                            continue
+
+                        if (tag is not None and 'id' in tag and
+                                variable_ids is not None and
+                                tag['id'] in variable_ids):
+                            parts.append(variable_ids[tag['id']])
+                            pos += 1
+                            continue
+
+                        if (opcode == _OP_SYMBOL or
+                                opcode == _OP_INLINED_SYMBOL):
+                            attempt = 0
+                            start_symbol = True
+                            break
+
+                        if opcode == _OP_INLINED_TEXT:
+                            text, levels, inlined_id = arg
+                            if depth + levels >= recursion_max:
+                                raise RecursionError(
+                                    'Maximum recursion level reached while '
+                                    'creating object of type' +
+                                    symbol_names[inlined_id]
+                                )
+                            expanded = text
+                        elif opcode == _OP_BUILTIN:
+                            expanded = arg()
+                        elif opcode == _OP_NEW:
+                            if new_vars is None:
+                                new_vars = []
+                                ret_vars = []
+                            context['lastvar'] += 1
+                            var_name = self._var_format % context['lastvar']
+                            new_vars.append({'name': var_name, 'type': arg})
+                            if arg == symbol_names[symbol_id]:
+                                ret_vars.append(var_name)
+                            expanded = '/* newvar{' + var_name + ':' + arg + '} */ var ' + var_name
+                        elif opcode == _OP_CONSTANT:
+                            expanded = arg
+                        else:
+                            if 'function' not in tag:
+                                raise GrammarError(
+                                    'Call tag without a function attribute')
+                            expanded = self._exec_function(
+                                tag['function'],
+                                tag,
+                                context,
+                                ''
+                            )
+
+                        if tag is not None:
+                            if 'id' in tag:
+                                if variable_ids is None:
+                                    variable_ids = {}
+                                variable_ids[tag['id']] = expanded
+
+                            if 'beforeoutput' in tag:
+                                expanded = self._exec_function(
+                                    tag['beforeoutput'],
+                                    tag,
+                                    context,
+                                    expanded
+                                )
+
+                        parts.append(expanded)
+                        pos += 1
+
+                    if not start_symbol:
+                        # The rule is complete, return the result to the
+                        # operation waiting for it.
+                        if new_vars is None:
+                            new_vars = ret_vars = []
+                        expanded = self._finish_rule(
+                            symbol_id, is_code, parts, new_vars, ret_vars,
+                            context)
+                        if not stack:
+                            return expanded
+                        if caches[symbol_id] is not None:
+                            caches[symbol_id].add(expanded, depth,
+                                                  context.get('journal'))
+                        (symbol_id, is_code, ops, pos, parts, variable_ids,
+                         new_vars, ret_vars, depth, force,
+                         attempt) = stack.pop()
+                        tag = ops[pos][2]
+                        if tag is not None:
+                            if 'id' in tag:
+                                if variable_ids is None:
+                                    variable_ids = {}
+                                variable_ids[tag['id']] = expanded
+
+                            if 'beforeoutput' in tag:
+                                expanded = self._exec_function(
+                                    tag['beforeoutput'],
+                                    tag,
+                                    context,
+                                    expanded
+                                )
+                        parts.append(expanded)
+                        pos += 1
+                        continue
+                except RecursionError as e:
+                    # The current rule fails, pass the error to the
+                    # operation waiting for it.
+                    if not stack:
+                        raise
+                    error = e
+                    (symbol_id, is_code, ops, pos, parts, variable_ids,
+                     new_vars, ret_vars, depth, force,
+                     attempt) = stack.pop()
+
+            if error is not None:
+                # The symbol at pos could not be expanded, see if it can
+                # be retried with nonrecursive rules.
+                start_symbol = False
+                if not force:
+                    opcode, arg, _ = ops[pos]
+                    if opcode == _OP_SYMBOL:
+                        start_symbol = attempt == 0
+                    else:
+                        start_symbol = attempt <= arg[1]
+                if start_symbol:
+                    attempt += 1
+                    error = None
+                elif not stack:
+                    raise RecursionError(error)
+                else:
+                    (symbol_id, is_code, ops, pos, parts, variable_ids,
+                     new_vars, ret_vars, depth, force,
+                     attempt) = stack.pop()
+                    continue
+
+            # Start expanding the symbol at pos, like _generate() does.
+            start_symbol = False
+            opcode, arg, tag = ops[pos]
+            if opcode == _OP_SYMBOL:
+                child_id = arg
+                child_depth = depth + 1
+            else:
+                child_id, levels = arg
+                child_depth = depth + levels + 1
+            child_force = force or attempt > 0
+
+            expanded = None
+            if reusable_symbols[child_id]:
+                variables = context['variables'].get(symbol_names[child_id])
+                if variables is not None and (
+                        context['force_var_reuse'] or
+                        random.random() < self._var_reuse_prob or
+                        len(variables) > self._max_vars_of_same_type):
+                    context['force_var_reuse'] = False
+                    expanded = variables[randint(0, len(variables) - 1)]
+            if expanded is None and caches[child_id] is not None:
+                expanded = caches[child_id].get(child_depth)
+            if expanded is None and pools[child_id] is not None:
+                expanded = self._sample_pool(child_id, child_depth, context)
+            if expanded is not None:
+                if tag is not None:
+                    if 'id' in tag:
+                        if variable_ids is None:
+                            variable_ids = {}
+                        variable_ids[tag['id']] = expanded
+
+                    if 'beforeoutput' in tag:
+                        expanded = self._exec_function(
+                            tag['beforeoutput'],
+                            tag,
+                            context,
+                            expanded
+                        )
+                parts.append(expanded)
+                pos += 1
+                continue
+
+            creators = lowered_creators[child_id]
+            if creators is None:
+                raise GrammarError('No creators for type ' +
+                                   symbol_names[child_id])
+            if child_depth + max_depths[child_id] > recursion_max:
+                creators, alias_table = self._restrict_creators(child_id,
+                                                                child_depth)
+                if creators is None:
+                    error = RecursionError(
+                        'Maximum recursion level reached while creating '
+                        'object of type' + symbol_names[child_id]
+                    )
+                    continue
+            elif child_force and lowered_nonrecursive[child_id] is not None:
+                creators = lowered_nonrecursive[child_id]
+                alias_table = self._lowered_nonrecursive_alias_tables[child_id]
+            else:
+                alias_table = alias_tables[child_id]
+            if alias_table is None:
+                child = creators[randint(0, len(creators) - 1)]
+            else:
+                child = creators[_alias_index(alias_table)]
+
+            stack.append((symbol_id, is_code, ops, pos, parts, variable_ids,
+                          new_vars, ret_vars, depth, force, attempt))
+            symbol_id = child_id
+            is_code, ops = child
+            pos = 0
+            parts = []
+            variable_ids = None
+            new_vars = None
+            ret_vars = None
+            depth = child_depth
+            force = child_force
+
+    def _expand_inlined_symbol(self, arg, context, recursion_depth,
+                               force_nonrecursive):
+        """Expands a symbol that replaced a chain of inlined symbols.
+
+        Behaves like expanding the chain: the symbol is generated at the
+        depth it would have had, and if that fails, every skipped level
+        retries it once with only nonrecursive rules.
+
+        Args:
+            arg: (symbol ID, number of skipped levels) tuple.
+        """
+        symbol_id, levels = arg
+        depth = recursion_depth + levels + 1
+        try:
+            return self._generate(symbol_id, context, depth,
+                                  force_nonrecursive)
+        except RecursionError as e:
+            if force_nonrecursive:
+                raise RecursionError(e)
+            error = e
+        for _ in range(levels + 1):
+            try:
+                return self._generate(symbol_id, context, depth, True)
+            except RecursionError as e:
+                error = e
+        raise RecursionError(error)
+
     def generate_root(self):
         """Expands root symbol."""
         if self._root:
-            context = {
-                'lastvar': 0,
-                'lines': [],
-                'variables': {},
-                'force_var_reuse': False
-            }
-            return self._generate(self._root, context, 0)
+            return self.generate_symbol(self._root)
         else:
             print('Error: No root element defined.')
             return ''
@@ -566,7 +1584,9 @@ class Grammar(object):
             'variables': {},
             'force_var_reuse': False
         }
-        return self._generate(name, context, 0)
+        if name not in self._symbol_ids:
+            raise GrammarError('No creators for type ' + name)
+        return self._generate(self._symbol_ids[name], context, 0)
 
     def _get_cdf(self, symbol, creators):
         """Computes a probability function for a given creator array."""
@@ -575,17 +1595,15 @@ class Grammar(object):
         defined = []
         cdf = []
 
-        if symbol == 'line':
-            # We can't currently set line probability
-            return []
-
         # Get probabilities for individual rule
         for creator in creators:
-            if creator['type'] == 'grammar':
-                create_tag = creator['creates']
+            if creator.type == 'grammar':
+                create_tag = creator.creates
             else:
-                # For type=code multiple variables may be created
-                for tag in creator['creates']:
+                # For type=code multiple variables may be created, and
+                # lines can be weighted with a <line> tag.
+                create_tag = {}
+                for tag in creator.creates:
                     if tag['tagname'] == symbol:
                         create_tag = tag
                         break
@@ -631,6 +1649,8 @@ class Grammar(object):
         preprocessing function that makes subsequent creator selection
         based on probability easier.
         """
+        self._creator_cdfs = {}
+        self._nonrecursivecreator_cdfs = {}
         for symbol, creators in self._creators.items():
             cdf = self._get_cdf(symbol, creators)
             self._creator_cdfs[symbol] = cdf
@@ -639,136 +1659,1029 @@ class Grammar(object):
             cdf = self._get_cdf(symbol, creators)
             self._nonrecursivecreator_cdfs[symbol] = cdf
 
-    def _parse_tag_and_attributes(self, string):
-        """Extracts tag name and attributes from a string."""
-        parts = string.split()
-        if len(parts) < 1:
-            raise GrammarError('Empty tag encountered')
-        ret = {'type': 'tag'}
-        if len(parts) > 1 and parts[0] == 'new':
-            ret['tagname'] = parts[1]
-            ret['new'] = 'true'
-            attrstart = 2
-        else:
-            ret['tagname'] = parts[0]
-            attrstart = 1
-        for i in range(attrstart, len(parts)):
-            attrparts = parts[i].split('=')
-            if len(attrparts) == 2:
-                ret[attrparts[0]] = attrparts[1]
-            elif len(attrparts) == 1:
-                ret[attrparts[0]] = True
-            else:
-                raise GrammarError('Error parsing tag ' + string)
-        return ret
+    def _symbol_id(self, symbol):
+        """Returns the ID of a symbol, assigning a new one if needed."""
+        symbol_id = self._symbol_ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = len(self._symbol_names)
+            self._symbol_ids[symbol] = symbol_id
+            self._symbol_names.append(symbol)
+        return symbol_id
+
+    def _lower_part(self, part, is_code):
+        """Converts a rule part into an (opcode, argument, tag) operation.
+
+        The opcode determines how the part is expanded, following the same
+        precedence _expand_rule() used to apply to tags: new variables
+        (only in code rules), constants, built-in types, calls and
+        finally user-defined symbols, whose argument is the symbol ID.
+        The argument of a built-in type is its specialized generator, see
+        _specialize_built_in(). tag is the attribute dictionary passed to
+        user functions, or None for text.
+        """
+        if isinstance(part, str):
+            return (_OP_TEXT, part, None)
+        tagname = part['tagname']
+        if is_code and 'new' in part:
+            return (_OP_NEW, tagname, part)
+        if tagname in self._constant_types:
+            constant = self._constant_types[tagname]
+            if 'id' in part or 'beforeoutput' in part:
+                return (_OP_CONSTANT, constant, part)
+            return (_OP_TEXT, constant, None)
+        if tagname in self._built_in_types:
+            return (_OP_BUILTIN, self._specialize_built_in(part), part)
+        if tagname == 'call':
+            return (_OP_CALL, None, part)
+        return (_OP_SYMBOL, self._symbol_id(tagname), part)
+
+    def _lower_rule(self, rule, lowered_parts):
+        """Converts a rule into an (is_code, operations) tuple.
+
+        Tags and texts are shared between rules, and so are the operations
+        built from them. lowered_parts is a pair of dictionaries that map
+        part IDs to operations, for grammar and code rules respectively.
+        """
+        is_code = rule.type == 'code'
+        lowered = lowered_parts[is_code]
+        ops = []
+        for part in rule.parts:
+            op = lowered.get(id(part))
+            if op is None:
+                op = lowered[id(part)] = self._lower_part(part, is_code)
+            ops.append(op)
+        return (is_code, tuple(ops))
+
+    def _lower(self):
+        """Builds the representation of the grammar used for generation.
+
+        Symbols are numbered and the creators of every symbol (and their
+        CDFs, alias tables, depths and output pools) are stored in lists
+        indexed by symbol ID. Rules are lowered into tuples of operations
+        that can be expanded without inspecting the tag attributes.
+        _creators and the other dictionaries stay the editable source of
+        truth; this needs to run again after they change.
+        """
+        self._symbol_ids = {}
+        self._symbol_names = []
+        self._lowered_creators = []
+        self._lowered_nonrecursive = []
+        self._lowered_cdfs = []
+        self._lowered_nonrecursive_cdfs = []
+        self._reusable_symbols = []
+        for symbol in self._creators:
+            self._symbol_id(symbol)
+        self._lower_symbols(list(self._creators))
+        self._line_id = self._symbol_ids.get('line')
+        if self._optimized:
+            self._optimize_lowered()
+        self._lower_alias_tables()
+        self._lower_depths()
+        self._lower_pools()
+        self._lower_caches()
+        self._lower_variable_ancestors()
+
+    def _relower(self, symbols):
+        """Updates the lowered grammar after creators of symbols changed.
+
+        Only the rules of the given symbols are lowered again. The depths
+        and pools are computed again for them and for the symbols that
+        reference them, directly or indirectly, since only those can
+        change. Variable ancestors only depend on !extends commands and
+        stay the same. Optimized grammars are lowered again from scratch,
+        since their rules may have other symbols inlined into them.
+        """
+        if self._optimized:
+            self._lower()
+            return
+        self._lower_symbols(sorted(symbols))
+        self._line_id = self._symbol_ids.get('line')
+        self._lower_alias_tables()
+        dependents = self._dependent_symbols(
+            [self._symbol_ids[symbol] for symbol in symbols])
+        self._lower_depths(dependents)
+        self._lower_pools(dependents)
+        self._lower_caches()
+
+    def _dependent_symbols(self, symbol_ids):
+        """Returns the IDs of the symbols that reference the given ones.
+
+        Symbols are followed through any number of rules and the given
+        symbols are included.
+        """
+        users = [[] for _ in self._symbol_names]
+        for symbol_id, creators in enumerate(self._lowered_creators):
+            for _, ops in creators or ():
+                for opcode, arg, _ in ops:
+                    if opcode == _OP_SYMBOL:
+                        users[arg].append(symbol_id)
+                    elif opcode == _OP_INLINED_SYMBOL:
+                        users[arg[0]].append(symbol_id)
+        found = set(symbol_ids)
+        pending = list(found)
+        while pending:
+            for user in users[pending.pop()]:
+                if user not in found:
+                    found.add(user)
+                    pending.append(user)
+        return sorted(found)
+
+    def _lower_symbols(self, symbols):
+        """Lowers the creators of the given symbols.
+
+        The lists indexed by symbol ID are extended as symbols get IDs,
+        which includes symbols that are used but never created, so that
+        they only fail if they are actually generated.
+
+        Rules with the same operations, such as a line repeated in several
+        files, are lowered into a single shared tuple.
+        """
+        lowered_rules = {}
+        lowered_parts = ({}, {})
+        interned_rules = {}
+
+        def lower_creators(creators):
+            if creators is None:
+                return None
+            lowered = []
+            for rule in creators:
+                lowered_rule = lowered_rules.get(id(rule))
+                if lowered_rule is None:
+                    lowered_rule = self._lower_rule(rule, lowered_parts)
+                    # Operations are shared, so their IDs identify them.
+                    key = (lowered_rule[0],
+                           tuple(map(id, lowered_rule[1])))
+                    lowered_rule = interned_rules.setdefault(
+                        key, lowered_rule)
+                    lowered_rules[id(rule)] = lowered_rule
+                lowered.append(lowered_rule)
+            return lowered
+
+        for symbol in symbols:
+            symbol_id = self._symbol_id(symbol)
+            creators = lower_creators(self._creators.get(symbol))
+            nonrecursive = lower_creators(
+                self._nonrecursive_creators.get(symbol))
+            num_new = len(self._symbol_names) - len(self._lowered_creators)
+            if num_new:
+                self._lowered_creators.extend([None] * num_new)
+                self._lowered_nonrecursive.extend([None] * num_new)
+                self._lowered_cdfs.extend([None] * num_new)
+                self._lowered_nonrecursive_cdfs.extend([None] * num_new)
+                self._reusable_symbols.extend(
+                    new_symbol not in _NONINTERESTING_TYPES
+                    for new_symbol in self._symbol_names[-num_new:])
+            self._lowered_creators[symbol_id] = creators
+            self._lowered_nonrecursive[symbol_id] = nonrecursive
+            self._lowered_cdfs[symbol_id] = self._creator_cdfs.get(symbol)
+            self._lowered_nonrecursive_cdfs[symbol_id] = (
+                self._nonrecursivecreator_cdfs.get(symbol))
+
+    def _lower_alias_tables(self):
+        self._lowered_alias_tables = [
+            _alias_table(_cdf_probabilities(cdf)) if cdf else None
+            for cdf in self._lowered_cdfs]
+        self._lowered_nonrecursive_alias_tables = [
+            _alias_table(_cdf_probabilities(cdf)) if cdf else None
+            for cdf in self._lowered_nonrecursive_cdfs]
+
+    def _lower_depths(self, symbol_ids=None):
+        """Computes the recursion depth needed by every lowered symbol.
+
+        The minimum depth of a symbol is the smallest depth of its
+        creators (see _rule_depth()) and the maximum depth is the largest
+        one. While the recursion depth plus the maximum depth of a symbol
+        is within the limit, any of its creators can be selected;
+        otherwise _restrict_creators() picks the ones that still fit.
+        This is done on the lowered rules, so that inlined symbols are
+        accounted for.
 
-    def _parse_code_line(self, line, helper_lines=False):
-        """Parses a rule for generating code."""
-        rule = {
-            'type': 'code',
-            'parts': [],
-            'creates': []
-        }
-        # Splits the line into constant parts and tags. For example
-        # "foo<bar>baz" would be split into three parts, "foo", "bar" and "baz"
-        # Every other part is going to be constant and every other part
-        # is going to be a tag, always starting with a constant. Empty
-        # spaces between tags/beginning/end are not a problem because
-        # then empty strings will be returned in corresponding places,
-        # for example "<foo><bar>" gets split into "", "foo", "", "bar", ""
-        rule_parts = re.split(r'<([^>)]*)>', line)
-        for i in range(0, len(rule_parts)):
-            if i % 2 == 0:
-                if rule_parts[i]:
-                    rule['parts'].append({
-                        'type': 'text',
-                        'text': rule_parts[i]
-                    })
-            else:
-                parsedtag = self._parse_tag_and_attributes(rule_parts[i])
-                rule['parts'].append(parsedtag)
-                if 'new' in parsedtag:
-                    rule['creates'].append(parsedtag)
+        Args:
+            symbol_ids: IDs of the only symbols whose depths may have
+                changed, see _relower(). Defaults to all the symbols.
+        """
+        import heapq
+
+        num_symbols = len(self._symbol_names)
+        if symbol_ids is None:
+            symbol_ids = range(num_symbols)
+            min_depths = [_UNBOUNDED_DEPTH] * num_symbols
+            max_depths = [0] * num_symbols
+            final = None
+        else:
+            # The depths of the other symbols are final already. Symbols
+            # that got IDs since are undefined, unless they are given.
+            min_depths = self._lowered_min_depths
+            max_depths = self._lowered_max_depths
+            num_new = num_symbols - len(min_depths)
+            min_depths.extend([_UNBOUNDED_DEPTH] * num_new)
+            max_depths.extend([_UNBOUNDED_DEPTH] * num_new)
+            final = [True] * num_symbols
+            for symbol_id in symbol_ids:
+                final[symbol_id] = False
+                min_depths[symbol_id] = _UNBOUNDED_DEPTH
+                max_depths[symbol_id] = 0
+
+        # Knuth's generalization of Dijkstra's algorithm: symbols are
+        # finalized in order of increasing depth and a rule is complete
+        # once all the symbols it references are finalized. By then, the
+        # depth of the rule is known as well.
+        users = [[] for _ in range(num_symbols)]
+        productions = []
+        heap = []
+        for symbol_id in symbol_ids:
+            creators = self._lowered_creators[symbol_id]
+            if creators is None:
+                max_depths[symbol_id] = _UNBOUNDED_DEPTH
+                continue
+            # Rules without symbols are complete from the start, only the
+            # shallowest one needs to be queued.
+            complete_depth = None
+            for _, ops in creators:
+                depth = 1
+                children = {}
+                for opcode, arg, _ in ops:
+                    if opcode == _OP_SYMBOL:
+                        children[arg] = 1
+                    elif opcode == _OP_INLINED_TEXT:
+                        depth = max(depth, arg[1] + 1)
+                    elif opcode == _OP_INLINED_SYMBOL:
+                        children[arg[0]] = max(children.get(arg[0], 0),
+                                               arg[1] + 1)
+                if final is not None:
+                    for child in [child for child in children
+                                  if final[child]]:
+                        depth = max(depth,
+                                    min_depths[child] + children.pop(child))
+                    if depth >= _UNBOUNDED_DEPTH:
+                        # The rule references a symbol that can't be
+                        # fully expanded.
+                        max_depths[symbol_id] = _UNBOUNDED_DEPTH
+                        continue
+                if children:
+                    production = [symbol_id, len(children), depth]
+                    productions.append(production)
+                    for child, levels in children.items():
+                        users[child].append((production, levels))
+                    continue
+                if complete_depth is None or depth < complete_depth:
+                    complete_depth = depth
+                max_depths[symbol_id] = max(max_depths[symbol_id], depth)
+            if complete_depth is not None:
+                heap.append((complete_depth, symbol_id))
+        heapq.heapify(heap)
+
+        while heap:
+            depth, symbol_id = heapq.heappop(heap)
+            if min_depths[symbol_id] != _UNBOUNDED_DEPTH:
+                continue
+            min_depths[symbol_id] = depth
+            for production, levels in users[symbol_id]:
+                production[1] -= 1
+                production[2] = max(production[2], depth + levels)
+                if (production[1] == 0 and
+                        min_depths[production[0]] == _UNBOUNDED_DEPTH):
+                    heapq.heappush(heap, (production[2], production[0]))
+
+        # Rules that reference a symbol which can't be fully expanded are
+        # never complete.
+        for symbol_id, pending, depth in productions:
+            if pending:
+                depth = _UNBOUNDED_DEPTH
+            if depth > max_depths[symbol_id]:
+                max_depths[symbol_id] = min(depth, _UNBOUNDED_DEPTH)
+
+        self._lowered_min_depths = min_depths
+        self._lowered_max_depths = max_depths
+        self._restricted_creators = {}
+
+    def _lower_pools(self, symbol_ids=None):
+        """Enumerates the outputs of symbols that can only expand to text.
+
+        A symbol is finite if its rules consist of text and of finite
+        symbols only, with no code rules, nonrecursive rules, id and
+        beforeoutput attributes or cached symbols involved. Such a symbol
+        is generated by sampling its pool of outputs (every combination of
+        rule and outputs of the symbols it references) with their exact
+        probabilities, instead of expanding it, see _sample_pool().
+        Symbols with more than _MAX_POOL_SIZE outputs are not pooled.
+
+        Pools of symbols whose rules are all plain text list the rules in
+        order with the alias table of the symbol, so they draw the same
+        random numbers as expanding them.
 
-        for tag in rule['creates']:
-            tag_name = tag['tagname']
-            if tag_name in _NONINTERESTING_TYPES:
+        Args:
+            symbol_ids: IDs of the only symbols whose pools may have
+                changed, see _relower(). Defaults to all the symbols.
+        """
+        num_symbols = len(self._symbol_names)
+        if symbol_ids is None:
+            symbol_ids = range(num_symbols)
+            candidates = None
+            self._lowered_pools = [None] * num_symbols
+            self._lowered_pool_alias_tables = [None] * num_symbols
+            self._lowered_pool_depths = [0] * num_symbols
+            self._lowered_pool_symbols = [None] * num_symbols
+        else:
+            num_new = num_symbols - len(self._lowered_pools)
+            self._lowered_pools.extend([None] * num_new)
+            self._lowered_pool_alias_tables.extend([None] * num_new)
+            self._lowered_pool_depths.extend([0] * num_new)
+            self._lowered_pool_symbols.extend([None] * num_new)
+            # Only the probabilities of the outputs of the pools are
+            # missing, so the pools that the given symbols use are
+            # enumerated again as well.
+            symbol_ids = self._pooled_descendants(symbol_ids)
+            candidates = [False] * num_symbols
+            for symbol_id in symbol_ids:
+                candidates[symbol_id] = True
+        # (outputs, probabilities, depth, reusable descendants)
+        pools = [None] * num_symbols
+        users = [[] for _ in range(num_symbols)]
+        pending = [0] * num_symbols
+        ready = []
+        text_only = set()
+        for symbol_id in symbol_ids:
+            creators = self._lowered_creators[symbol_id]
+            if (creators is None or symbol_id == self._line_id or
+                    self._lowered_nonrecursive[symbol_id] is not None or
+                    self._symbol_names[symbol_id] in self._cache_settings):
                 continue
-            if tag_name in self._creators:
-                self._creators[tag_name].append(rule)
+            children = self._pool_children(creators)
+            if children is None or symbol_id in children:
+                continue
+            if candidates is not None and not all(
+                    candidates[child] for child in children):
+                # The other symbols don't have pools.
+                continue
+            for child in children:
+                users[child].append(symbol_id)
+            pending[symbol_id] = len(children)
+            if not children:
+                ready.append(symbol_id)
+                text_only.add(symbol_id)
+
+        # Symbols are enumerated once all the symbols they reference are;
+        # the ones in cycles or referencing other symbols never are.
+        while ready:
+            symbol_id = ready.pop()
+            pool = self._enumerate_pool(symbol_id, pools)
+            if pool is None:
+                continue
+            pools[symbol_id] = pool
+            for user in users[symbol_id]:
+                pending[user] -= 1
+                if pending[user] == 0:
+                    ready.append(user)
+
+        for symbol_id in symbol_ids:
+            pool = pools[symbol_id]
+            if pool is None:
+                self._lowered_pools[symbol_id] = None
+                self._lowered_pool_alias_tables[symbol_id] = None
+                self._lowered_pool_depths[symbol_id] = 0
+                self._lowered_pool_symbols[symbol_id] = None
+                continue
+            outputs, probabilities, depth, symbols = pool
+            if symbol_id in text_only:
+                # One output per rule, in order.
+                alias_table = self._lowered_alias_tables[symbol_id]
+            elif all(p == probabilities[0] for p in probabilities):
+                alias_table = None
             else:
-                self._creators[tag_name] = [rule]
-            if 'nonrecursive' in tag:
-                if tag_name in self._nonrecursive_creators:
-                    self._nonrecursive_creators[tag_name].append(rule)
-                else:
-                    self._nonrecursive_creators[tag_name] = [rule]
+                alias_table = _alias_table(probabilities)
+            self._lowered_pools[symbol_id] = tuple(outputs)
+            self._lowered_pool_alias_tables[symbol_id] = alias_table
+            self._lowered_pool_depths[symbol_id] = depth
+            self._lowered_pool_symbols[symbol_id] = (
+                frozenset(symbols) if symbols else None)
 
-        if not helper_lines:
-            if 'line' in self._creators:
-                self._creators['line'].append(rule)
-            else:
-                self._creators['line'] = [rule]
+    def _pooled_descendants(self, symbol_ids):
+        """Adds the pooled symbols that the given symbols depend on.
 
-        self._all_rules.append(rule)
+        Returns:
+            A list of the given symbol IDs and the IDs of the symbols with
+            pools that they reference, directly or through other pooled
+            symbols.
+        """
+        found = set(symbol_ids)
+        pending = list(found)
+        while pending:
+            symbol_id = pending.pop()
+            for _, ops in self._lowered_creators[symbol_id] or ():
+                for opcode, arg, _ in ops:
+                    if opcode == _OP_SYMBOL:
+                        child = arg
+                    elif opcode == _OP_INLINED_SYMBOL:
+                        child = arg[0]
+                    else:
+                        continue
+                    if (child not in found and
+                            self._lowered_pools[child] is not None):
+                        found.add(child)
+                        pending.append(child)
+        return sorted(found)
 
-    def _parse_grammar_line(self, line):
-        """Parses a grammar rule."""
-        # Check if the line matches grammar rule pattern (<tagname> = ...).
-        match = re.match(r'^<([^>]*)>\s*=\s*(.*)$', line)
-        if not match:
-            raise GrammarError('Error parsing rule ' + line)
+    def _pool_children(self, creators):
+        """Returns the symbols referenced by creators of a finite symbol.
 
-        # Parse the line to create a grammar rule.
-        rule = {
-            'type': 'grammar',
-            'creates': self._parse_tag_and_attributes(match.group(1)),
-            'parts': []
-        }
-        rule_parts = re.split(r'<([^>)]*)>', match.group(2))
-        rule['recursive'] = False
-        # Splits the line into constant parts and tags. For example
+        Returns:
+            A set of symbol IDs, or None if the rules can't be pooled.
+        """
+        children = set()
+        for is_code, ops in creators:
+            if is_code:
+                return None
+            for opcode, arg, tag in ops:
+                if _is_decorated(tag):
+                    return None
+                if opcode == _OP_SYMBOL:
+                    children.add(arg)
+                elif opcode == _OP_INLINED_SYMBOL:
+                    children.add(arg[0])
+                elif opcode != _OP_TEXT and opcode != _OP_INLINED_TEXT:
+                    return None
+        return children
+
+    def _enumerate_pool(self, symbol_id, pools):
+        """Returns the pool of a finite symbol, see _lower_pools().
+
+        Returns:
+            An (outputs, probabilities, depth, reusable descendants)
+            tuple, where depth is the recursion depth needed to expand
+            the symbol in any way, or None if it has too many outputs.
+        """
+        creators = self._lowered_creators[symbol_id]
+        cdf = self._lowered_cdfs[symbol_id]
+        if cdf:
+            creator_probabilities = _cdf_probabilities(cdf)
+        else:
+            creator_probabilities = [1.0 / len(creators)] * len(creators)
+        outputs = []
+        probabilities = []
+        depth = 1
+        symbols = set()
+        for (_, ops), probability in zip(creators, creator_probabilities):
+            rule_outputs = ['']
+            rule_probabilities = [probability]
+            for opcode, arg, _ in ops:
+                if opcode == _OP_TEXT:
+                    rule_outputs = [output + arg for output in rule_outputs]
+                    continue
+                if opcode == _OP_INLINED_TEXT:
+                    text, levels, _ = arg
+                    depth = max(depth, levels + 1)
+                    rule_outputs = [output + text for output in rule_outputs]
+                    continue
+                if opcode == _OP_SYMBOL:
+                    child_id, levels = arg, 0
+                else:
+                    child_id, levels = arg
+                (child_outputs, child_probabilities, child_depth,
+                 child_symbols) = pools[child_id]
+                depth = max(depth, child_depth + levels + 1)
+                symbols.update(child_symbols)
+                if self._reusable_symbols[child_id]:
+                    symbols.add(self._symbol_names[child_id])
+                if (len(rule_outputs) * len(child_outputs) + len(outputs) >
+                        _MAX_POOL_SIZE):
+                    return None
+                rule_outputs = [
+                    output + child_output for output in rule_outputs
+                    for child_output in child_outputs]
+                rule_probabilities = [
+                    p * child_p for p in rule_probabilities
+                    for child_p in child_probabilities]
+            outputs.extend(rule_outputs)
+            probabilities.extend(rule_probabilities)
+            if len(outputs) > _MAX_POOL_SIZE:
+                return None
+        return outputs, probabilities, depth, symbols
+
+    def _sample_pool(self, symbol_id, recursion_depth, context):
+        """Generates a finite symbol from its pool, see _lower_pools().
+
+        The pool is only used where expanding the symbol could not be
+        affected by the recursion limit or by variables of the types it
+        references, so it produces the same distribution.
+
+        Returns:
+            The generated string, or None if the symbol needs to be
+            expanded.
+        """
+        if (recursion_depth + self._lowered_pool_depths[symbol_id] >
+                self._recursion_max):
+            return None
+        symbols = self._lowered_pool_symbols[symbol_id]
+        if (symbols is not None and
+                not context['variables'].keys().isdisjoint(symbols)):
+            return None
+        pool = self._lowered_pools[symbol_id]
+        alias_table = self._lowered_pool_alias_tables[symbol_id]
+        if alias_table is None:
+            return pool[random.randint(0, len(pool) - 1)]
+        return pool[_alias_index(alias_table)]
+
+    def optimize(self):
+        """Enables optimizations of the grammar used for generation.
+
+        The lowered rules are rewritten so that fewer symbols need to be
+        expanded per sample:
+            - adjacent constant parts are folded into a single string,
+            - symbols with a single rule that consists of just text or
+              just another symbol are inlined into the rules using them,
+            - identical rules of the same symbol are merged into a single
+              rule with their combined probability.
+
+        The distribution of the generated samples stays the same (inlined
+        symbols still count towards the recursion depth), but the samples
+        generated with a given random seed change.
+        Symbols that can be variable types (created with 'new', named in
+        !extends, Document and Window) are never inlined, so variables of
+        other types must not be added by user-defined functions or as
+        initial variables of _generate_code().
+
+        The optimizations are applied again whenever the grammar is
+        finalized or refreshed. _creators and the CDFs are not changed.
+        """
+        self._optimized = True
+        if self._symbol_names:
+            self._lower()
+
+    def use_explicit_stack(self, enabled=True):
+        """Selects the engine that expands rules during generation.
+
+        By default symbols are expanded by recursive method calls, which
+        limits how deep the expansion can go to what fits into Python's
+        stack. The explicit-stack engine keeps the partially expanded rules
+        in a list instead, so the depth is only limited by !max_recursion.
+        Both engines consume the random number generator in the same way and
+        generate the same samples for a given seed.
+
+        The explicit-stack engine is always used for grammars that set
+        !max_recursion above 250 (_MAX_RECURSIVE_DEPTH).
+
+        Args:
+            enabled: Whether to use the explicit-stack engine.
+        """
+        self._explicit_stack = enabled
+
+    def use_random_pools(self, enabled=True, batch_size=4096):
+        """Draws the values of built-in types from NumPy random pools.
+
+        Integers, floats, characters, strings and hex digits are then
+        generated from batches of random values drawn with NumPy (see
+        random_pools.py) instead of one call into the random module per
+        value, or per character for strings. The values follow the same
+        distributions, but the generated samples change. The pools are
+        seeded from the random module when they are enabled, so samples
+        are reproducible if it was seeded before. Rule selection still
+        uses the random module. The pools are not kept when the grammar
+        is pickled and are not used by compiled grammar modules.
+
+        Args:
+            enabled: Whether to use random pools.
+            batch_size: Largest number of values drawn at once for a
+                single range.
+
+        Raises:
+            GrammarError: If NumPy is not installed.
+        """
+        if not enabled:
+            self._random_pools = None
+            return
+        try:
+            from random_pools import RandomPools
+        except ImportError:
+            raise GrammarError('Random pools need NumPy, which is not '
+                               'installed')
+        self._random_pools = RandomPools(random.getrandbits(64), batch_size)
+
+    def cache_symbol(self, symbol, size=64, refresh_prob=0.1):
+        """Caches recent expansions of a symbol.
+
+        Once the cache of the symbol holds size expansions, generating the
+        symbol returns one of them, picked at random, and only generates
+        a fresh expansion (replacing the least recently used one) with
+        probability refresh_prob. This trades output diversity for speed
+        on expensive symbols, such as the ones used from other grammars
+        with <import>. The same can be declared in grammar files with
+        !cache <symbol> <size> [<refresh probability>]. Cached expansions
+        are only returned where they fit into the remaining recursion
+        depth, and the ones added by lines of code that fail are removed
+        again.
+
+        Only symbols whose expansion neither depends on nor changes the
+        context can be cached: no code rules, user-defined functions,
+        new variables or symbols that can be variable types may be used
+        to expand them.
+
+        Args:
+            symbol: Name of the symbol.
+            size: Number of expansions kept, 0 to stop caching the symbol.
+            refresh_prob: Probability of generating a fresh expansion
+                when the cache is full.
+
+        Grammars loaded with load_image() keep the caches declared when
+        the image was saved.
+
+        Raises:
+            GrammarError: If the arguments are invalid or the symbol can't
+                be cached.
+        """
+        if isinstance(self._lowered_creators, _ImageTable):
+            raise GrammarError('Can\'t change the caches of a grammar image')
+        if self._symbol_names and size:
+            error = self._cache_error(symbol, self._variable_types())
+            if error:
+                raise GrammarError(error)
+        self._cache_symbol(symbol, size, refresh_prob)
+        if self._symbol_names:
+            # Pooling and inlining depend on which symbols are cached.
+            self._lower()
+
+    def cache_stats(self):
+        """Returns statistics of the expansion caches.
+
+        Returns:
+            A dictionary that maps cached symbols to dictionaries with:
+                'lookups': Number of times the symbol was generated.
+                'hits': Number of cached expansions returned.
+                'hit_rate': hits / lookups.
+                'fresh': Number of expansions generated, which bounds the
+                    number of distinct expansions returned.
+                'distinct_rate': fresh / lookups, the share of returned
+                    expansions that were not repeated.
+                'max_reuse': Largest number of times a single expansion
+                    was returned.
+        """
+        stats = {}
+        for symbol_id, cache in enumerate(self._lowered_caches):
+            if cache is not None:
+                stats[self._symbol_names[symbol_id]] = cache.stats()
+        return stats
+
+    def _lower_caches(self):
+        """Creates empty expansion caches for the cached symbols.
+
+        Symbols declared with !cache that can't be cached are dropped with
+        a warning.
+        """
+        if self._cache_settings:
+            variable_types = self._variable_types()
+        for symbol in sorted(self._cache_settings):
+            error = self._cache_error(symbol, variable_types)
+            if error:
+                print('Warning: ' + error)
+                del self._cache_settings[symbol]
+        self._create_caches()
+
+    def _create_caches(self):
+        self._lowered_caches = [None] * len(self._symbol_names)
+        for symbol, (size, refresh_prob) in self._cache_settings.items():
+            self._lowered_caches[self._symbol_ids[symbol]] = _ExpansionCache(
+                size, refresh_prob)
+
+    def _cache_error(self, symbol, variable_types):
+        """Returns why a symbol can't be cached, or None if it can."""
+        symbol_id = self._symbol_ids.get(symbol)
+        if symbol_id is None or self._lowered_creators[symbol_id] is None:
+            return 'Can\'t cache undefined symbol ' + symbol
+        if not self._is_context_free(symbol_id, variable_types):
+            return ('Can\'t cache symbol %s, its expansion depends on the '
+                    'context' % symbol)
+        return None
+
+    def _is_context_free(self, symbol_id, variable_types):
+        """Checks if expanding a symbol can't use or change the context."""
+        seen = set([symbol_id])
+        pending = [symbol_id]
+        while pending:
+            current = pending.pop()
+            if (current == self._line_id or
+                    self._symbol_names[current] in variable_types):
+                return False
+            for is_code, ops in self._lowered_creators[current] or ():
+                if is_code:
+                    return False
+                for opcode, arg, tag in ops:
+                    if opcode == _OP_NEW or opcode == _OP_CALL:
+                        return False
+                    if tag is not None and 'beforeoutput' in tag:
+                        return False
+                    if opcode == _OP_SYMBOL:
+                        child = arg
+                    elif opcode == _OP_INLINED_SYMBOL:
+                        child = arg[0]
+                    else:
+                        continue
+                    if child not in seen:
+                        seen.add(child)
+                        pending.append(child)
+        return True
+
+    def _optimize_lowered(self):
+        """Runs the optimizations described in optimize()."""
+        self._map_lowered_rules(self._fold_constants)
+        variable_types = self._variable_types()
+        while self._inline_symbols(variable_types):
+            self._map_lowered_rules(self._fold_constants)
+        self._merge_duplicate_rules()
+
+    def _map_lowered_rules(self, function):
+        """Replaces every lowered rule r with function(r).
+
+        Returns:
+            Whether any rule was changed.
+        """
+        mapped = {}
+        changed = False
+        for creators_lists in (self._lowered_creators,
+                               self._lowered_nonrecursive):
+            for creators in creators_lists:
+                if creators is None:
+                    continue
+                for i, rule in enumerate(creators):
+                    new_rule = mapped.get(id(rule))
+                    if new_rule is None:
+                        new_rule = function(rule)
+                        mapped[id(rule)] = new_rule
+                    if new_rule is not rule:
+                        creators[i] = new_rule
+                        changed = True
+        return changed
+
+    def _fold_constants(self, rule):
+        """Merges adjacent text operations of a lowered rule."""
+        is_code, ops = rule
+        folded = []
+        for op in ops:
+            if op[0] == _OP_TEXT and folded and folded[-1][0] == _OP_TEXT:
+                folded[-1] = (_OP_TEXT, folded[-1][1] + op[1], None)
+            else:
+                folded.append(op)
+        if len(folded) == len(ops):
+            return rule
+        return (is_code, tuple(folded))
+
+    def _variable_types(self):
+        """Returns the symbols that variables can have as their type."""
+        variable_types = set(['Document', 'Window'])
+        for rule in self._all_rules:
+            if rule.type == 'code':
+                variable_types.update(tag['tagname'] for tag in rule.creates
+                                      if 'new' in tag)
+        for objectname, parents in self._inheritance.items():
+            variable_types.add(objectname)
+            variable_types.update(parents)
+        return variable_types
+
+    def _inline_symbols(self, variable_types):
+        """Inlines symbols whose only rule is a single text or symbol.
+
+        References to such a symbol are replaced with _OP_INLINED_TEXT or
+        _OP_INLINED_SYMBOL operations that remember how many levels of
+        recursion were skipped, so the recursion limit applies as before.
+        Chains of symbols are inlined one level per call.
+
+        Returns:
+            Whether any rule was changed.
+        """
+        inline = {}
+        for symbol_id, creators in enumerate(self._lowered_creators):
+            if (creators is None or len(creators) != 1 or
+                    symbol_id == self._line_id or
+                    self._symbol_names[symbol_id] in variable_types or
+                    self._symbol_names[symbol_id] in self._cache_settings):
+                continue
+            is_code, ops = creators[0]
+            if is_code or len(ops) != 1:
+                continue
+            opcode, arg, tag = ops[0]
+            if opcode == _OP_TEXT:
+                inline[symbol_id] = (_OP_INLINED_TEXT, (arg, 1, symbol_id))
+            elif _is_decorated(tag):
+                continue
+            elif opcode == _OP_SYMBOL and arg != symbol_id:
+                inline[symbol_id] = (_OP_INLINED_SYMBOL, (arg, 1))
+            elif opcode == _OP_INLINED_TEXT:
+                text, levels, inlined_id = arg
+                inline[symbol_id] = (_OP_INLINED_TEXT,
+                                     (text, levels + 1, inlined_id))
+            elif opcode == _OP_INLINED_SYMBOL and arg[0] != symbol_id:
+                inline[symbol_id] = (_OP_INLINED_SYMBOL,
+                                     (arg[0], arg[1] + 1))
+        if not inline:
+            return False
+
+        def inline_rule(rule):
+            is_code, ops = rule
+            new_ops = []
+            for op in ops:
+                opcode, arg, tag = op
+                if opcode == _OP_SYMBOL and arg in inline:
+                    op = inline[arg] + (tag,)
+                elif opcode == _OP_INLINED_SYMBOL and arg[0] in inline:
+                    target_opcode, target_arg = inline[arg[0]]
+                    if target_opcode == _OP_INLINED_TEXT:
+                        target_arg = (target_arg[0],
+                                      target_arg[1] + arg[1],
+                                      target_arg[2])
+                    else:
+                        target_arg = (target_arg[0],
+                                      target_arg[1] + arg[1])
+                    op = (target_opcode, target_arg, tag)
+                new_ops.append(op)
+            if all(new is old for new, old in zip(new_ops, ops)):
+                return rule
+            return (is_code, tuple(new_ops))
+
+        return self._map_lowered_rules(inline_rule)
+
+    def _merge_duplicate_rules(self):
+        """Merges identical rules of a symbol, adding up probabilities."""
+        for creators_lists, cdfs in (
+                (self._lowered_creators, self._lowered_cdfs),
+                (self._lowered_nonrecursive,
+                 self._lowered_nonrecursive_cdfs)):
+            for symbol_id, creators in enumerate(creators_lists):
+                # Lines are selected by index, see _generate_code().
+                if creators is None or symbol_id == self._line_id:
+                    continue
+                cdf = cdfs[symbol_id]
+                if cdf:
+                    probabilities = _cdf_probabilities(cdf)
+                else:
+                    probabilities = [1.0 / len(creators)] * len(creators)
+                merged = {}
+                merged_creators = []
+                merged_probabilities = []
+                for rule, p in zip(creators, probabilities):
+                    # Tags are dictionaries, rules are compared by the
+                    # identity of their tags instead.
+                    key = (rule[0], tuple((opcode, arg, id(tag))
+                                          for opcode, arg, tag in rule[1]))
+                    index = merged.get(key)
+                    if index is None:
+                        merged[key] = len(merged_creators)
+                        merged_creators.append(rule)
+                        merged_probabilities.append(p)
+                    else:
+                        merged_probabilities[index] += p
+                if len(merged_creators) == len(creators):
+                    continue
+                creators_lists[symbol_id] = merged_creators
+                p_sum = 0
+                merged_cdf = []
+                for p in merged_probabilities:
+                    p_sum += p
+                    merged_cdf.append(p_sum)
+                cdfs[symbol_id] = merged_cdf
+
+    def _parse_tag_and_attributes(self, string):
+        """Extracts tag name and attributes from a string.
+
+        Tags are not modified once parsed, so identical tag strings of the
+        grammar share a single (interned) tag object. User-defined
+        functions get a copy of the tag.
+        """
+        tag = self._tag_cache.get(string)
+        if tag is not None:
+            return tag
+        parts = string.split()
+        if len(parts) < 1:
+            raise GrammarError('Empty tag encountered')
+        ret = {}
+        if len(parts) > 1 and parts[0] == 'new':
+            ret['tagname'] = sys.intern(parts[1])
+            ret['new'] = 'true'
+            attrstart = 2
+        else:
+            ret['tagname'] = sys.intern(parts[0])
+            attrstart = 1
+        for i in range(attrstart, len(parts)):
+            attrparts = parts[i].split('=')
+            if len(attrparts) == 2:
+                ret[sys.intern(attrparts[0])] = sys.intern(attrparts[1])
+            elif len(attrparts) == 1:
+                ret[sys.intern(attrparts[0])] = True
+            else:
+                raise GrammarError('Error parsing tag ' + string)
+        if 'new' not in ret and ret['tagname'] in self._built_in_types:
+            # Reports invalid attributes of built-in types while parsing,
+            # before the tag is cached.
+            self._specialize_built_in(ret)
+        self._tag_cache[string] = ret
+        return ret
+
+    def _parse_rule_parts(self, string):
+        """Splits the right-hand side of a rule into text parts and tags."""
+        # Splits the line into constant parts and tags. For example
         # "foo<bar>baz" would be split into three parts, "foo", "bar" and "baz"
         # Every other part is going to be constant and every other part
         # is going to be a tag, always starting with a constant. Empty
         # spaces between tags/beginning/end are not a problem because
         # then empty strings will be returned in corresponding places,
         # for example "<foo><bar>" gets split into "", "foo", "", "bar", ""
-        for i in range(0, len(rule_parts)):
-            if i % 2 == 0:
-                if rule_parts[i]:
-                    rule['parts'].append({
-                        'type': 'text',
-                        'text': rule_parts[i]
-                    })
-            else:
-                parsedtag = self._parse_tag_and_attributes(rule_parts[i])
-                rule['parts'].append(parsedtag)
-                if parsedtag['tagname'] == rule['creates']['tagname']:
-                    rule['recursive'] = True
-
-        # Store the rule in appropriate sets.
-        create_tag_name = rule['creates']['tagname']
-        if create_tag_name in self._creators:
-            self._creators[create_tag_name].append(rule)
-        else:
-            self._creators[create_tag_name] = [rule]
-        if 'nonrecursive' in rule['creates']:
-            if create_tag_name in self._nonrecursive_creators:
-                self._nonrecursive_creators[create_tag_name].append(rule)
-            else:
-                self._nonrecursive_creators[create_tag_name] = [rule]
+        rule_parts = _TAG_SPLIT_RE.split(string)
+        parts = []
+        tag_cache = self._tag_cache
+        for text, tag in zip(rule_parts[::2], rule_parts[1::2]):
+            if text:
+                parts.append(sys.intern(text))
+            parts.append(tag_cache.get(tag) or
+                         self._parse_tag_and_attributes(tag))
+        if rule_parts[-1]:
+            parts.append(sys.intern(rule_parts[-1]))
+        return tuple(parts)
+
+    def _parse_code_line(self, line, helper_lines=False):
+        """Parses a rule for generating code.
+
+        A <line> tag in the line is not expanded, its attributes (such as
+        p) apply to the line itself and it is stored with the tags of the
+        created variables.
+        """
+        parts = self._parse_rule_parts(line)
+        creates = tuple(part for part in parts
+                        if not isinstance(part, str) and
+                        ('new' in part or part['tagname'] == 'line'))
+        if any(tag['tagname'] == 'line' for tag in creates):
+            parts = [part for part in parts
+                     if isinstance(part, str) or part['tagname'] != 'line']
+        return _CodeRule(creates, parts, helper_lines)
+
+    def _parse_grammar_line(self, line):
+        """Parses a grammar rule."""
+        # Check if the line matches grammar rule pattern (<tagname> = ...).
+        match = _RULE_RE.match(line)
+        if not match:
+            raise GrammarError('Error parsing rule ' + line)
+
+        # Parse the line to create a grammar rule.
+        creates = self._parse_tag_and_attributes(match.group(1))
+        parts = self._parse_rule_parts(match.group(2))
+        create_tag_name = creates['tagname']
+        recursive = False
+        for part in parts:
+            if (not isinstance(part, str) and
+                    part['tagname'] == create_tag_name):
+                recursive = True
+                break
+        return _GrammarRule(creates, parts, recursive)
+
+    def _add_rule(self, rule):
+        """Stores a parsed rule in the appropriate sets."""
+        self._index_rule(rule)
         self._all_rules.append(rule)
-        if 'root' in rule['creates']:
-            self._root = create_tag_name
+        if rule.type == 'grammar' and 'root' in rule.creates:
+            self._root = rule.creates['tagname']
+
+    def _rule_symbols(self, rule):
+        """Returns the symbols that a rule can be used to create."""
+        if rule.type == 'grammar':
+            return [rule.creates['tagname']]
+        symbols = [tag['tagname'] for tag in rule.creates
+                   if 'new' in tag and
+                   tag['tagname'] not in _NONINTERESTING_TYPES]
+        if not rule.helper:
+            symbols.append('line')
+        return symbols
+
+    def _index_rule(self, rule, symbols=None):
+        """Adds a rule to the creators of symbols it creates.
 
-    def _remove_comments(self, line):
-        """Removes comments and trims the line."""
-        if '#' in line:
-            cleanline = line[:line.index('#')].strip()
+        Args:
+            rule: The rule to add.
+            symbols: If given, only creators of these symbols are updated.
+        """
+        if rule.type == 'grammar':
+            create_tags = [rule.creates]
         else:
-            cleanline = line.strip()
-        return cleanline
+            create_tags = [tag for tag in rule.creates
+                           if 'new' in tag and
+                           tag['tagname'] not in _NONINTERESTING_TYPES]
+        for tag in create_tags:
+            tag_name = tag['tagname']
+            if symbols is not None and tag_name not in symbols:
+                continue
+            if tag_name in self._creators:
+                self._creators[tag_name].append(rule)
+            else:
+                self._creators[tag_name] = [rule]
+            if 'nonrecursive' in tag:
+                if tag_name in self._nonrecursive_creators:
+                    self._nonrecursive_creators[tag_name].append(rule)
+                else:
+                    self._nonrecursive_creators[tag_name] = [rule]
+
+        if rule.type == 'code' and not rule.helper:
+            if symbols is not None and 'line' not in symbols:
+                return
+            if 'line' in self._creators:
+                self._creators['line'].append(rule)
+            else:
+                self._creators['line'] = [rule]
 
     def _fix_idents(self, source):
         """Fixes indentation in user-defined functions.
@@ -801,13 +2714,17 @@ class Grammar(object):
 
         return '\n'.join(output)
 
-    def _save_function(self, name, source):
+    def _compile_function(self, name, source):
         source = self._fix_idents(source)
         try:
             compiled_fn = compile(source, name, 'exec')
         except (SyntaxError, TypeError) as e:
             raise GrammarError('Error in user-defined function: %s' % str(e))
+        return source, compiled_fn
+
+    def _save_function(self, name, source, compiled_fn):
         self._functions[name] = compiled_fn
+        self._function_sources[name] = source
 
     def _set_variable_format(self, var_format):
         """Sets variable format for programming language generation."""
@@ -843,15 +2760,36 @@ class Grammar(object):
         # print(objectname, parentname)
         self._inheritance[objectname].append(parentname)
 
+    def _set_cache(self, p_str):
+        """Handles !cache <symbol> <size> [<refresh probability>]."""
+        args = p_str.split()
+        try:
+            if len(args) not in (2, 3):
+                raise ValueError()
+            size = int(args[1])
+            refresh_prob = float(args[2]) if len(args) == 3 else 0.1
+        except ValueError:
+            raise GrammarError('Arguments to cache are not a symbol, a size '
+                               'and an optional probability')
+        self._cache_symbol(args[0], size, refresh_prob)
+
+    def _cache_symbol(self, symbol, size, refresh_prob):
+        if size < 0 or not 0 <= refresh_prob <= 1:
+            raise GrammarError('Invalid cache size or refresh probability '
+                               'for ' + symbol)
+        if size:
+            self._cache_settings[symbol] = (size, refresh_prob)
+        else:
+            self._cache_settings.pop(symbol, None)
+
     def _import_grammar(self, filename):
         """Imports a grammar from another file."""
         basename = os.path.basename(filename)
         path = os.path.join(self._definitions_dir, filename)
-        subgrammar = Grammar()
-        num_errors = subgrammar.parse_from_file(path)
-        if num_errors:
-            raise GrammarError('There were errors when parsing ' + filename)
+        subgrammar = registry.get_grammar(path)
         self._imports[basename] = subgrammar
+        self._import_paths[basename] = path
+        self._source_files.extend(subgrammar._source_files)
 
     def add_import(self, name, grammar):
         """Adds a grammar that can then be used from <import> tags.
@@ -866,28 +2804,40 @@ class Grammar(object):
 
         self._imports[name] = grammar
 
-    def _include_from_string(self, grammar_str):
+    def _parse_fragment(self, grammar_str, path=None):
+        """Parses grammar rules and commands from string.
+
+        Parsing does not modify the grammar, the result is a fragment that
+        can be linked into this or any other grammar with _link_fragment().
+
+        Args:
+            grammar_str: String containing the grammar.
+            path: Canonical path of the file the string was read from.
+
+        Returns:
+            A _Fragment object.
+        """
+        fragment = _Fragment(path, _digest(grammar_str))
+        filename = path or '<string>'
         in_code = False
         helper_lines = False
-        in_function = False
-        num_errors = 0
-        lines = grammar_str.split('\n')
-        for line in lines:
-
-            if not in_function:
-                cleanline = self._remove_comments(line)
-                if not cleanline:
-                    continue
-            else:
-                cleanline = line
-
-            # Process special commands
-            match = re.match(r'^!([a-z_]+)\s*(.*)$', cleanline)
-            if match:
-                command = match.group(1)
-                params = match.group(2)
+        entries = fragment.entries
+        for kind, lineno, value, line in _tokenize(grammar_str):
+            if kind == _TOKEN_RULE:
+                try:
+                    if in_code:
+                        entries.append(
+                            self._parse_code_line(value, helper_lines))
+                    else:
+                        entries.append(self._parse_grammar_line(value))
+                except GrammarError as e:
+                    print('Error parsing line %s (%s:%d: %s)' %
+                          (line, filename, lineno, e))
+                    fragment.num_errors += 1
+            elif kind == _TOKEN_COMMAND:
+                command, params = value
                 if command in self._command_handlers:
-                    self._command_handlers[command](params)
+                    entries.append((_COMMAND, command, params))
                 elif command == 'begin' and params == 'lines':
                     in_code = True
                     helper_lines = False
@@ -897,48 +2847,466 @@ class Grammar(object):
                 elif command == 'end' and params in ('lines', 'helperlines'):
                     if in_code:
                         in_code = False
-                elif command == 'begin' and params.startswith('function'):
-                    match = re.match(r'^function\s*([a-zA-Z._0-9]+)$', params)
-                    if match and not in_function:
-                        function_name = match.group(1)
-                        function_body = ''
-                        in_function = True
-                    else:
-                        print('Error parsing line ' + line)
-                        num_errors += 1
                 elif command == 'end' and params == 'function':
-                    if in_function:
-                        in_function = False
-                        self._save_function(function_name, function_body)
+                    pass
                 else:
-                    print('Unknown command: ' + command)
-                    num_errors += 1
+                    print('Unknown command: %s (%s:%d)' %
+                          (command, filename, lineno))
+                    fragment.num_errors += 1
+            elif kind == _TOKEN_FUNCTION:
+                function_name, function_body = value
+                source, compiled_fn = self._compile_function(
+                    function_name, function_body)
+                entries.append((_FUNCTION, function_name, source, compiled_fn))
+            else:
+                print('Error parsing line %s (%s:%d)' %
+                      (line, filename, lineno))
+                fragment.num_errors += 1
+
+        return fragment
+
+    def _link_fragment(self, fragment):
+        """Adds rules and executes commands from a parsed fragment.
+
+        Rules are also recorded in segments, runs of rules from a single
+        fragment that are delimited by commands. Since !include is a
+        command, concatenating all segments gives every rule of the
+        grammar in link order, which is what refresh() relies on.
+        """
+        if fragment.path:
+            self._source_files.append((fragment.path, fragment.digest))
+        segment = _Segment(fragment)
+        self._segments.append(segment)
+        for entry in fragment.entries:
+            if not isinstance(entry, tuple):
+                segment.rules.append(entry)
+                self._add_rule(entry)
+            elif entry[0] == _COMMAND:
+                self._command_handlers[entry[1]](entry[2])
+                segment = _Segment(fragment)
+                self._segments.append(segment)
+            else:
+                self._save_function(entry[1], entry[2], entry[3])
+        return fragment.num_errors
+
+    def _is_symbol_part(self, part):
+        """Checks if a rule part is expanded by generating a symbol."""
+        if isinstance(part, str) or 'new' in part:
+            return False
+        tagname = part['tagname']
+        return (tagname not in self._constant_types and
+                tagname not in self._built_in_types and
+                tagname != 'call')
+
+    def _compute_min_depths(self):
+        """Returns the minimum derivation depth of every symbol.
+
+        The depth of a rule without symbols on the right-hand side is 1,
+        otherwise it is 1 more than the largest depth of its symbols. The
+        depth of a symbol is the smallest depth of its creators, so a
+        symbol can be generated at recursion depth d only if d plus its
+        minimum depth does not exceed the maximum recursion depth.
+        Existing variables that could be reused are not taken into
+        account. The depths are the ones computed by _lower_depths().
+
+        Returns:
+            A dictionary mapping symbols to their minimum depth. Symbols
+            that can never be fully expanded are not included.
+        """
+        return dict(
+            (symbol, depth) for symbol, depth
+            in zip(self._symbol_names, self._lowered_min_depths)
+            if depth != _UNBOUNDED_DEPTH)
+
+    def _reachable_symbols(self, start_symbols):
+        """Computes the symbols needed to generate the start symbols.
+
+        Follows tags on the right-hand side of rules, the 'line' symbol for
+        <lines> tags and !extends inheritance of variable types.
+
+        Returns:
+            A tuple of the set of reachable symbols and a dictionary that
+            maps import names to sets of symbols needed from the imported
+            grammars (None stands for the root symbol).
+        """
+        reachable = set()
+        imports = {}
+        pending = list(start_symbols)
+        while pending:
+            symbol = pending.pop()
+            if symbol in reachable:
                 continue
+            reachable.add(symbol)
+            pending.extend(self._inheritance.get(symbol, []))
+            for rule in self._creators.get(symbol, []):
+                for part in rule.parts:
+                    if isinstance(part, str):
+                        continue
+                    tagname = part['tagname']
+                    if 'new' in part:
+                        pending.append(tagname)
+                    elif tagname == 'import':
+                        if 'from' in part:
+                            imports.setdefault(part['from'], set()).add(
+                                part.get('symbol'))
+                    elif tagname == 'lines':
+                        pending.append('line')
+                    elif (tagname not in self._constant_types and
+                          tagname not in self._built_in_types and
+                          tagname != 'call'):
+                        pending.append(tagname)
+        return reachable, imports
+
+    def extract(self, start_symbols=None):
+        """Creates a grammar with only the rules needed for given symbols.
+
+        Symbols are followed through <import> tags (the imported grammars
+        are pruned as well) and !extends inheritance. The returned grammar
+        shares rule objects with this one and is already finalized.
 
-            try:
-                if in_function:
-                    function_body += cleanline + '\n'
-                elif in_code:
-                    self._parse_code_line(cleanline, helper_lines)
-                else:
-                    self._parse_grammar_line(cleanline)
-            except GrammarError:
-                print('Error parsing line ' + line)
-                num_errors += 1
+        Args:
+            start_symbols: list of symbols that need to be generated.
+                Defaults to the root symbol.
 
-        return num_errors
+        Returns:
+            A new Grammar object.
+        """
+        if not start_symbols:
+            start_symbols = [self._root]
+        reachable, imports = self._reachable_symbols(start_symbols)
+
+        pruned = Grammar()
+        for attr in ('_var_format', '_definitions_dir', '_line_guard',
+                     '_recursion_max', '_var_reuse_prob',
+                     '_interesting_line_prob', '_max_vars_of_same_type'):
+            setattr(pruned, attr, getattr(self, attr))
+        pruned._functions = dict(self._functions)
+        pruned._function_sources = dict(self._function_sources)
+        pruned._source_files = list(self._source_files)
+        for objectname, parents in self._inheritance.items():
+            if objectname in reachable:
+                pruned._inheritance[objectname] = list(parents)
+        for symbol, settings in self._cache_settings.items():
+            if symbol in reachable:
+                pruned._cache_settings[symbol] = settings
+
+        for rule in self._all_rules:
+            if rule.type == 'grammar':
+                if rule.creates['tagname'] in reachable:
+                    pruned._add_rule(rule)
+                continue
+            if ((not rule.helper and 'line' in reachable) or
+                    any(tag['tagname'] in reachable
+                        for tag in rule.creates)):
+                pruned._add_rule(rule)
+        if self._root in reachable:
+            pruned._root = self._root
+        else:
+            pruned._root = start_symbols[0]
+
+        for name, symbols in imports.items():
+            if name not in self._imports:
+                continue
+            subgrammar = self._imports[name]
+            symbols = [subgrammar._root if symbol is None else symbol
+                       for symbol in symbols]
+            pruned._imports[name] = subgrammar.extract(symbols)
+            if name in self._import_paths:
+                pruned._import_paths[name] = self._import_paths[name]
+
+        pruned.finalize()
+        return pruned
+
+    def _tag_to_string(self, tag):
+        items = []
+        if 'new' in tag:
+            items.append('new')
+        items.append(tag['tagname'])
+        for key, value in tag.items():
+            if key in ('tagname', 'new'):
+                continue
+            if value is True:
+                items.append(key)
+            else:
+                items.append(key + '=' + value)
+        return '<' + ' '.join(items) + '>'
+
+    def _rule_to_string(self, rule):
+        parts = []
+        for part in rule.parts:
+            if isinstance(part, str):
+                parts.append(part)
+            else:
+                parts.append(self._tag_to_string(part))
+        if rule.type == 'grammar':
+            return self._tag_to_string(rule.creates) + ' = ' + ''.join(parts)
+        for tag in rule.creates:
+            if tag['tagname'] == 'line':
+                parts.insert(0, self._tag_to_string(tag))
+        return ''.join(parts)
+
+    def to_string(self):
+        """Returns the grammar source that produces this grammar.
+
+        Imported grammars are referenced with !import commands using the
+        import name as the file name, so they need to be written to files
+        with those names next to the output.
+        """
+        out = []
+        if self._var_format != 'var%05d':
+            out.append('!varformat ' + self._var_format)
+        if self._line_guard:
+            out.append('!lineguard ' + self._line_guard)
+        out.append('!max_recursion %d' % self._recursion_max)
+        out.append('!var_reuse_prob %s' % repr(self._var_reuse_prob))
+        for name in sorted(self._imports):
+            out.append('!import ' + name)
+        for objectname, parents in sorted(self._inheritance.items()):
+            for parentname in parents:
+                out.append('!extends %s %s' % (objectname, parentname))
+        for symbol, (size, refresh_prob) in sorted(
+                self._cache_settings.items()):
+            out.append('!cache %s %d %r' % (symbol, size, refresh_prob))
+        for name, source in sorted(self._function_sources.items()):
+            out.append('!begin function ' + name)
+            out.append(source.rstrip('\n'))
+            out.append('!end function')
+
+        block = None
+        for rule in self._all_rules:
+            if rule.type == 'grammar':
+                rule_block = None
+            elif not rule.helper:
+                rule_block = 'lines'
+            else:
+                rule_block = 'helperlines'
+            if rule_block != block:
+                if block:
+                    out.append('!end ' + block)
+                if rule_block:
+                    out.append('!begin ' + rule_block)
+                block = rule_block
+            out.append(self._rule_to_string(rule))
+        if block:
+            out.append('!end ' + block)
+        return '\n'.join(out) + '\n'
+
+    def _include_from_string(self, grammar_str):
+        return self._link_fragment(self._parse_fragment(grammar_str))
 
     def _include_from_file(self, filename):
         try:
-            f = open(os.path.join(self._definitions_dir,
-                filename
-            ))
-            content = f.read()
-            f.close()
+            fragment = registry.get_fragment(
+                os.path.join(self._definitions_dir, filename),
+                self
+            )
         except IOError:
             print('Error reading ' + filename)
             return 1
-        return self.parse_from_string(content)
+        return self._link_fragment(fragment)
+
+    def include_from_string(self, grammar_str):
+        """Parses grammar rules from string and adds them to the grammar.
+
+        Unlike parse_from_string(), this only adds rules (like the !include
+        command does) and doesn't prepare the grammar for generation, so
+        it can be called several times to combine grammar sources cheaply.
+        Call finalize() once all the rules are added.
+
+        Args:
+            grammar_str: String containing the grammar.
+
+        Returns:
+            Number of errors encountered during the parsing.
+        """
+        return self._include_from_string(grammar_str)
+
+    def include_from_file(self, filename):
+        """Parses grammar from file and adds its rules to the grammar.
+
+        Like include_from_string(), this does not finalize the grammar.
+        Files included from the grammar file are looked up relative to
+        the directory of this file.
+
+        Args:
+            filename: path to the file with grammar rules.
+
+        Returns:
+            Number of errors encountered during the parsing.
+        """
+        try:
+            fragment = registry.get_fragment(filename, self)
+        except IOError:
+            print('Error reading ' + filename)
+            return 1
+        self._definitions_dir = os.path.dirname(filename)
+        self._root_files.append(filename)
+        return self._link_fragment(fragment)
+
+    def finalize(self):
+        """Prepares the grammar for generation.
+
+        Computes creator probabilities and interesting line indices from
+        all the rules added so far and lowers the rules for generation.
+        This is done once, after all the included files have been linked.
+        """
+        self._normalize_probabilities()
+        self._compute_interesting_indices()
+        _without_gc(self._lower)
+
+    def refresh(self):
+        """Updates the grammar after some of its source files changed.
+
+        Only the files that were modified since they were last loaded are
+        parsed again. If their commands (such as !include or !extends) did
+        not change, their rules are spliced into the grammar in place,
+        only the probabilities of the affected symbols are recomputed and
+        only the symbols whose rules were edited are lowered again (see
+        _relower()). Otherwise, the grammar is linked again from the parsed files.
+        Grammars loaded with !import are refreshed as well.
+
+        Grammars built with include_from_string() or extract() are not
+        refreshed.
+
+        Returns:
+            Number of errors encountered during the parsing.
+        """
+        if not self._root_files:
+            return 0
+
+        for name, path in self._import_paths.items():
+            subgrammar = registry.get_grammar(path)
+            if subgrammar is not self._imports[name]:
+                self._imports[name] = subgrammar
+                self._update_source_files(subgrammar._source_files)
+
+        if not self._segments:
+            # Loaded from the cache, the parsed files are not available.
+            if not _sources_unchanged(self._source_files):
+                return self._reload()
+            return 0
+
+        changed = {}
+        checked = set()
+        for segment in self._segments:
+            fragment = segment.fragment
+            if fragment in checked or not fragment.path:
+                continue
+            checked.add(fragment)
+            try:
+                new_fragment = registry.get_fragment(fragment.path, self)
+            except IOError:
+                print('Error reading ' + fragment.path)
+                return 1
+            if new_fragment is not fragment:
+                if (new_fragment.num_errors or
+                        _commands(fragment) != _commands(new_fragment)):
+                    return self._reload()
+                changed[fragment] = new_fragment
+        if not changed:
+            return 0
+
+        affected = set()
+        for old_fragment, new_fragment in changed.items():
+            spliced = self._splice_fragment(old_fragment, new_fragment)
+            if spliced is None:
+                return self._reload()
+            affected.update(spliced)
+
+        old_creators = dict((symbol, self._creators.pop(symbol, None))
+                            for symbol in affected)
+        self._all_rules = []
+        for symbol in affected:
+            self._nonrecursive_creators.pop(symbol, None)
+        for segment in self._segments:
+            for rule in segment.rules:
+                self._all_rules.append(rule)
+                self._index_rule(rule, affected)
+        self._root = ''
+        for rule in self._all_rules:
+            if rule.type == 'grammar' and 'root' in rule.creates:
+                self._root = rule.creates['tagname']
+
+        for symbol in affected:
+            self._creator_cdfs.pop(symbol, None)
+            self._nonrecursivecreator_cdfs.pop(symbol, None)
+            if symbol in self._creators:
+                self._creator_cdfs[symbol] = self._get_cdf(
+                    symbol, self._creators[symbol])
+            if symbol in self._nonrecursive_creators:
+                self._nonrecursivecreator_cdfs[symbol] = self._get_cdf(
+                    symbol, self._nonrecursive_creators[symbol])
+        # Fragments are spliced as a whole, but usually only the rules of
+        # a few of their symbols were edited.
+        modified = set(
+            symbol for symbol in affected
+            if _rule_keys(self._creators.get(symbol)) !=
+            _rule_keys(old_creators[symbol]))
+        if 'line' in modified:
+            self._compute_interesting_indices()
+        _without_gc(self._relower, modified)
+        return 0
+
+    def _splice_fragment(self, old_fragment, new_fragment):
+        """Replaces rules from a fragment with rules from its new version.
+
+        Returns:
+            The set of symbols whose creators changed, or None if the
+            segments of the fragments don't match and the grammar needs to
+            be built again.
+        """
+        new_rules = [[]]
+        functions = []
+        for entry in new_fragment.entries:
+            if not isinstance(entry, tuple):
+                new_rules[-1].append(entry)
+            elif entry[0] == _COMMAND:
+                new_rules.append([])
+            else:
+                functions.append(entry)
+
+        # Every time a fragment is linked (once per !include of it), it
+        # adds one segment per run of rules between its commands, in
+        # order. With the same commands in both versions, the i-th segment
+        # of each link therefore gets the i-th run of the new version.
+        segments = [segment for segment in self._segments
+                    if segment.fragment is old_fragment]
+        if len(segments) % len(new_rules):
+            return None
+
+        for entry in functions:
+            self._save_function(entry[1], entry[2], entry[3])
+        affected = set()
+        for start in range(0, len(segments), len(new_rules)):
+            for segment, rules in zip(segments[start:], new_rules):
+                for rule in segment.rules + rules:
+                    affected.update(self._rule_symbols(rule))
+                segment.fragment = new_fragment
+                segment.rules = list(rules)
+
+        self._update_source_files([(new_fragment.path, new_fragment.digest)])
+        return affected
+
+    def _update_source_files(self, source_files):
+        """Records new digests of files the grammar was built from."""
+        digests = dict(source_files)
+        self._source_files = [(path, digests.get(path, digest))
+                              for path, digest in self._source_files]
+
+    def _reload(self):
+        """Builds the grammar again from its source files."""
+        root_files = self._root_files
+        imports = dict((name, grammar)
+                       for name, grammar in self._imports.items()
+                       if name not in self._import_paths)
+        self.__init__()
+        self._imports.update(imports)
+        for filename in root_files:
+            errors = self.include_from_file(filename)
+            if errors:
+                return errors
+        self.finalize()
+        return 0
 
     def parse_from_string(self, grammar_str):
         """Parses grammar rules from string.
@@ -952,16 +3320,15 @@ class Grammar(object):
         Returns:
             Number of errors encountered during the parsing.
         """
-        errors = self._include_from_string(grammar_str)
+        errors = self.include_from_string(grammar_str)
         if errors:
             return errors
 
-        self._normalize_probabilities()
-        self._compute_interesting_indices()
+        self.finalize()
 
         return 0
 
-    def parse_from_file(self, filename):
+    def parse_from_file(self, filename, cache_dir=None):
         """Parses grammar from file.
 
         Opens a text file, parses it and loads the grammar rules within.
@@ -970,22 +3337,367 @@ class Grammar(object):
 
         Args:
             filename: path to the file with grammar rules.
+            cache_dir: optional directory for the compiled grammar cache.
+                If given, a grammar built from unchanged files is loaded
+                from the cache instead of being parsed again.
 
         Returns:
             Number of errors encountered during the parsing.
         """
+        if not cache_dir:
+            errors = self.include_from_file(filename)
+            if errors:
+                return errors
+            self.finalize()
+            return 0
+
+        # The cache entry only holds what the grammar files define, the
+        # configuration of this instance is applied after loading it.
+        configuration = self._take_configuration()
+        if not self._load_from_cache(filename, cache_dir):
+            errors = self.include_from_file(filename)
+            if errors:
+                self._apply_configuration(configuration)
+                return errors
+            self.finalize()
+            self._save_to_cache(filename, cache_dir)
+        self._apply_configuration(configuration)
+        return 0
+
+    def _take_configuration(self):
+        """Resets the settings made with cache_symbol() and use_*() calls.
+
+        Returns:
+            The previous settings, for _apply_configuration().
+        """
+        configuration = (self._cache_settings, self._optimized,
+                         self._explicit_stack, self._random_pools)
+        self._cache_settings = {}
+        self._optimized = False
+        self._explicit_stack = False
+        self._random_pools = None
+        return configuration
+
+    def _apply_configuration(self, configuration):
+        """Restores settings returned by _take_configuration()."""
+        (cache_settings, optimized, self._explicit_stack,
+         self._random_pools) = configuration
+        if not cache_settings and not optimized:
+            return
+        # Caches declared in the grammar files take precedence, like when
+        # the files are parsed after calling cache_symbol().
+        cache_settings.update(self._cache_settings)
+        self._cache_settings = cache_settings
+        self._optimized = optimized
+        if self._symbol_names:
+            self._lower()
+
+    def _cache_path(self, filename, cache_dir):
+        name = _digest(os.path.abspath(filename))
+        return os.path.join(cache_dir, name + '.grammar')
+
+    def _load_from_cache(self, filename, cache_dir):
+        """Restores the grammar state from cache if it is up to date.
+
+        The cache entry is valid only if the content of the root file and
+        of every file it transitively includes or imports is unchanged.
+
+        Returns:
+            True if the grammar was loaded from the cache.
+        """
         try:
-            f = open(filename)
-            content = f.read()
-            f.close()
-        except IOError:
-            print('Error reading ' + filename)
-            return 1
-        self._definitions_dir = os.path.dirname(filename)
-        return self.parse_from_string(content)
+            state = _read_state(self._cache_path(filename, cache_dir))
+        except Exception:
+            # Missing and unreadable entries are both cache misses.
+            return False
+        if state is None or not _sources_unchanged(state['_source_files']):
+            return False
+        imports = self._imports
+        self.__setstate__(state)
+        # Keep imports added with add_import() before loading.
+        imports.update(self._imports)
+        self._imports = imports
+        return True
+
+    def _save_to_cache(self, filename, cache_dir):
+        """Writes the fully built grammar state to the cache."""
+        state = self.__getstate__()
+        # Imports added with add_import() are wired up by the caller,
+        # only grammars loaded with !import belong to this grammar.
+        state['_imports'] = dict(
+            (name, grammar) for name, grammar in self._imports.items()
+            if name in self._import_paths
+        )
+        path = self._cache_path(filename, cache_dir)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            _write_state(path, state)
+        except (IOError, OSError):
+            print('Error writing grammar cache ' + path)
+
+    def save_compiled(self, filename):
+        """Writes the built grammar to a file.
+
+        Unlike the grammar cache, the file also contains all the imported
+        grammars, including the ones added with add_import(), and it is not
+        tied to the grammar source files. Load it with load_compiled().
+
+        Args:
+            filename: path of the output file.
+        """
+        _write_state(filename, self.__getstate__())
+
+    def load_compiled(self, filename):
+        """Loads a grammar written by save_compiled().
+
+        Args:
+            filename: path to the compiled grammar.
+
+        Raises:
+            GrammarError: If the file was written by an incompatible version.
+        """
+        state = _read_state(filename)
+        if state is None:
+            raise GrammarError('Incompatible compiled grammar ' + filename)
+        self.__setstate__(state)
+
+    def save_image(self, filename):
+        """Writes the finalized grammar as a flat binary image.
+
+        The image contains the lowered rules in offset-addressed tables
+        and is meant to be mapped read-only with load_image(), so that
+        processes generating from the same grammar share a single copy of
+        it. Imported grammars are not included, they need to be saved
+        separately and added to the loaded grammar with add_import().
+        Images can only be loaded on machines with the same byte order.
+
+        Args:
+            filename: path of the output file.
+        """
+        import array
+        import pickle
+
+        strings = _StringTable()
+        tags = {}
+        tag_offsets = array.array('I', [0])
+        tag_items = array.array('I')
+        ops = array.array('I')
+        inlined = array.array('I')
+        rules = {}
+        rule_offsets = array.array('I', [0])
+        rule_code = array.array('B')
+
+        def add_tag(tag):
+            if tag is None:
+                return _IMAGE_NONE
+            index = tags.get(id(tag))
+            if index is None:
+                index = len(tags)
+                tags[id(tag)] = index
+                for key, value in tag.items():
+                    tag_items.append(strings.add(key))
+                    tag_items.append(_IMAGE_NONE if value is True
+                                     else strings.add(value))
+                tag_offsets.append(len(tag_items) // 2)
+            return index
+
+        def add_rule(rule):
+            index = rules.get(id(rule))
+            if index is None:
+                index = len(rules)
+                rules[id(rule)] = index
+                is_code, rule_ops = rule
+                for opcode, arg, tag in rule_ops:
+                    if opcode == _OP_BUILTIN:
+                        arg = strings.add(tag['tagname'])
+                    elif opcode == _OP_CALL:
+                        arg = 0
+                    elif opcode == _OP_INLINED_TEXT:
+                        inlined.extend((strings.add(arg[0]), arg[1], arg[2]))
+                        arg = len(inlined) // 3 - 1
+                    elif opcode == _OP_INLINED_SYMBOL:
+                        inlined.extend((arg[0], arg[1], 0))
+                        arg = len(inlined) // 3 - 1
+                    elif opcode != _OP_SYMBOL:
+                        arg = strings.add(arg)
+                    ops.extend((opcode, arg, add_tag(tag)))
+                rule_offsets.append(len(ops) // 3)
+                rule_code.append(is_code)
+            return index
+
+        def add_lists(lists, item_function, typecode):
+            offsets = array.array('I', [0])
+            items = array.array(typecode)
+            for items_list in lists:
+                if items_list:
+                    items.extend(item_function(item) for item in items_list)
+                offsets.append(len(items))
+            return offsets, items
+
+        creator_offsets, creator_rules = add_lists(
+            self._lowered_creators, add_rule, 'I')
+        nonrecursive_offsets, nonrecursive_rules = add_lists(
+            self._lowered_nonrecursive, add_rule, 'I')
+        cdf_offsets, cdfs = add_lists(self._lowered_cdfs, float, 'd')
+        nonrecursive_cdf_offsets, nonrecursive_cdfs = add_lists(
+            self._lowered_nonrecursive_cdfs, float, 'd')
+
+        def add_alias_tables(tables):
+            offsets, thresholds = add_lists(
+                [table and table[0] for table in tables], float, 'd')
+            _, aliases = add_lists(
+                [table and table[1] for table in tables], int, 'I')
+            return offsets, thresholds, aliases
+
+        alias_offsets, alias_thresholds, alias_indices = (
+            add_alias_tables(self._lowered_alias_tables))
+        (nonrecursive_alias_offsets, nonrecursive_alias_thresholds,
+         nonrecursive_alias_indices) = add_alias_tables(
+             self._lowered_nonrecursive_alias_tables)
+        pool_offsets, pool_outputs = add_lists(
+            self._lowered_pools, strings.add, 'I')
+        pool_alias_offsets, pool_alias_thresholds, pool_alias_indices = (
+            add_alias_tables(self._lowered_pool_alias_tables))
+        pool_symbol_offsets, pool_symbols = add_lists(
+            [symbols and sorted(symbols)
+             for symbols in self._lowered_pool_symbols],
+            self._symbol_ids.__getitem__, 'I')
+        interesting_offsets, interesting_lines = add_lists(
+            [self._interesting_lines.get(symbol)
+             for symbol in self._symbol_names], int, 'i')
+
+        metadata = {
+            'symbol_names': self._symbol_names,
+            'line_id': self._line_id,
+            'num_lines': len(self._all_nonhelper_lines),
+            'root': self._root,
+            'inheritance': self._inheritance,
+            'function_sources': self._function_sources,
+            'var_format': self._var_format,
+            'line_guard': self._line_guard,
+            'recursion_max': self._recursion_max,
+            'var_reuse_prob': self._var_reuse_prob,
+            'interesting_line_prob': self._interesting_line_prob,
+            'max_vars_of_same_type': self._max_vars_of_same_type,
+            'cache_settings': self._cache_settings
+        }
+        sections = {
+            'metadata': pickle.dumps(metadata, pickle.HIGHEST_PROTOCOL),
+            'string_data': strings.data(),
+            'string_offsets': strings.offsets,
+            'tag_offsets': tag_offsets,
+            'tag_items': tag_items,
+            'ops': ops,
+            'inlined': inlined,
+            'rule_offsets': rule_offsets,
+            'rule_code': rule_code,
+            'creator_offsets': creator_offsets,
+            'creator_rules': creator_rules,
+            'nonrecursive_offsets': nonrecursive_offsets,
+            'nonrecursive_rules': nonrecursive_rules,
+            'cdf_offsets': cdf_offsets,
+            'cdfs': cdfs,
+            'nonrecursive_cdf_offsets': nonrecursive_cdf_offsets,
+            'nonrecursive_cdfs': nonrecursive_cdfs,
+            'alias_offsets': alias_offsets,
+            'alias_thresholds': alias_thresholds,
+            'alias_indices': alias_indices,
+            'nonrecursive_alias_offsets': nonrecursive_alias_offsets,
+            'nonrecursive_alias_thresholds':
+                nonrecursive_alias_thresholds,
+            'nonrecursive_alias_indices': nonrecursive_alias_indices,
+            'symbol_reusable': array.array('B', self._reusable_symbols),
+            'symbol_min_depths': array.array('I', self._lowered_min_depths),
+            'symbol_max_depths': array.array('I', self._lowered_max_depths),
+            'pool_offsets': pool_offsets,
+            'pool_outputs': pool_outputs,
+            'pool_alias_offsets': pool_alias_offsets,
+            'pool_alias_thresholds': pool_alias_thresholds,
+            'pool_alias_indices': pool_alias_indices,
+            'pool_depths': array.array('I', self._lowered_pool_depths),
+            'pool_symbol_offsets': pool_symbol_offsets,
+            'pool_symbols': pool_symbols,
+            'interesting_offsets': interesting_offsets,
+            'interesting_lines': interesting_lines
+        }
+        _write_image(filename, [bytes(sections[name])
+                                for name in _IMAGE_SECTIONS])
+
+    def load_image(self, filename):
+        """Maps a grammar image written by save_image() into memory.
+
+        Rules are decoded from the mapped file when they are used, with
+        only the recently used ones cached, so the memory used by each
+        process stays small and the image itself is shared by all the
+        processes that load it. The loaded grammar can be used for
+        generation only; it can't be refreshed, extracted, analyzed or
+        pickled.
+
+        Args:
+            filename: path to the grammar image.
+
+        Raises:
+            GrammarError: If the file is not a compatible grammar image.
+        """
+        import pickle
+
+        image = _GrammarImage(filename, self._specialize_built_in)
+        metadata = pickle.loads(image.section('metadata'))
+        self._symbol_names = metadata['symbol_names']
+        self._symbol_ids = dict((symbol, symbol_id) for symbol_id, symbol
+                                in enumerate(self._symbol_names))
+        self._line_id = metadata['line_id']
+        self._all_nonhelper_lines = range(metadata['num_lines'])
+        self._root = metadata['root']
+        self._inheritance = metadata['inheritance']
+        self._lower_variable_ancestors()
+        self._var_format = metadata['var_format']
+        self._line_guard = metadata['line_guard']
+        self._recursion_max = metadata['recursion_max']
+        self._var_reuse_prob = metadata['var_reuse_prob']
+        self._interesting_line_prob = metadata['interesting_line_prob']
+        self._max_vars_of_same_type = metadata['max_vars_of_same_type']
+        self._function_sources = metadata['function_sources']
+        self._functions = {}
+        for name, source in self._function_sources.items():
+            self._functions[name] = compile(source, name, 'exec')
+
+        self._reusable_symbols = image.section('symbol_reusable')
+        self._lowered_min_depths = image.section('symbol_min_depths')
+        self._lowered_max_depths = image.section('symbol_max_depths')
+        self._restricted_creators = {}
+        self._lowered_creators = _ImageTable(
+            image, 'creator_offsets', 'creator_rules', image.rule)
+        self._lowered_nonrecursive = _ImageTable(
+            image, 'nonrecursive_offsets', 'nonrecursive_rules', image.rule)
+        self._lowered_cdfs = _ImageTable(image, 'cdf_offsets', 'cdfs')
+        self._lowered_nonrecursive_cdfs = _ImageTable(
+            image, 'nonrecursive_cdf_offsets', 'nonrecursive_cdfs')
+        self._lowered_alias_tables = _ImageAliasTables(
+            image, 'alias_offsets', 'alias_thresholds', 'alias_indices')
+        self._lowered_nonrecursive_alias_tables = _ImageAliasTables(
+            image, 'nonrecursive_alias_offsets',
+            'nonrecursive_alias_thresholds', 'nonrecursive_alias_indices')
+        self._lowered_pools = _ImageTable(
+            image, 'pool_offsets', 'pool_outputs', image.string)
+        self._lowered_pool_alias_tables = _ImageAliasTables(
+            image, 'pool_alias_offsets', 'pool_alias_thresholds',
+            'pool_alias_indices')
+        self._lowered_pool_depths = image.section('pool_depths')
+        self._lowered_pool_symbols = _ImageTable(
+            image, 'pool_symbol_offsets', 'pool_symbols',
+            self._symbol_names.__getitem__)
+        self._interesting_lines = _ImageMapping(
+            self._symbol_ids,
+            _ImageTable(image, 'interesting_offsets', 'interesting_lines'))
+        self._cache_settings = metadata['cache_settings']
+        self._create_caches()
 
     def _compute_interesting_indices(self):
         # select interesting lines for each variable type
+        self._interesting_lines = {}
+        self._all_nonhelper_lines = []
 
         if 'line' not in self._creators:
             return
@@ -993,34 +3705,502 @@ class Grammar(object):
         for i in range(len(self._creators['line'])):
             self._all_nonhelper_lines.append(i)
             rule = self._creators['line'][i]
-            for part in rule['parts']:
-                if part['type'] == 'text':
+            for part in rule.parts:
+                if isinstance(part, str):
                     continue
                 tagname = part['tagname']
                 if tagname in _NONINTERESTING_TYPES:
                     continue
                 if 'new' in part:
                     continue
-                if tagname not in self._interesting_lines:
-                    self._interesting_lines[tagname] = []
-                self._interesting_lines[tagname].append(i)
+                lines = self._interesting_lines.setdefault(tagname, [])
+                if not lines or lines[-1] != i:
+                    lines.append(i)
+
+    def _lower_variable_ancestors(self):
+        """Lists the types a variable of every extended type is added as.
+
+        A variable is added as its own type and, depth first, as every
+        type its type extends with !extends, so that variables of a type
+        can be picked from a single list that includes its subtypes.
+        """
+        def ancestors(var_type, path):
+            types = [var_type]
+            for parent_type in self._inheritance.get(var_type, ()):
+                # A cycle of !extends statements is followed only once.
+                if parent_type not in path:
+                    types.extend(ancestors(parent_type,
+                                           path + (parent_type,)))
+            return types
+
+        self._variable_ancestors = dict(
+            (var_type, tuple(ancestors(var_type, (var_type,))))
+            for var_type in self._inheritance)
+        self._setter_templates = {}
+        if self._all_rules:
+            for var_type in self._variable_types():
+                self._setter_template(var_type)
+
+    def _setter_template(self, var_type):
+        """Returns the line that registers a new variable of a type.
+
+        The line is returned split at the places of the variable name,
+        for joining with the name, and kept for the next variable of the
+        type. Types that were not known when the grammar was lowered,
+        such as the ones of initial variables, get their template when
+        it is first needed.
+        """
+        literals = ['if (!', ') { ', " = GetVariable(fuzzervars, '" +
+                    var_type + "'); } else { "]
+        for ancestor in self._variable_ancestors.get(var_type, (var_type,)):
+            literals[-1] += 'SetVariable(fuzzervars, '
+            literals.append(", '" + ancestor + "'); ")
+        literals[-1] += ' }'
+        template = tuple(literals)
+        self._setter_templates[var_type] = template
+        return template
 
     def _add_variable(self, var_name, var_type, context):
-        if var_type not in context['variables']:
-            context['variables'][var_type] = []
-            if var_type in self._interesting_lines:
-                set1 = set(context['interesting_lines'])
-                set2 = set(self._interesting_lines[var_type])
-                new_interesting = set2 - set1
-                context['interesting_lines'] += list(new_interesting)
-        context['variables'][var_type].append(var_name)
-        if var_type in self._inheritance:
-            for parent_type in self._inheritance[var_type]:
-                self._add_variable(var_name, parent_type, context)
-
-    def _get_variable_setters(self, var_name, var_type):
-        ret = "SetVariable(fuzzervars, " + var_name + ", '" + var_type + "'); "
-        if var_type in self._inheritance:
-            for parent_type in self._inheritance[var_type]:
-                ret += self._get_variable_setters(var_name, parent_type)
-        return ret
+        variables = context['variables']
+        journal = context.get('journal')
+        for ancestor in self._variable_ancestors.get(var_type, (var_type,)):
+            names = variables.get(ancestor)
+            if names is None:
+                names = variables[ancestor] = []
+                if ancestor in self._interesting_lines:
+                    # The lines are kept in a list to sample from and in a
+                    # set to skip the ones that are already in the list,
+                    # so adding a type only costs as much as its lines.
+                    interesting_lines = context['interesting_lines']
+                    interesting_line_set = context['interesting_line_set']
+                    for line in self._interesting_lines[ancestor]:
+                        if line not in interesting_line_set:
+                            interesting_line_set.add(line)
+                            interesting_lines.append(line)
+            names.append(var_name)
+            if journal is not None:
+                journal.append(ancestor)
+
+
+def _without_gc(function, *args):
+    """Calls a function with the cyclic garbage collector paused.
+
+    Lowering a grammar and loading a lowered grammar create lots of small
+    tuples, which would otherwise trigger the collector over and over.
+    """
+    import gc
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return function(*args)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _read_state(path):
+    """Reads pickled grammar state, None if it has a different version."""
+    import pickle
+    with open(path, 'rb') as f:
+        entry = _without_gc(pickle.load, f)
+    if entry.get('version') != _CACHE_VERSION:
+        return None
+    return entry['state']
+
+
+def _write_state(path, state):
+    """Atomically writes pickled grammar state."""
+    import pickle
+    entry = {'version': _CACHE_VERSION, 'state': state}
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def _load_grammar(filename, cache_dir):
+    grammar = Grammar()
+    num_errors = grammar.parse_from_file(filename, cache_dir)
+    return num_errors, grammar
+
+
+def load_grammars(filenames, cache_dir=None, processes=None):
+    """Loads several independent grammars, optionally in parallel.
+
+    With more than one process, each grammar is built in a separate worker
+    process and the finished grammar is sent back to the caller, so on a
+    multi-core machine loading all the grammars takes about as long as
+    loading the largest one. Starting the workers and sending the grammars
+    back costs more than loading them from a warm cache, so grammars are
+    loaded in this process unless processes is given.
+    Grammars that use each other through <import> tags should be linked
+    with add_import() once all of them are loaded.
+
+    Args:
+        filenames: list of paths of the root grammar files.
+        cache_dir: optional directory for the compiled grammar cache.
+        processes: maximum number of worker processes, 0 for one per CPU.
+            If None or 1, grammars are loaded in this process.
+
+    Returns:
+        A list of Grammar objects in the same order as filenames.
+
+    Raises:
+        GrammarError: If there were errors parsing any of the grammars.
+    """
+    if processes is None:
+        processes = 1
+    elif processes == 0:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(filenames))
+    if processes <= 1:
+        results = [_load_grammar(filename, cache_dir)
+                   for filename in filenames]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(processes) as executor:
+            results = list(executor.map(_load_grammar, filenames,
+                                        [cache_dir] * len(filenames)))
+
+    grammars = []
+    for filename, (num_errors, grammar) in zip(filenames, results):
+        if num_errors:
+            raise GrammarError('There were errors parsing ' + filename)
+        grammars.append(grammar)
+    return grammars
+
+
+def _write_image(path, sections):
+    """Writes a grammar image, see Grammar.save_image().
+
+    The image starts with a header of the magic string, the format version
+    and the number of sections, followed by an (offset, size) pair for each
+    section. Sections are aligned to 8 bytes.
+    """
+    header_size = struct.calcsize(_IMAGE_HEADER_FORMAT)
+    entry_size = struct.calcsize(_IMAGE_ENTRY_FORMAT)
+    offset = header_size + entry_size * len(sections)
+    entries = []
+    for data in sections:
+        offset += -offset % 8
+        entries.append((offset, len(data)))
+        offset += len(data)
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack(_IMAGE_HEADER_FORMAT, _IMAGE_MAGIC,
+                            _IMAGE_VERSION, len(sections)))
+        for entry in entries:
+            f.write(struct.pack(_IMAGE_ENTRY_FORMAT, *entry))
+        for (offset, _), data in zip(entries, sections):
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(data)
+    os.replace(tmp_path, path)
+
+
+class _StringTable(object):
+    """Deduplicated UTF-8 strings of a grammar image, addressed by index."""
+
+    def __init__(self):
+        import array
+        self._indices = {}
+        self._chunks = []
+        self._size = 0
+        self.offsets = array.array('I', [0])
+
+    def add(self, string):
+        index = self._indices.get(string)
+        if index is None:
+            index = len(self._indices)
+            self._indices[string] = index
+            encoded = string.encode('utf-8', 'surrogatepass')
+            self._chunks.append(encoded)
+            self._size += len(encoded)
+            self.offsets.append(self._size)
+        return index
+
+    def data(self):
+        return b''.join(self._chunks)
+
+
+class _GrammarImage(object):
+    """Read-only view of a grammar image mapped into memory."""
+
+    def __init__(self, filename, specialize_built_in):
+        import mmap
+        with open(filename, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._data)
+        header_size = struct.calcsize(_IMAGE_HEADER_FORMAT)
+        entry_size = struct.calcsize(_IMAGE_ENTRY_FORMAT)
+        if len(view) < header_size:
+            raise GrammarError('Not a grammar image: ' + filename)
+        magic, version, num_sections = struct.unpack_from(
+            _IMAGE_HEADER_FORMAT, view)
+        if (magic != _IMAGE_MAGIC or version != _IMAGE_VERSION or
+                num_sections != len(_IMAGE_SECTIONS)):
+            raise GrammarError('Incompatible grammar image ' + filename)
+        self._sections = {}
+        for i, name in enumerate(_IMAGE_SECTIONS):
+            offset, size = struct.unpack_from(
+                _IMAGE_ENTRY_FORMAT, view, header_size + i * entry_size)
+            section = view[offset:offset + size]
+            if name in _IMAGE_SECTION_TYPES:
+                section = section.cast(_IMAGE_SECTION_TYPES[name])
+            self._sections[name] = section
+
+        self._specialize_built_in = specialize_built_in
+        self._string_data = self._sections['string_data']
+        self._string_offsets = self._sections['string_offsets']
+        self._tag_offsets = self._sections['tag_offsets']
+        self._tag_items = self._sections['tag_items']
+        self._ops = self._sections['ops']
+        self._inlined = self._sections['inlined']
+        self._rule_offsets = self._sections['rule_offsets']
+        self._rule_code = self._sections['rule_code']
+        self._tags = {}
+        self.rule = functools.lru_cache(_IMAGE_RULE_CACHE_SIZE)(self._rule)
+
+    def section(self, name):
+        return self._sections[name]
+
+    def string(self, index):
+        return str(self._string_data[self._string_offsets[index]:
+                                     self._string_offsets[index + 1]],
+                   'utf-8', 'surrogatepass')
+
+    def _tag(self, index):
+        tag = self._tags.get(index)
+        if tag is None:
+            tag = {}
+            for i in range(self._tag_offsets[index],
+                           self._tag_offsets[index + 1]):
+                value = self._tag_items[2 * i + 1]
+                tag[self.string(self._tag_items[2 * i])] = (
+                    True if value == _IMAGE_NONE else self.string(value))
+            self._tags[index] = tag
+        return tag
+
+    def _rule(self, index):
+        """Decodes a lowered rule, see Grammar._lower_rule()."""
+        ops = []
+        for i in range(self._rule_offsets[index],
+                       self._rule_offsets[index + 1]):
+            opcode, arg, tag = self._ops[3 * i:3 * i + 3]
+            tag = None if tag == _IMAGE_NONE else self._tag(tag)
+            if opcode == _OP_BUILTIN:
+                arg = self._specialize_built_in(tag)
+            elif opcode == _OP_CALL:
+                arg = None
+            elif opcode == _OP_INLINED_TEXT:
+                text, levels, symbol_id = self._inlined[3 * arg:3 * arg + 3]
+                arg = (self.string(text), levels, symbol_id)
+            elif opcode == _OP_INLINED_SYMBOL:
+                arg = tuple(self._inlined[3 * arg:3 * arg + 2])
+            elif opcode != _OP_SYMBOL:
+                arg = self.string(arg)
+            ops.append((opcode, arg, tag))
+        return (bool(self._rule_code[index]), tuple(ops))
+
+
+class _ImageTable(object):
+    """Sequence of lists stored in a grammar image as offsets and items.
+
+    Empty lists are returned as None, items can optionally be converted
+    with a function when they are accessed.
+    """
+
+    def __init__(self, image, offsets, items, item_function=None):
+        self._offsets = image.section(offsets)
+        self._items = image.section(items)
+        self._item_function = item_function
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        start = self._offsets[index]
+        end = self._offsets[index + 1]
+        if start == end:
+            return None
+        if self._item_function is None:
+            return self._items[start:end]
+        return _ImageList(self._items[start:end], self._item_function)
+
+
+class _ImageAliasTables(object):
+    """Sequence of alias tables stored in a grammar image.
+
+    Symbols without an alias table are returned as None.
+    """
+
+    def __init__(self, image, offsets, thresholds, aliases):
+        self._thresholds = _ImageTable(image, offsets, thresholds)
+        self._aliases = _ImageTable(image, offsets, aliases)
+
+    def __len__(self):
+        return len(self._thresholds)
+
+    def __getitem__(self, index):
+        thresholds = self._thresholds[index]
+        if thresholds is None:
+            return None
+        return thresholds, self._aliases[index]
+
+
+class _ImageList(object):
+    """A list of items converted with a function when accessed."""
+
+    def __init__(self, items, item_function):
+        self._items = items
+        self._item_function = item_function
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        return self._item_function(self._items[index])
+
+
+class _ImageMapping(object):
+    """Read-only mapping from symbol names to items of an _ImageTable."""
+
+    def __init__(self, symbol_ids, table):
+        self._symbol_ids = symbol_ids
+        self._table = table
+
+    def __contains__(self, symbol):
+        return self.get(symbol) is not None
+
+    def __getitem__(self, symbol):
+        value = self.get(symbol)
+        if value is None:
+            raise KeyError(symbol)
+        return value
+
+    def get(self, symbol, default=None):
+        symbol_id = self._symbol_ids.get(symbol)
+        if symbol_id is None:
+            return default
+        value = self._table[symbol_id]
+        return default if value is None else value
+
+
+class _Fragment(object):
+    """Rules, commands and functions parsed from a single grammar file.
+
+    Entries are kept in file order so that linking a fragment into a
+    grammar has the same effect as parsing the file in place. Rules are
+    stored as they are, commands and functions as (kind, ...) tuples.
+    """
+
+    def __init__(self, path, digest):
+        self.path = path
+        self.digest = digest
+        self.entries = []
+        self.num_errors = 0
+
+
+class _Segment(object):
+    """A run of rules from one fragment, see Grammar._link_fragment()."""
+
+    def __init__(self, fragment):
+        self.fragment = fragment
+        self.rules = []
+
+
+def _sources_unchanged(source_files):
+    """Checks that files still have the recorded content digests."""
+    for path, digest in source_files:
+        try:
+            with open(path) as f:
+                if _digest(f.read()) != digest:
+                    return False
+        except IOError:
+            return False
+    return True
+
+
+def _commands(fragment):
+    """Returns the commands in a fragment, in order."""
+    return [entry[1:3] for entry in fragment.entries
+            if isinstance(entry, tuple) and entry[0] == _COMMAND]
+
+
+class GrammarRegistry(object):
+    """Process-wide store of parsed grammar files.
+
+    Grammar files that are included from several grammars (such as
+    common.txt) are parsed only once and the resulting fragment is shared
+    by every grammar that includes it. Similarly, grammars loaded with
+    get_grammar() (which is also used by the !import command) are built
+    only once per process.
+
+    Entries are keyed by canonical path and are parsed again only after
+    the file modification time changes.
+    """
+
+    def __init__(self):
+        self._fragments = {}
+        self._grammars = {}
+
+    def get_fragment(self, filename, parser):
+        """Returns the parsed fragment for a grammar file.
+
+        Args:
+            filename: path to the grammar file.
+            parser: Grammar used to parse the file if it isn't loaded yet.
+
+        Raises:
+            IOError: If the file can't be read.
+        """
+        path = os.path.realpath(filename)
+        mtime = os.path.getmtime(path)
+        entry = self._fragments.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        with open(path) as f:
+            content = f.read()
+        fragment = parser._parse_fragment(content, path)
+        self._fragments[path] = (mtime, fragment)
+        return fragment
+
+    def get_grammar(self, filename):
+        """Returns a shared, fully built grammar for a grammar file.
+
+        The returned object is shared by all callers, so it should not be
+        modified (for example with add_import) in ways other users of the
+        same file don't expect.
+
+        Raises:
+            GrammarError: If there were errors parsing the grammar.
+        """
+        path = os.path.realpath(filename)
+        entry = self._grammars.get(path)
+        if entry is not None and self._is_current(entry[0]):
+            return entry[1]
+        grammar = Grammar()
+        num_errors = grammar.parse_from_file(filename)
+        if num_errors:
+            raise GrammarError('There were errors when parsing ' + filename)
+        mtimes = [(source, os.path.getmtime(source))
+                  for source, _ in grammar._source_files]
+        self._grammars[path] = (mtimes, grammar)
+        return grammar
+
+    def _is_current(self, mtimes):
+        for path, mtime in mtimes:
+            try:
+                if os.path.getmtime(path) != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def clear(self):
+        """Forgets all loaded fragments and grammars."""
+        self._fragments = {}
+        self._grammars = {}
+
+
+registry = GrammarRegistry()
@@ -0,0 +1,301 @@
+#   Domato - static grammar analyzer
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from __future__ import print_function
+import sys
+
+# Limits for solving the expected expansion size equations.
+_MAX_ITERATIONS = 10000
+_CONVERGENCE_EPSILON = 1e-9
+_DIVERGENCE_LIMIT = 1e30
+
+
+def _creator_probabilities(grammar, symbol):
+    """Returns the probability of selecting each creator of a symbol."""
+    creators = grammar._creators[symbol]
+    cdf = grammar._creator_cdfs.get(symbol)
+    if not cdf:
+        return [1.0 / len(creators)] * len(creators)
+    return [cdf[0]] + [cdf[i] - cdf[i - 1] for i in range(1, len(cdf))]
+
+
+def _mean_matrix(grammar):
+    """Computes the expected number of times each symbol is generated.
+
+    Returns:
+        A dictionary that maps each symbol S to a dictionary that maps
+        symbols T to the expected number of T symbols in a single
+        expansion of S.
+    """
+    matrix = {}
+    for symbol in grammar._creators:
+        row = {}
+        probabilities = _creator_probabilities(grammar, symbol)
+        for rule, p in zip(grammar._creators[symbol], probabilities):
+            ids = set()
+            for part in rule.parts:
+                if not grammar._is_symbol_part(part):
+                    continue
+                if 'id' in part:
+                    # Parts with the same id are only expanded once.
+                    if part['id'] in ids:
+                        continue
+                    ids.add(part['id'])
+                tagname = part['tagname']
+                row[tagname] = row.get(tagname, 0) + p
+        matrix[symbol] = row
+    return matrix
+
+
+def _strongly_connected_components(graph):
+    """Tarjan's algorithm, without recursion.
+
+    Returns:
+        A list of components (lists of nodes). Every component comes after
+        all the components reachable from it.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for root in graph:
+        if root in index:
+            continue
+        work = [(root, iter(graph[root]))]
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, children = work[-1]
+            pushed = False
+            for child in children:
+                if child not in graph:
+                    continue
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(graph[child])))
+                    pushed = True
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            if pushed:
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+    return components
+
+
+def expected_sizes(grammar):
+    """Computes the expected expansion size of every symbol.
+
+    The size of an expansion is the number of symbols expanded to produce
+    it, including the symbol itself. Built-in symbols, constants, calls and
+    new variables are not counted, and symbols without creators (such as
+    imports) count as a single symbol. Rules are selected according to their
+    probabilities and the maximum recursion depth is ignored, so recursive
+    symbols whose expected size is infinite are the ones that rely on the
+    recursion limit to terminate.
+
+    Returns:
+        A tuple of a dictionary mapping symbols to their expected size
+        (float('inf') if it diverges) and a dictionary mapping symbols in
+        supercritical recursive cycles to the estimated growth rate of the
+        cycle (its spectral radius, 1 or more).
+    """
+    matrix = _mean_matrix(grammar)
+    sizes = {}
+    supercritical = {}
+    for component in _strongly_connected_components(matrix):
+        members = set(component)
+        base = {}
+        for symbol in component:
+            b = 1.0
+            for child, count in matrix[symbol].items():
+                if child not in members:
+                    b += count * sizes.get(child, 1.0)
+            base[symbol] = b
+        cyclic = len(component) > 1 or component[0] in matrix[component[0]]
+        if not cyclic:
+            sizes[component[0]] = base[component[0]]
+            continue
+        if any(b == float('inf') for b in base.values()):
+            for symbol in component:
+                sizes[symbol] = float('inf')
+            continue
+
+        # Solve x = base + M * x by fixed-point iteration, which converges
+        # if and only if the spectral radius of M is less than 1. The
+        # ratio of successive differences estimates the spectral radius.
+        x = dict(base)
+        delta = rate = 0.0
+        converged = False
+        for _ in range(_MAX_ITERATIONS):
+            new_x = {}
+            for symbol in component:
+                value = base[symbol]
+                for child, count in matrix[symbol].items():
+                    if child in members:
+                        value += count * x[child]
+                new_x[symbol] = value
+            new_delta = max(abs(new_x[s] - x[s]) for s in component)
+            if delta:
+                rate = new_delta / delta
+            delta = new_delta
+            x = new_x
+            if delta <= _CONVERGENCE_EPSILON * max(x.values()):
+                converged = True
+                break
+            if max(x.values()) > _DIVERGENCE_LIMIT:
+                break
+        if converged:
+            sizes.update(x)
+        else:
+            for symbol in component:
+                sizes[symbol] = float('inf')
+                supercritical[symbol] = max(rate, 1.0)
+    return sizes, supercritical
+
+
+def analyze_grammar(grammar, start_symbols=None):
+    """Finds problems in a loaded grammar.
+
+    Args:
+        grammar: A finalized Grammar object.
+        start_symbols: Symbols that are generated directly by the user of
+            the grammar. The root symbol and, for grammars that contain
+            code lines, the 'line' symbol are always included.
+
+    Returns:
+        A dictionary consisting of:
+            'undefined': Symbols used in grammar rules that have no
+                creators.
+            'variables_only': Symbols used only in code lines that have no
+                creators, so they can only be satisfied by reusing
+                existing variables.
+            'unreachable': Symbols with creators that are never used when
+                generating the start symbols, or None if there are no start
+                symbols to check against.
+            'nonterminating': Symbols that can never be fully expanded.
+            'too_deep': Symbols whose minimum depth exceeds the maximum
+                recursion depth.
+            'min_depth': Minimum derivation depth of every symbol that can
+                be fully expanded.
+            'expected_size': Expected expansion size of every symbol.
+            'supercritical': Symbols whose expected expansion size
+                diverges, mapped to the estimated growth rate.
+    """
+    start_symbols = list(start_symbols or [])
+    if grammar._root:
+        start_symbols.append(grammar._root)
+    if 'line' in grammar._creators:
+        start_symbols.append('line')
+
+    undefined = set()
+    variables_only = set()
+    for rule in grammar._all_rules:
+        for part in rule.parts:
+            if not grammar._is_symbol_part(part):
+                continue
+            tagname = part['tagname']
+            if tagname in grammar._creators:
+                continue
+            if rule.type == 'grammar':
+                undefined.add(tagname)
+            else:
+                variables_only.add(tagname)
+    variables_only -= undefined
+
+    # Without start symbols every symbol would be reported as unreachable.
+    unreachable = None
+    if start_symbols:
+        reachable, _ = grammar._reachable_symbols(start_symbols)
+        unreachable = sorted(set(grammar._creators) - reachable)
+
+    min_depth = grammar._compute_min_depths()
+    nonterminating = set(grammar._creators) - set(min_depth)
+    too_deep = set(symbol for symbol, depth in min_depth.items()
+                   if depth > grammar._recursion_max)
+
+    sizes, supercritical = expected_sizes(grammar)
+
+    return {
+        'undefined': sorted(undefined),
+        'variables_only': sorted(variables_only),
+        'unreachable': unreachable,
+        'nonterminating': sorted(nonterminating),
+        'too_deep': sorted(too_deep),
+        'min_depth': min_depth,
+        'expected_size': sizes,
+        'supercritical': supercritical
+    }
+
+
+def _print_symbols(title, symbols, out):
+    if symbols:
+        print('%s (%d): %s' % (title, len(symbols), ', '.join(symbols)),
+              file=out)
+
+
+def print_report(report, verbose=False, out=sys.stdout):
+    """Prints the result of analyze_grammar() in a readable form."""
+    _print_symbols('Undefined symbols', report['undefined'], out)
+    _print_symbols('Symbols only available as existing variables',
+                   report['variables_only'], out)
+    if report['unreachable'] is None:
+        print('Unreachable symbols: not checked, the grammar has no root '
+              'symbol and no start symbols were given', file=out)
+    else:
+        _print_symbols('Unreachable symbols', report['unreachable'], out)
+    _print_symbols('Symbols that can never terminate',
+                   report['nonterminating'], out)
+    _print_symbols('Symbols deeper than the maximum recursion depth',
+                   ['%s (%d)' % (symbol, report['min_depth'][symbol])
+                    for symbol in report['too_deep']], out)
+    _print_symbols('Supercritical recursion (expected size diverges)',
+                   ['%s (growth %.3f)' % (symbol, rate) for symbol, rate
+                    in sorted(report['supercritical'].items())], out)
+
+    sizes = report['expected_size']
+    finite = sorted((size, symbol) for symbol, size in sizes.items()
+                    if size != float('inf'))
+    if finite:
+        print('Largest finite expected expansion sizes: ' + ', '.join(
+            '%s (%.1f)' % (symbol, size)
+            for size, symbol in reversed(finite[-10:])), file=out)
+
+    if verbose:
+        print('%-40s %10s %16s' % ('symbol', 'min depth', 'expected size'),
+              file=out)
+        for symbol in sorted(sizes):
+            depth = report['min_depth'].get(symbol)
+            print('%-40s %10s %16.1f' % (
+                symbol, '-' if depth is None else depth, sizes[symbol]),
+                file=out)
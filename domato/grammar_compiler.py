@@ -0,0 +1,818 @@
+#   Domato - grammar compiler
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from __future__ import print_function
+import importlib.util
+import math
+import os
+
+from grammar import GrammarError, _INT_RANGES, _MAX_RECURSIVE_DEPTH
+from grammar import _NONINTERESTING_TYPES
+from grammar import _OP_TEXT, _OP_SYMBOL, _OP_BUILTIN, _OP_NEW
+from grammar import _OP_CONSTANT, _OP_INLINED_TEXT, _OP_INLINED_SYMBOL
+
+# Rules with more parts than this are joined instead of concatenated.
+_MAX_CONCATENATED_PARTS = 8
+
+# Code shared by all generated modules. It mirrors the generation methods
+# of Grammar and is filled in with the settings of the compiled grammar.
+_RUNTIME = '''\
+from __future__ import print_function
+import random as _random_module
+
+from grammar import Grammar, GrammarError, _alias_index
+from grammar import RecursionError as GrammarRecursionError
+from grammar import _escape, _ExpansionCache
+
+_random = _random_module.random
+_randint = _random_module.randint
+_getrandbits = _random_module.getrandbits
+_choice = _random_module.choice
+
+_imports = {}
+
+# Specializes the rare built-in tags that are not compiled, such as
+# binary integers.
+_runtime = Grammar()
+
+
+def add_import(name, grammar):
+    """Adds a grammar that can then be used from <import> tags."""
+    _imports[name] = grammar
+
+
+def _import(name, symbol):
+    if name not in _imports:
+        raise GrammarError('unknown import ' + name)
+    if symbol is None:
+        return _imports[name].generate_root()
+    return _imports[name].generate_symbol(symbol)
+
+
+def _exec_function(function_name, attributes, context, ret_val):
+    """Executes user-defined python code."""
+    if function_name not in _FUNCTIONS:
+        raise GrammarError('Unknown function ' + function_name)
+    args = {
+        # Tags are shared between rules, changes must not leak into other
+        # rules.
+        'attributes': dict(attributes),
+        'context': context,
+        'ret_val': ret_val
+    }
+    # pylint: disable=exec-used
+    try:
+        exec(_FUNCTIONS[function_name], args)
+    except Exception as e:
+        raise GrammarError('Error in user-defined function: %%s' %% str(e))
+    return args['ret_val']
+
+
+def _randbelow(n):
+    # randint(0, n - 1) without the argument checks. This copies the
+    # private Random._randbelow() of CPython (_randbelow_with_getrandbits()
+    # in Python 3.11), which randint() calls, so that modules draw the
+    # same random bits as grammars. test_engines.py checks that the two
+    # still agree.
+    k = n.bit_length()
+    r = _getrandbits(k)
+    while r >= n:
+        r = _getrandbits(k)
+    return r
+
+
+def _random_string(min_value, num_chars, minlen, maxlen):
+    length = _randint(minlen, maxlen)
+    return ''.join([chr(min_value + int(_random() * num_chars))
+                    for _ in range(length)])
+
+
+def _expand_inlined(function, levels, context, depth, force):
+    """Expands a symbol that replaced a chain of inlined symbols."""
+    try:
+        return function(context, depth, force)
+    except GrammarRecursionError as e:
+        if force:
+            raise
+        error = e
+    for _ in range(levels + 1):
+        try:
+            return function(context, depth, True)
+        except GrammarRecursionError as e:
+            error = e
+    raise GrammarRecursionError(error)
+
+
+def _add_variable(var_name, var_type, context):
+    variables = context['variables']
+    journal = context.get('journal')
+    for var_type in _VARIABLE_TYPES.get(var_type, (var_type,)):
+        if var_type not in variables:
+            variables[var_type] = []
+            if var_type in _INTERESTING_LINES:
+                interesting_lines = context['interesting_lines']
+                interesting_line_set = context['interesting_line_set']
+                for line in _INTERESTING_LINES[var_type]:
+                    if line not in interesting_line_set:
+                        interesting_line_set.add(line)
+                        interesting_lines.append(line)
+        variables[var_type].append(var_name)
+        if journal is not None:
+            journal.append(var_type)
+
+
+def _save_point(context):
+    return (len(context['lines']), len(context['interesting_lines']),
+            len(context['journal']), context['lastvar'],
+            context['force_var_reuse'])
+
+
+def _roll_back(context, save_point):
+    (num_lines, num_interesting_lines, journal_size, context['lastvar'],
+     context['force_var_reuse']) = save_point
+    del context['lines'][num_lines:]
+    interesting_lines = context['interesting_lines']
+    context['interesting_line_set'].difference_update(
+        interesting_lines[num_interesting_lines:])
+    del interesting_lines[num_interesting_lines:]
+    variables = context['variables']
+    journal = context['journal']
+    while len(journal) > journal_size:
+        entry = journal.pop()
+        if isinstance(entry, tuple):
+            cache, expansion, evicted = entry
+            cache.undo_add(expansion, evicted)
+            continue
+        names = variables[entry]
+        names.pop()
+        if not names:
+            del variables[entry]
+
+
+def _generate_code(num_lines, initial_variables=[], last_var=0):
+    """Generates a given number of lines of code."""
+
+    context = {
+        'lastvar': last_var,
+        'lines': [],
+        'variables': {},
+        'interesting_lines': [],
+        'interesting_line_set': set(),
+        'force_var_reuse': False,
+        'journal': []
+    }
+
+    for v in initial_variables:
+        _add_variable(v['name'], v['type'], context)
+    _add_variable('document', 'Document', context)
+    _add_variable('window', 'Window', context)
+
+    while len(context['lines']) < num_lines:
+        save_point = _save_point(context)
+        try:
+            if (_random() < %(interesting_line_prob)r) and (len(context['interesting_lines']) > 0):
+                context['force_var_reuse'] = True
+                lineno = _choice(context['interesting_lines'])
+            elif _LINE_ALIAS_TABLE is None:
+                lineno = _choice(_ALL_NONHELPER_LINES)
+            else:
+                lineno = _alias_index(_LINE_ALIAS_TABLE)
+            _LINE_RULES[lineno](context, 0, False)
+        except GrammarRecursionError as e:
+            print('Warning: ' + str(e))
+            _roll_back(context, save_point)
+    if not _LINE_GUARD:
+        guarded_lines = context['lines']
+    else:
+        guarded_lines = [line.join(_LINE_GUARD)
+                         for line in context['lines']]
+    return '\\n'.join(guarded_lines)
+
+
+def generate_symbol(name):
+    """Expands a symbol whose name is given as an argument."""
+    context = {
+        'lastvar': 0,
+        'lines': [],
+        'variables': {},
+        'force_var_reuse': False
+    }
+    if name not in _SYMBOLS:
+        raise GrammarError('No creators for type ' + name)
+    return _SYMBOLS[name](context, 0, False)
+
+
+def generate_root():
+    """Expands root symbol."""
+    if _ROOT:
+        return generate_symbol(_ROOT)
+    else:
+        print('Error: No root element defined.')
+        return ''
+
+
+def cache_stats():
+    """Returns statistics of the expansion caches."""
+    return dict((name, cache.stats()) for name, cache in _CACHES.items())
+'''
+
+
+def _randint(a, b):
+    """Returns an expression equivalent to random.randint(a, b).
+
+    random.randint(a, b) returns a + random._randbelow(b - a + 1), the
+    generated module calls its own copy of _randbelow() directly.
+    """
+    if a > b:
+        return '_randint(%d, %d)' % (a, b)
+    if a == 0:
+        return '_randbelow(%d)' % (b + 1)
+    return '%d + _randbelow(%d)' % (a, b - a + 1)
+
+
+def _concat(expressions):
+    """Returns an expression concatenating the given string expressions."""
+    if not expressions:
+        return "''"
+    if len(expressions) == 1:
+        return expressions[0]
+    if len(expressions) > _MAX_CONCATENATED_PARTS:
+        return "''.join((" + ', '.join(expressions) + ',))'
+    return ' + '.join(expressions)
+
+
+class _Expression(object):
+    """Collects the parts of a string expression, merging literals."""
+
+    def __init__(self):
+        self.parts = []
+        self._literal = None
+
+    def add_literal(self, text):
+        if self._literal is None:
+            self._literal = text
+        else:
+            self._literal += text
+
+    def add(self, expression):
+        self._flush()
+        self.parts.append(expression)
+
+    def _flush(self):
+        if self._literal is not None:
+            self.parts.append(repr(self._literal))
+            self._literal = None
+
+    def code(self, strings_only=True):
+        self._flush()
+        if strings_only:
+            return _concat(self.parts)
+        return "''.join((" + ', '.join(self.parts) + ',))'
+
+
+class _GrammarCompiler(object):
+    """Translates the lowered rules of a grammar into Python source.
+
+    Every symbol becomes a function that checks for reusable variables
+    and the recursion depth and then calls the function of the selected
+    rule. Rules become functions that expand their operations in order,
+    with the built-in types, tag ids and variable bookkeeping resolved
+    while compiling. Symbols with a single rule have it inlined.
+    """
+
+    def __init__(self, grammar):
+        self._grammar = grammar
+        self._lines = []
+        self._tags = {}
+        self._tag_lines = []
+        self._generators = {}
+        self._rule_names = {}
+        self._rule_lines = []
+
+    def _tag(self, tag):
+        """Returns the name of a module-level copy of the tag."""
+        name = self._tags.get(id(tag))
+        if name is None:
+            name = '_T%d' % len(self._tags)
+            self._tags[id(tag)] = name
+            self._tag_lines.append('%s = %r' % (name, tag))
+        return name
+
+    def _generator(self, tag):
+        """Returns the name of a module-level generator for a built-in tag.
+
+        See Grammar._specialize_built_in().
+        """
+        name = self._generators.get(id(tag))
+        if name is None:
+            name = '_G%d' % len(self._generators)
+            self._generators[id(tag)] = name
+            self._tag_lines.append('%s = _runtime._specialize_built_in(%s)' %
+                                   (name, self._tag(tag)))
+        return name
+
+    def _symbol_function(self, symbol_id):
+        return '_s%d' % symbol_id
+
+    def _recursion_error(self, symbol_id):
+        return 'raise GrammarRecursionError(%r)' % (
+            'Maximum recursion level reached while creating object of '
+            'type' + self._grammar._symbol_names[symbol_id])
+
+    def _builtin(self, tag):
+        """Returns (expression, is_string) for a built-in type.
+
+        The attributes were already checked when the grammar was loaded.
+        """
+        name = self._grammar._built_in_types[tag['tagname']].__name__
+        expression = None
+        if name == '_int_generator' and 'b' not in tag and 'be' not in tag:
+            expression = self._int_builtin(tag)
+        elif name == '_float_generator' and 'b' not in tag:
+            expression = self._float_builtin(tag)
+        elif name == '_char_generator':
+            expression = self._char_builtin(tag)
+        elif name == '_string_generator':
+            expression = self._string_builtin(tag)
+        elif name == '_html_string_generator':
+            expression = '_escape(%s, quote=True)' % (
+                self._string_builtin(tag))
+        elif name == '_hex_generator':
+            expression = "'%%%s' %% _randbelow(16)" % (
+                'X' if 'up' in tag else 'x')
+        elif name == '_import_generator':
+            expression = self._import_builtin(tag)
+        elif name == '_lines_generator':
+            expression = self._lines_builtin(tag)
+        if expression is not None:
+            return expression, True
+        return '%s()' % self._generator(tag), False
+
+    def _int_builtin(self, tag):
+        min_value, max_value = _INT_RANGES[tag['tagname']]
+        if 'min' in tag:
+            min_value = int(tag['min'], 0)
+        if 'max' in tag:
+            max_value = int(tag['max'], 0)
+        return 'str(%s)' % _randint(min_value, max_value)
+
+    def _float_builtin(self, tag):
+        min_value = float(tag.get('min', '0'))
+        max_value = float(tag.get('max', '1'))
+        span = max_value - min_value
+        if not all(math.isfinite(f) for f in (min_value, span)):
+            return None
+        return 'str(%r + _random() * %r)' % (min_value, span)
+
+    def _char_builtin(self, tag):
+        if 'code' in tag:
+            return repr(chr(int(tag['code'], 0)))
+        min_value = int(tag.get('min', '0'), 0)
+        max_value = int(tag.get('max', '255'), 0)
+        return 'chr(%s)' % _randint(min_value, max_value)
+
+    def _string_builtin(self, tag):
+        min_value = int(tag.get('min', '0'), 0)
+        max_value = int(tag.get('max', '255'), 0)
+        minlen = int(tag.get('minlength', '0'), 0)
+        maxlen = int(tag.get('maxlength', '20'), 0)
+        return '_random_string(%d, %d, %d, %d)' % (
+            min_value, max_value - min_value + 1, minlen, maxlen)
+
+    def _import_builtin(self, tag):
+        return '_import(%r, %r)' % (tag['from'], tag.get('symbol'))
+
+    def _lines_builtin(self, tag):
+        return '_generate_code(%d)' % int(tag['count'], 0)
+
+    def _rule_body(self, symbol_id, rule):
+        """Returns the lines of a function body that expands a rule."""
+        grammar = self._grammar
+        is_code, ops = rule
+        body = []
+        expression = _Expression()
+        strings_only = True
+        variable_ids = {}
+        new_vars = []
+        ret_vars = []
+
+        for i, (opcode, arg, tag) in enumerate(ops):
+            if opcode == _OP_TEXT:
+                expression.add_literal(arg)
+                continue
+
+            if tag is not None and 'id' in tag:
+                if tag['id'] in variable_ids:
+                    expression.add(variable_ids[tag['id']])
+                    continue
+
+            local = 'p%d' % i
+            is_string = True
+            if opcode == _OP_SYMBOL:
+                function = self._symbol_function(arg)
+                body.extend([
+                    'try:',
+                    '    %s = %s(context, depth + 1, force)' % (local,
+                                                               function),
+                    'except GrammarRecursionError:',
+                    '    if force:',
+                    '        raise',
+                    '    %s = %s(context, depth + 1, True)' % (local,
+                                                              function),
+                ])
+            elif opcode == _OP_INLINED_TEXT:
+                text, levels, inlined_id = arg
+                body.append('if depth >= %d:' %
+                            (grammar._recursion_max - levels))
+                body.append('    ' + self._recursion_error(inlined_id))
+                if tag is None or ('id' not in tag and
+                                   'beforeoutput' not in tag):
+                    expression.add_literal(text)
+                    continue
+                body.append('%s = %r' % (local, text))
+            elif opcode == _OP_INLINED_SYMBOL:
+                target, levels = arg
+                body.append(
+                    '%s = _expand_inlined(%s, %d, context, depth + %d, '
+                    'force)' % (local, self._symbol_function(target), levels,
+                                levels + 1))
+            elif opcode == _OP_BUILTIN:
+                code, is_string = self._builtin(tag)
+                body.append('%s = %s' % (local, code))
+            elif opcode == _OP_NEW:
+                var_name = 'n%d' % i
+                body.extend([
+                    "lastvar = context['lastvar'] + 1",
+                    "context['lastvar'] = lastvar",
+                    '%s = %r %% lastvar' % (var_name, grammar._var_format),
+                    "%s = '/* newvar{' + %s + %r + %s" % (
+                        local, var_name, ':' + arg + '} */ var ', var_name),
+                ])
+                new_vars.append((var_name, arg))
+                if arg == grammar._symbol_names[symbol_id]:
+                    ret_vars.append(var_name)
+            elif opcode == _OP_CONSTANT:
+                body.append('%s = %r' % (local, arg))
+            else:
+                if 'function' not in tag:
+                    body.append("raise GrammarError('Call tag without a "
+                                "function attribute')")
+                    return body
+                body.append('%s = _exec_function(%r, %s, context, %r)' % (
+                    local, tag['function'], self._tag(tag), ''))
+                is_string = False
+
+            if tag is not None:
+                if 'id' in tag:
+                    variable_ids[tag['id']] = local
+
+                if 'beforeoutput' in tag:
+                    body.append('q%d = _exec_function(%r, %s, context, %s)' % (
+                        i, tag['beforeoutput'], self._tag(tag), local))
+                    local = 'q%d' % i
+                    is_string = False
+
+            expression.add(local)
+            strings_only = strings_only and is_string
+
+        if not is_code:
+            body.append('return ' + expression.code(strings_only))
+            return body
+
+        body.append('line = ' + expression.code(strings_only))
+        body.append("lines = context['lines']")
+        body.append('lines.append(line)')
+        for var_name, var_type in new_vars:
+            if var_type in _NONINTERESTING_TYPES:
+                continue
+            body.append('_add_variable(%s, %r, context)' % (var_name,
+                                                            var_type))
+            body.append('lines.append(%s)' % self._variable_line(var_name,
+                                                                 var_type))
+        if symbol_id == grammar._line_id:
+            body.append('return line')
+        else:
+            body.append('return (%s)[%s]' % (
+                ''.join(v + ', ' for v in ret_vars),
+                _randint(0, len(ret_vars) - 1)))
+        return body
+
+    def _variable_types(self, var_type):
+        """Returns the types a variable is added as, see _add_variable()."""
+        return self._grammar._variable_ancestors.get(var_type, (var_type,))
+
+    def _variable_line(self, var_name, var_type):
+        """Returns an expression for the line that registers a variable."""
+        expression = _Expression()
+        expression.add_literal('if (!')
+        expression.add(var_name)
+        expression.add_literal(') { ')
+        expression.add(var_name)
+        expression.add_literal(" = GetVariable(fuzzervars, '" + var_type +
+                               "'); } else { ")
+        for setter_type in self._variable_types(var_type):
+            expression.add_literal('SetVariable(fuzzervars, ')
+            expression.add(var_name)
+            expression.add_literal(", '" + setter_type + "'); ")
+        expression.add_literal(' }')
+        return expression.code()
+
+    def _rule_function(self, symbol_id, rule):
+        """Returns the name of a function that expands the rule."""
+        body = tuple(self._rule_body(symbol_id, rule))
+        name = self._rule_names.get(body)
+        if name is None:
+            name = '_r%d' % len(self._rule_names)
+            self._rule_names[body] = name
+            self._rule_lines.append('')
+            self._rule_lines.append('')
+            self._rule_lines.append('def %s(context, depth, force):' % name)
+            self._rule_lines.extend('    ' + line for line in body)
+        return name
+
+    def _selection(self, symbol_id, creators, alias_table, suffix):
+        """Returns the lines that select and expand a rule."""
+        if len(creators) == 1 and alias_table is None:
+            # Only one rule, expand it in place.
+            return ([_randint(0, 0)] +
+                    self._rule_body(symbol_id, creators[0]))
+        table = '_R%d%s' % (symbol_id, suffix)
+        functions = [self._rule_function(symbol_id, rule)
+                     for rule in creators]
+        self._lines.append('%s = (%s)' % (
+            table, ''.join(f + ', ' for f in functions)))
+        if alias_table is None:
+            index = _randint(0, len(creators) - 1)
+        else:
+            alias_name = '_A%d%s' % (symbol_id, suffix)
+            self._lines.append('%s = %r' % (
+                alias_name, tuple(tuple(items) for items in alias_table)))
+            index = '_alias_index(%s)' % alias_name
+        return ['return %s[%s](context, depth, force)' % (table, index)]
+
+    def _restricted_selection(self, symbol_id):
+        """Returns the lines that select a rule near the recursion limit.
+
+        The creators that fit at every depth where not all of them do are
+        taken from Grammar._restrict_creators(), and depths with the same
+        creators share a selection.
+        """
+        grammar = self._grammar
+        recursion_max = grammar._recursion_max
+        no_fit_depth = recursion_max - grammar._lowered_min_depths[symbol_id]
+        limit = recursion_max - grammar._lowered_max_depths[symbol_id]
+        lines = [
+            'if depth > %d:' % limit,
+            '    if depth > %d:' % no_fit_depth,
+            '        ' + self._recursion_error(symbol_id),
+        ]
+        groups = []
+        for depth in range(no_fit_depth, max(limit, -1), -1):
+            creators, alias_table = grammar._restrict_creators(symbol_id,
+                                                               depth)
+            if (groups and groups[-1][1] == creators and
+                    groups[-1][2] == alias_table):
+                groups[-1][0] = depth
+            else:
+                groups.append([depth, creators, alias_table])
+        for depth, creators, alias_table in groups:
+            lines.append('    if depth >= %d:' % depth)
+            lines.extend('        ' + line for line in self._selection(
+                symbol_id, creators, alias_table, 'd%d' % depth))
+        return lines
+
+    def _pool_selection(self, symbol_id):
+        """Returns the lines that sample a finite symbol from its pool.
+
+        See Grammar._sample_pool().
+        """
+        grammar = self._grammar
+        pool = grammar._lowered_pools[symbol_id]
+        alias_table = grammar._lowered_pool_alias_tables[symbol_id]
+        symbols = grammar._lowered_pool_symbols[symbol_id]
+        self._lines.append('_P%d = %r' % (symbol_id, tuple(pool)))
+        if alias_table is None:
+            index = _randint(0, len(pool) - 1)
+        else:
+            self._lines.append('_PA%d = %r' % (
+                symbol_id, tuple(tuple(items) for items in alias_table)))
+            index = '_alias_index(_PA%d)' % symbol_id
+        condition = 'depth <= %d' % (
+            grammar._recursion_max - grammar._lowered_pool_depths[symbol_id])
+        if symbols is not None:
+            self._lines.append('_PV%d = frozenset(%r)' % (
+                symbol_id, tuple(sorted(symbols))))
+            condition += (" and context['variables'].keys().isdisjoint("
+                          "_PV%d)" % symbol_id)
+        return [
+            'if %s:' % condition,
+            '    return _P%d[%s]' % (symbol_id, index),
+        ]
+
+    def _symbol_body(self, symbol_id):
+        grammar = self._grammar
+        name = grammar._symbol_names[symbol_id]
+        body = ['# ' + repr(name)]
+
+        if grammar._reusable_symbols[symbol_id]:
+            body.extend([
+                "variables = context['variables'].get(%r)" % name,
+                'if variables is not None and (',
+                "        context['force_var_reuse'] or",
+                '        _random() < %r or' % grammar._var_reuse_prob,
+                '        len(variables) > %d):' %
+                grammar._max_vars_of_same_type,
+                "    context['force_var_reuse'] = False",
+                '    return variables[_randbelow(len(variables))]',
+            ])
+
+        creators = grammar._lowered_creators[symbol_id]
+        if creators is None:
+            body.append('raise GrammarError(%r)' %
+                        ('No creators for type ' + name))
+            return body
+
+        cache = grammar._lowered_caches[symbol_id]
+        if cache is not None:
+            # Expand the symbol in a separate function on a cache miss.
+            self._lines.append('_C%d = _ExpansionCache(%d, %r)' % (
+                symbol_id, grammar._cache_settings[name][0],
+                grammar._cache_settings[name][1]))
+            expansion = self._expansion(symbol_id)
+            self._rule_lines.append('')
+            self._rule_lines.append('')
+            self._rule_lines.append('def _u%d(context, depth, force):' %
+                                    symbol_id)
+            self._rule_lines.extend('    ' + line for line in expansion)
+            body.extend([
+                'expanded = _C%d.get(depth)' % symbol_id,
+                'if expanded is None:',
+                '    expanded = _u%d(context, depth, force)' % symbol_id,
+                "    _C%d.add(expanded, depth, context.get('journal'))" %
+                symbol_id,
+                'return expanded',
+            ])
+            return body
+
+        body.extend(self._expansion(symbol_id))
+        return body
+
+    def _expansion(self, symbol_id):
+        """Returns the lines that expand a defined symbol."""
+        grammar = self._grammar
+        body = []
+        if grammar._lowered_pools[symbol_id] is not None:
+            body.extend(self._pool_selection(symbol_id))
+
+        body.extend(self._restricted_selection(symbol_id))
+
+        nonrecursive = grammar._lowered_nonrecursive[symbol_id]
+        if nonrecursive is not None:
+            body.append('if force:')
+            body.extend('    ' + line for line in self._selection(
+                symbol_id, nonrecursive,
+                grammar._lowered_nonrecursive_alias_tables[symbol_id], 'n'))
+        body.extend(self._selection(
+            symbol_id, grammar._lowered_creators[symbol_id],
+            grammar._lowered_alias_tables[symbol_id], ''))
+        return body
+
+    def compile(self, source_name):
+        grammar = self._grammar
+        settings = {'interesting_line_prob': grammar._interesting_line_prob}
+
+        symbol_lines = []
+        for symbol_id in range(len(grammar._symbol_names)):
+            symbol_lines.append('')
+            symbol_lines.append('')
+            symbol_lines.append('def %s(context, depth, force):' %
+                                self._symbol_function(symbol_id))
+            symbol_lines.extend('    ' + line
+                                for line in self._symbol_body(symbol_id))
+
+        line_alias_table = None
+        if grammar._line_id is None:
+            line_rules = []
+        else:
+            line_alias_table = grammar._lowered_alias_tables[grammar._line_id]
+            line_rules = [
+                self._rule_function(grammar._line_id, rule)
+                for rule in grammar._lowered_creators[grammar._line_id]]
+
+        functions = ''.join(
+            '    %r: compile(%r, %r, %r),\n' % (name, source, name, 'exec')
+            for name, source in sorted(grammar._function_sources.items()))
+        interesting_lines = dict(
+            (var_type, tuple(lines))
+            for var_type, lines in grammar._interesting_lines.items())
+        variable_types = {}
+        for var_type in grammar._inheritance:
+            variable_types[var_type] = tuple(self._variable_types(var_type))
+        symbols = ''.join(
+            '    %r: %s,\n' % (name, self._symbol_function(symbol_id))
+            for symbol_id, name in enumerate(grammar._symbol_names))
+
+        line_guard = ()
+        if grammar._line_guard:
+            line_guard = tuple(grammar._line_guard.split('<line>'))
+
+        out = [
+            '# Generated by grammar_compiler.py from %s, do not edit.' %
+            source_name,
+            '',
+            _RUNTIME % settings,
+            '',
+            '_ROOT = %r' % grammar._root,
+            '_LINE_GUARD = %r' % (line_guard,),
+            '_ALL_NONHELPER_LINES = %r' % (grammar._all_nonhelper_lines,),
+            '_LINE_ALIAS_TABLE = %r' % (line_alias_table,),
+            '_INTERESTING_LINES = %r' % (interesting_lines,),
+            '_VARIABLE_TYPES = %r' % (variable_types,),
+            '_FUNCTIONS = {\n%s}' % functions,
+        ]
+        out.extend(self._tag_lines)
+        out.extend(self._rule_lines)
+        out.extend(symbol_lines)
+        out.append('')
+        out.append('')
+        out.extend(self._lines)
+        out.append('_LINE_RULES = (%s)' % ''.join(f + ', '
+                                                   for f in line_rules))
+        out.append('_SYMBOLS = {\n%s}' % symbols)
+        out.append('_CACHES = {\n%s}' % ''.join(
+            '    %r: _C%d,\n' % (name, symbol_id)
+            for symbol_id, name in enumerate(grammar._symbol_names)
+            if grammar._lowered_caches[symbol_id] is not None))
+        return '\n'.join(out) + '\n'
+
+
+def compile_grammar(grammar, source_name='a grammar'):
+    """Translates a finalized grammar into the source of a Python module.
+
+    The module generates the same output as the grammar, given the same
+    random state, but without interpreting the rules. It provides
+    generate_root(), generate_symbol(), add_import(), cache_stats() and
+    _generate_code(), so it can be used in place of the grammar once
+    loaded with load_grammar_module(). Imports are not compiled into the
+    module and need to be added with add_import().
+
+    Generated modules expand symbols with recursive calls, so grammars
+    that set !max_recursion above 250 (_MAX_RECURSIVE_DEPTH), which need
+    the explicit-stack engine of Grammar, can't be compiled.
+
+    Args:
+        grammar: The grammar to compile, optimized or not.
+        source_name: Name of the grammar mentioned in the module header.
+
+    Returns:
+        The source of the module.
+
+    Raises:
+        GrammarError: If the recursion depth of the grammar is too large.
+    """
+    if grammar._recursion_max > _MAX_RECURSIVE_DEPTH:
+        raise GrammarError(
+            'Can\'t compile %s, its maximum recursion depth %d is larger '
+            'than %d' % (source_name, grammar._recursion_max,
+                         _MAX_RECURSIVE_DEPTH))
+    return _GrammarCompiler(grammar).compile(source_name)
+
+
+def write_grammar_module(grammar, filename):
+    """Compiles a grammar into a Python module saved as filename."""
+    if grammar._root_files:
+        source_name = os.path.basename(grammar._root_files[0])
+    else:
+        source_name = 'a grammar'
+    source = compile_grammar(grammar, source_name)
+    with open(filename, 'w') as f:
+        f.write(source)
+
+
+def load_grammar_module(filename):
+    """Imports a module written by write_grammar_module().
+
+    Returns:
+        The module, which can be used like a Grammar for generation.
+    """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    spec = importlib.util.spec_from_file_location(name, filename)
+    if spec is None:
+        raise GrammarError('Can not load grammar module ' + filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,159 @@
+#   Domato - grammar tools
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from __future__ import print_function
+import argparse
+import os
+import sys
+
+from grammar import Grammar, GrammarError, registry
+from grammar_analyzer import analyze_grammar, print_report
+from grammar_compiler import write_grammar_module
+
+
+def load_grammar(args):
+    """Loads the grammar given on the command line, with its imports."""
+    grammar = Grammar()
+    for name_and_path in args.imports:
+        if '=' not in name_and_path:
+            raise GrammarError('Imports should be given as name=path')
+        name, path = name_and_path.split('=', 1)
+        grammar.add_import(name, registry.get_grammar(path))
+    if grammar.parse_from_file(args.grammar):
+        raise GrammarError('There were errors parsing ' + args.grammar)
+    return grammar
+
+
+def extract(args):
+    """Writes a grammar pruned to the rules needed for given symbols."""
+    grammar = load_grammar(args)
+    pruned = grammar.extract(args.symbols)
+    print('Kept %d of %d rules' % (len(pruned._all_rules),
+                                    len(grammar._all_rules)))
+    if not args.text:
+        pruned.save_compiled(args.output)
+        return
+    out_dir = os.path.dirname(args.output)
+    with open(args.output, 'w') as f:
+        f.write(pruned.to_string())
+    for name, subgrammar in pruned._imports.items():
+        with open(os.path.join(out_dir, name), 'w') as f:
+            f.write(subgrammar.to_string())
+
+
+def image(args):
+    """Writes a grammar image that can be mapped with load_image()."""
+    load_grammar(args).save_image(args.output)
+
+
+def compile_module(args):
+    """Writes a Python module that generates samples like the grammar."""
+    grammar = load_grammar(args)
+    if args.optimize:
+        grammar.optimize()
+    write_grammar_module(grammar, args.output)
+
+
+def analyze(args):
+    """Reports undefined, unreachable and nonterminating symbols."""
+    grammar = load_grammar(args)
+    print_report(analyze_grammar(grammar, args.symbols), args.verbose)
+
+
+def add_grammar_arguments(parser):
+    parser.add_argument('grammar', help='Root grammar file')
+    parser.add_argument('-i', '--import', dest='imports', action='append',
+                        default=[], metavar='NAME=PATH',
+                        help='Grammar to make available to <import> tags '
+                             'under the given name (like add_import)')
+
+
+def get_argument_parser():
+
+    parser = argparse.ArgumentParser(description="DOMATO grammar tools")
+    subparsers = parser.add_subparsers(dest='command')
+
+    extract_parser = subparsers.add_parser(
+        'extract',
+        help='Write a grammar with only the rules reachable from the '
+             'given symbols')
+    add_grammar_arguments(extract_parser)
+    extract_parser.add_argument('-s', '--symbol', dest='symbols',
+                                action='append', default=[],
+                                help='Start symbol, can be repeated '
+                                     '(defaults to the root symbol)')
+    extract_parser.add_argument('-o', '--output', required=True,
+                                help='Output file')
+    extract_parser.add_argument('-t', '--text', action='store_true',
+                                help='Write grammar source instead of a '
+                                     'compiled grammar. Imported grammars '
+                                     'are written next to it, named after '
+                                     'the import.')
+    extract_parser.set_defaults(func=extract)
+
+    image_parser = subparsers.add_parser(
+        'image',
+        help='Write a grammar image that generator processes can map and '
+             'share')
+    add_grammar_arguments(image_parser)
+    image_parser.add_argument('-o', '--output', required=True,
+                              help='Output file')
+    image_parser.set_defaults(func=image)
+
+    compile_parser = subparsers.add_parser(
+        'compile',
+        help='Compile a grammar into a Python module that can be used in '
+             'place of the grammar for generation')
+    add_grammar_arguments(compile_parser)
+    compile_parser.add_argument('-o', '--output', required=True,
+                                help='Output file')
+    compile_parser.add_argument('--optimize', action='store_true',
+                                help='Optimize the grammar before compiling')
+    compile_parser.set_defaults(func=compile_module)
+
+    analyze_parser = subparsers.add_parser(
+        'analyze',
+        help='Report undefined, unreachable and nonterminating symbols and '
+             'the expected expansion size of every symbol')
+    add_grammar_arguments(analyze_parser)
+    analyze_parser.add_argument('-s', '--symbol', dest='symbols',
+                                action='append', default=[],
+                                help='Additional start symbol, can be '
+                                     'repeated')
+    analyze_parser.add_argument('-v', '--verbose', action='store_true',
+                                help='Print the minimum depth and expected '
+                                     'size of every symbol')
+    analyze_parser.set_defaults(func=analyze)
+
+    return parser
+
+
+def main():
+    parser = get_argument_parser()
+    args = parser.parse_args()
+    if not args.command:
+        parser.print_help()
+        return
+    try:
+        args.func(args)
+    except GrammarError as e:
+        print(str(e))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,14 +17,17 @@ import re
 import random
 import sys
 
-from grammar import Grammar
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.append(parent_dir)
+from grammar import Grammar, registry
 
-cssgrammar = Grammar()
-err = cssgrammar.parse_from_file('css.txt')
+# css.txt and mathml.txt both include common.txt, the registry makes sure
+# it is only parsed once.
+cssgrammar = registry.get_grammar(os.path.join(parent_dir, 'rules', 'css.txt'))
 
 htmlgrammar = Grammar()
 htmlgrammar.add_import('cssgrammar', cssgrammar)
-htmlgrammar.parse_from_file('mathml.txt')
+htmlgrammar.parse_from_file(os.path.join(os.path.dirname(__file__), 'mathml.txt'))
 
 # result_string = htmlgrammar .generate_symbol('svgelement_svg')
 # just math, without svg
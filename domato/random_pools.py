@@ -0,0 +1,117 @@
+#   Domato - random pools
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+from __future__ import print_function
+import random
+
+import numpy
+
+# Number of values drawn for a pool the first time it is used. Every
+# refill draws twice as many as the previous one, up to the batch size,
+# so that the many rarely used ranges of a grammar stay small.
+_INITIAL_BATCH_SIZE = 64
+
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+_UINT64_MAX = 2 ** 64 - 1
+_MAX_CODE_POINT = 0x10ffff
+
+
+class RandomPools(object):
+    """Random values for the built-in types, drawn with NumPy in batches.
+
+    Values are drawn from a NumPy generator into a separate pool for every
+    range (and for strings, every character range) and handed out one by
+    one, so generating a value costs a list pop instead of a call into
+    the random module. The values follow the same distributions as the
+    ones drawn by Grammar, but they don't depend on the state of the
+    random module.
+    """
+
+    def __init__(self, seed=None, batch_size=4096):
+        """Creates empty pools.
+
+        Args:
+            seed: Seed of the NumPy generator, None for a random one.
+            batch_size: Largest number of values drawn at once for a
+                single pool.
+        """
+        self._generator = numpy.random.default_rng(seed)
+        # For the rare ranges NumPy can't draw from.
+        self._random = random.Random(int(self._generator.integers(2 ** 63)))
+        self._batch_size = batch_size
+        self._integers = {}
+        self._floats = []
+        self._chars = {}
+        self._next_sizes = {}
+
+    def _next_size(self, key, needed=1):
+        size = self._next_sizes.get(key, _INITIAL_BATCH_SIZE)
+        self._next_sizes[key] = min(size * 2, self._batch_size)
+        return max(size, needed)
+
+    def integer(self, min_value, max_value):
+        """Returns a random integer N such that min_value <= N <= max_value.
+
+        Ranges that don't fit into 64-bit integers are drawn one at a
+        time.
+        """
+        key = (min_value, max_value)
+        values = self._integers.get(key)
+        if values:
+            return values.pop()
+        if min_value >= _INT64_MIN and max_value <= _INT64_MAX:
+            dtype = numpy.int64
+        elif min_value >= 0 and max_value <= _UINT64_MAX:
+            dtype = numpy.uint64
+        else:
+            return self._random.randint(min_value, max_value)
+        values = self._generator.integers(
+            min_value, max_value, size=self._next_size(key), endpoint=True,
+            dtype=dtype).tolist()
+        self._integers[key] = values
+        return values.pop()
+
+    def random(self):
+        """Returns a random float in [0, 1)."""
+        if not self._floats:
+            self._floats = self._generator.random(
+                self._next_size(None)).tolist()
+        return self._floats.pop()
+
+    def string(self, min_value, max_value, length):
+        """Returns a string of random characters from a code point range.
+
+        Characters are drawn into a string per range, which strings are
+        then sliced from.
+        """
+        if min_value < 0 or max_value > _MAX_CODE_POINT:
+            # Let chr() report invalid code points like Grammar does.
+            return ''.join([chr(self.integer(min_value, max_value))
+                            for _ in range(length)])
+        key = (min_value, max_value)
+        chars, pos = self._chars.get(key, ('', 0))
+        if pos + length > len(chars):
+            codes = self._generator.integers(
+                min_value, max_value,
+                size=self._next_size(('chars',) + key, length),
+                endpoint=True, dtype=numpy.uint32)
+            chars = codes.astype('<u4', copy=False).tobytes().decode(
+                'utf-32-le', 'surrogatepass')
+            pos = 0
+        self._chars[key] = (chars, pos + length)
+        return chars[pos:pos + length]
@@ -0,0 +1,138 @@
+#   Domato - test configuration
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+import random
+import sys
+
+import pytest
+
+DOMATO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DOMATO_DIR)
+
+import grammar  # noqa: E402
+
+# The grammars shipped with Domato, with the symbol generator scripts
+# generate from them (None for lines of code).
+_SHIPPED_GRAMMARS = {
+    'css': ('rules/css.txt', 'rules'),
+    'html': ('rules/html.txt', 'bodyelements'),
+    'js': ('rules/js.txt', None),
+    'mathml': ('mathml/mathml.txt', 'mathelement_math'),
+    'canvas': ('canvas/canvas.txt', None),
+    'webgl': ('webgl/webgl.txt', None),
+    'php': ('php/php.txt', None),
+    'jscript': ('jscript/jscript.txt', None),
+    'vbscript': ('vbscript/vbscript.txt', None)
+}
+# Grammars that use the CSS grammar through <import from=cssgrammar>.
+_CSS_IMPORTERS = ('html', 'js', 'mathml')
+
+
+@pytest.fixture(autouse=True)
+def clear_registry():
+    """Keeps grammars and fragments from leaking between tests."""
+    grammar.registry.clear()
+    yield
+    grammar.registry.clear()
+
+
+@pytest.fixture
+def grammar_path():
+    """Returns the path of a grammar shipped with Domato."""
+    def path(name):
+        return os.path.join(DOMATO_DIR, name)
+    return path
+
+
+def _write_file(path, content, mtime=None):
+    path = str(path)
+    if mtime is None and os.path.exists(path):
+        # Changes must be noticed even within the timestamp resolution of
+        # the file system.
+        mtime = os.path.getmtime(path) + 10
+    with open(path, 'w') as f:
+        f.write(content)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def write_file():
+    """Returns a function that writes a text file.
+
+    The function takes the path, the content and optionally the
+    modification time of the file. By default a file that already exists
+    gets a newer modification time than it had.
+    """
+    return _write_file
+
+
+def _link_shipped_grammars(grammars):
+    for name in _CSS_IMPORTERS:
+        grammars[name].add_import('cssgrammar', grammars['css'])
+    return grammars
+
+
+def _generate_shipped_samples(grammars, seed=1, count=1):
+    random.seed(seed)
+    samples = {}
+    for name in sorted(grammars):
+        symbol = _SHIPPED_GRAMMARS[name][1]
+        for _ in range(count):
+            if symbol:
+                sample = grammars[name].generate_symbol(symbol)
+            else:
+                sample = grammars[name]._generate_code(
+                    100, [{'name': 'htmlvar00001', 'type': 'HTMLDivElement'}])
+            samples.setdefault(name, []).append(sample)
+    return samples
+
+
+@pytest.fixture(scope='session')
+def shipped_grammars():
+    """Parses every shipped grammar once per session.
+
+    Returns:
+        A function that returns a dictionary mapping grammar names to new
+        generators made from the shipped grammars with convert(name,
+        grammar), by default the grammars themselves. Grammars that import
+        the CSS grammar get the converted CSS grammar as import.
+    """
+    parsed = {}
+    for name, (path, _) in _SHIPPED_GRAMMARS.items():
+        g = grammar.Grammar()
+        assert g.parse_from_file(os.path.join(DOMATO_DIR, path)) == 0
+        parsed[name] = g
+    grammar.registry.clear()
+
+    def convert_all(convert=None):
+        if convert is None:
+            return _link_shipped_grammars(dict(parsed))
+        return _link_shipped_grammars(dict(
+            (name, convert(name, g)) for name, g in parsed.items()))
+    return convert_all
+
+
+@pytest.fixture
+def generate_samples():
+    """Returns a function that generates seeded samples like generator.py.
+
+    The function takes a dictionary returned by shipped_grammars(), and
+    returns a dictionary mapping grammar names to lists of samples.
+    """
+    return _generate_shipped_samples
@@ -0,0 +1,108 @@
+#   Domato - alias table tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import collections
+import random
+
+import pytest
+
+import grammar
+from grammar import Grammar
+
+
+def _probabilities(table):
+    """Returns the exact probability of drawing each index of a table."""
+    thresholds, aliases = table
+    n = len(thresholds)
+    probabilities = [0.0] * n
+    for column, threshold in enumerate(thresholds):
+        own = threshold - column
+        assert 0 <= own <= 1
+        probabilities[column] += own / n
+        probabilities[aliases[column]] += (1 - own) / n
+    return probabilities
+
+
+@pytest.mark.parametrize('weights', [
+    [1],
+    [1, 1, 1],
+    [0.1, 0.2, 0.7],
+    [5, 0, 1, 0, 2],
+    [1e-9, 1, 1e-9],
+    [0.3] * 10,
+])
+def test_alias_table_probabilities(weights):
+    total = float(sum(weights))
+    assert (_probabilities(grammar._alias_table(weights)) ==
+            pytest.approx([w / total for w in weights]))
+
+
+def test_alias_table_without_weight():
+    assert grammar._alias_table([0, 0]) is None
+
+
+def test_alias_index_frequencies():
+    table = grammar._alias_table([0.5, 0.3, 0.2, 0])
+    random.seed(1)
+    counts = collections.Counter(grammar._alias_index(table)
+                                 for _ in range(20000))
+    assert counts[3] == 0
+    for index, p in enumerate([0.5, 0.3, 0.2]):
+        assert abs(counts[index] / 20000.0 - p) < 0.015
+
+
+def test_symbol_alias_tables_match_probabilities(grammar_path):
+    g = Grammar()
+    assert g.parse_from_file(grammar_path('rules/css.txt')) == 0
+    for tables, cdfs in ((g._lowered_alias_tables, g._lowered_cdfs),
+                         (g._lowered_nonrecursive_alias_tables,
+                          g._lowered_nonrecursive_cdfs)):
+        for table, cdf in zip(tables, cdfs):
+            if not cdf:
+                assert table is None
+                continue
+            assert (_probabilities(table) ==
+                    pytest.approx(grammar._cdf_probabilities(cdf)))
+
+
+_LINES = """
+!begin lines
+<line p=0.5>f();
+<x>();
+<line p=0.1>g();
+h();
+!end lines
+<x> = x
+"""
+
+
+def test_line_probabilities():
+    g = Grammar()
+    assert g.parse_from_string(_LINES) == 0
+    table = g._lowered_alias_tables[g._line_id]
+    assert _probabilities(table) == pytest.approx([0.5, 0.2, 0.1, 0.2])
+    random.seed(1)
+    counts = collections.Counter(g._generate_code(20000).split('\n'))
+    for line, p in (('f();', 0.5), ('x();', 0.2), ('g();', 0.1)):
+        assert abs(counts[line] / 20000.0 - p) < 0.015
+
+
+def test_lines_without_probabilities_are_uniform():
+    g = Grammar()
+    assert g.parse_from_string(
+        _LINES.replace('<line p=0.5>', '').replace('<line p=0.1>', '')) == 0
+    assert g._lowered_alias_tables[g._line_id] is None
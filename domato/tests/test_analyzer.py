@@ -0,0 +1,83 @@
+#   Domato - grammar analyzer tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import io
+
+import pytest
+
+from grammar import Grammar
+from grammar_analyzer import analyze_grammar, expected_sizes, print_report
+
+_GRAMMAR = """
+<a> = <b><int min=0 max=9><b>
+<a> = <c>
+<b> = x
+<c> = <c><c>
+<c> = y<undefined>
+<d> = z
+"""
+
+
+def _parse(source):
+    g = Grammar()
+    assert g.parse_from_string(source) == 0
+    return g
+
+
+def test_unreachable_symbols_from_root_and_start_symbols():
+    g = _parse('<root root=true> = <a>\n' + _GRAMMAR)
+    report = analyze_grammar(g)
+    assert report['unreachable'] == ['d']
+    assert analyze_grammar(g, ['d'])['unreachable'] == []
+
+
+def test_unreachable_symbols_are_not_checked_without_start_symbols():
+    g = _parse(_GRAMMAR)
+    report = analyze_grammar(g)
+    assert report['unreachable'] is None
+    assert report['undefined'] == ['undefined']
+    out = io.StringIO()
+    print_report(report, out=out)
+    assert 'Unreachable symbols: not checked' in out.getvalue()
+    assert analyze_grammar(g, ['a'])['unreachable'] == ['d']
+
+
+def test_expected_sizes_count_symbols_only():
+    g = _parse(_GRAMMAR)
+    sizes, supercritical = expected_sizes(g)
+    # Built-in symbols aren't counted, symbols without creators count once.
+    assert sizes['b'] == 1.0
+    assert sizes['d'] == 1.0
+    # c = 1 + 0.5 * 2c + 0.5 * 1 diverges, with a growth rate of 1.
+    assert sizes['c'] == float('inf')
+    assert supercritical['c'] == pytest.approx(1.0)
+    assert sizes['a'] == float('inf')
+    assert 'a' not in supercritical
+
+
+def test_expected_sizes_follow_probabilities():
+    g = _parse("""
+<a> = <b><b><int>
+<a p=0.75> = x
+<b> = <b>y
+<b p=0.9> = y
+""")
+    sizes, supercritical = expected_sizes(g)
+    # b = 1 + 0.1 * b, a = 1 + 0.25 * 2b.
+    assert sizes['b'] == pytest.approx(1 / 0.9)
+    assert sizes['a'] == pytest.approx(1 + 0.5 / 0.9)
+    assert not supercritical
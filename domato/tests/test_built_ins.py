@@ -0,0 +1,104 @@
+#   Domato - built-in symbol tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import random
+import struct
+
+import pytest
+
+from grammar import Grammar
+
+
+def _string(min_value, max_value, minlen, maxlen):
+    length = random.randint(minlen, maxlen)
+    return ''.join(chr(min_value + int(random.random() *
+                                       (max_value - min_value + 1)))
+                   for _ in range(length))
+
+
+# Built-in tags and how they used to be generated from the random module.
+_BUILT_INS = [
+    ('<int>', lambda: str(random.randint(-2147483648, 2147483647))),
+    ('<uint8>', lambda: str(random.randint(0, 255))),
+    ('<int64 min=-5 max=0x10>', lambda: str(random.randint(-5, 16))),
+    ('<float>', lambda: str(random.random())),
+    ('<double min=-1 max=3>', lambda: str(-1 + random.random() * 4)),
+    ('<char>', lambda: chr(random.randint(0, 255))),
+    ('<char min=65 max=90>', lambda: chr(random.randint(65, 90))),
+    ('<char code=0x41>', lambda: 'A'),
+    ('<string>', lambda: _string(0, 255, 0, 20)),
+    ('<string min=97 max=122 minlength=2 maxlength=4>',
+     lambda: _string(97, 122, 2, 4)),
+    ('<hex>', lambda: '%x' % random.randint(0, 15)),
+    ('<hex up>', lambda: '%X' % random.randint(0, 15)),
+]
+
+
+@pytest.mark.parametrize('tag, reference', _BUILT_INS)
+def test_built_ins_draw_like_before(tag, reference):
+    g = Grammar()
+    assert g.parse_from_string('<root root=true> = ' + tag) == 0
+    random.seed(1)
+    outputs = [g.generate_root() for _ in range(50)]
+    random.seed(1)
+    expected = []
+    for _ in range(50):
+        # Selecting the only rule of the root symbol.
+        random.randint(0, 0)
+        expected.append(reference())
+    assert outputs == expected
+
+
+def test_html_safe_strings():
+    g = Grammar()
+    assert g.parse_from_string(
+        '<root root=true> = <htmlsafestring min=60 max=60 minlength=3 '
+        'maxlength=3>') == 0
+    assert g.generate_root() == '&lt;&lt;&lt;'
+
+
+def test_binary_integers_and_floats():
+    g = Grammar()
+    for tag, expected in (
+            ('<uint16 be min=258 max=258>', b'\x01\x02'),
+            ('<uint16 b min=258 max=258>', b'\x02\x01'),
+            ('<int8 b min=-1 max=-1>', b'\xff'),
+            ('<double b min=1 max=1>', struct.pack('d', 1.0)),
+            ('<float b min=2 max=2>', struct.pack('f', 2.0))):
+        assert g._specialize_built_in(g._parse_tag_and_attributes(
+            tag[1:-1]))() == expected
+
+
+def test_invalid_attributes_are_parse_errors(capsys):
+    g = Grammar()
+    assert g.include_from_string("""
+<root root=true> = <a>
+<a> = <int min=5 max=1>
+<a> = <int min=x>
+<a> = <string minlength=3 maxlength=1>
+<a> = <char min=9 max=1>
+<a> = <float min=2 max=1>
+<a> = <import>
+<a> = ok
+""") == 6
+    out = capsys.readouterr().out
+    assert out.count('Error parsing line') == 6
+    assert '<string>:3: Range error in integer tag' in out
+    assert 'Invalid attribute in int tag' in out
+    # The other lines are kept.
+    g.finalize()
+    assert g.generate_root() == 'ok'
@@ -0,0 +1,224 @@
+#   Domato - grammar cache tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+import random
+import shutil
+
+import grammar
+from grammar import Grammar
+
+
+def _generate(g, symbol, count=5, seed=1):
+    random.seed(seed)
+    return [g.generate_symbol(symbol) for _ in range(count)]
+
+
+def test_cached_load_does_not_lower(tmp_path, monkeypatch, grammar_path):
+    path = grammar_path('rules/css.txt')
+    fresh = Grammar()
+    assert fresh.parse_from_file(path, str(tmp_path)) == 0
+
+    def lower(self):
+        raise AssertionError('the cached grammar was lowered again')
+
+    monkeypatch.setattr(Grammar, '_lower', lower)
+    grammar.registry.clear()
+    cached = Grammar()
+    assert cached.parse_from_file(path, str(tmp_path)) == 0
+
+    assert cached._symbol_names == fresh._symbol_names
+    assert cached._lowered_min_depths == fresh._lowered_min_depths
+    assert cached._lowered_max_depths == fresh._lowered_max_depths
+    assert cached._lowered_pools == fresh._lowered_pools
+    # Built-in types get their specialized generators back.
+    for creators in cached._lowered_creators:
+        for _, ops in creators or ():
+            for opcode, arg, _ in ops:
+                if opcode == grammar._OP_BUILTIN:
+                    assert callable(arg)
+    assert _generate(cached, 'rules') == _generate(fresh, 'rules')
+
+
+_ROOT = """
+<root root=true> = <common><import from=other.txt>
+!include common.txt
+!import other.txt
+"""
+
+
+def _load_cached(path, cache_dir):
+    grammar.registry.clear()
+    g = Grammar()
+    assert g.parse_from_file(str(path), str(cache_dir)) == 0
+    return g
+
+
+def _count_parses(monkeypatch):
+    parsed = []
+    parse_fragment = Grammar._parse_fragment
+
+    def count(self, content, path):
+        parsed.append(os.path.basename(path))
+        return parse_fragment(self, content, path)
+
+    monkeypatch.setattr(Grammar, '_parse_fragment', count)
+    return parsed
+
+
+def test_cache_is_invalidated_by_changed_sources(tmp_path, monkeypatch,
+                                                 write_file):
+    root = tmp_path / 'root.txt'
+    write_file(root, _ROOT)
+    write_file(tmp_path / 'common.txt', '<common> = a\n')
+    write_file(tmp_path / 'other.txt', '<other root=true> = b\n')
+    cache_dir = tmp_path / 'cache'
+    assert _load_cached(root, cache_dir).generate_root() == 'ab'
+    parsed = _count_parses(monkeypatch)
+
+    assert _load_cached(root, cache_dir).generate_root() == 'ab'
+    assert parsed == []
+
+    # Only the content matters, not the modification time.
+    os.utime(str(tmp_path / 'common.txt'), (1, 1))
+    assert _load_cached(root, cache_dir).generate_root() == 'ab'
+    assert parsed == []
+
+    write_file(tmp_path / 'common.txt', '<common> = c\n')
+    assert _load_cached(root, cache_dir).generate_root() == 'cb'
+    assert sorted(parsed) == ['common.txt', 'other.txt', 'root.txt']
+    del parsed[:]
+    assert _load_cached(root, cache_dir).generate_root() == 'cb'
+    assert parsed == []
+
+    # Imported grammars are sources too.
+    write_file(tmp_path / 'other.txt', '<other root=true> = d\n')
+    assert _load_cached(root, cache_dir).generate_root() == 'cd'
+    assert 'other.txt' in parsed
+
+
+def test_cache_entries_are_per_root_file(tmp_path, monkeypatch, write_file):
+    write_file(tmp_path / 'a.txt', '<root root=true> = a\n')
+    write_file(tmp_path / 'b.txt', '<root root=true> = b\n')
+    cache_dir = tmp_path / 'cache'
+    assert _load_cached(tmp_path / 'a.txt', cache_dir).generate_root() == 'a'
+    assert _load_cached(tmp_path / 'b.txt', cache_dir).generate_root() == 'b'
+    assert len(os.listdir(str(cache_dir))) == 2
+    parsed = _count_parses(monkeypatch)
+    assert _load_cached(tmp_path / 'a.txt', cache_dir).generate_root() == 'a'
+    assert parsed == []
+
+
+def test_unusable_cache_entries_are_misses(tmp_path, monkeypatch, write_file):
+    root = tmp_path / 'root.txt'
+    write_file(root, '<root root=true> = a\n')
+    cache_dir = tmp_path / 'cache'
+    _load_cached(root, cache_dir)
+    entry, = [os.path.join(str(cache_dir), name)
+              for name in os.listdir(str(cache_dir))]
+    parsed = _count_parses(monkeypatch)
+
+    monkeypatch.setattr(grammar, '_CACHE_VERSION', grammar._CACHE_VERSION + 1)
+    assert _load_cached(root, cache_dir).generate_root() == 'a'
+    assert parsed == ['root.txt']
+
+    write_file(entry, 'garbage')
+    assert _load_cached(root, cache_dir).generate_root() == 'a'
+    assert parsed == ['root.txt', 'root.txt']
+    # The broken entry was replaced.
+    assert _load_cached(root, cache_dir).generate_root() == 'a'
+    assert parsed == ['root.txt', 'root.txt']
+
+
+def test_cached_load_keeps_added_imports(tmp_path, write_file):
+    root = tmp_path / 'root.txt'
+    write_file(root, '<root root=true> = <import from=extra>\n')
+    extra = Grammar()
+    assert extra.parse_from_string('<e root=true> = x') == 0
+    for _ in range(2):
+        grammar.registry.clear()
+        g = Grammar()
+        g.add_import('extra', extra)
+        assert g.parse_from_file(str(root), str(tmp_path / 'cache')) == 0
+        assert g.generate_root() == 'x'
+
+
+_CONFIGURED = """
+!cache item 2 0.5
+<root root=true> = <item><other>
+<item> = <int>
+<other> = <int>
+<other> = <float>
+"""
+
+
+def _load_configured(path, cache_dir):
+    grammar.registry.clear()
+    g = Grammar()
+    g.cache_symbol('other', 3, 0)
+    g.use_explicit_stack()
+    g.optimize()
+    assert g.parse_from_file(str(path), str(cache_dir)) == 0
+    return g
+
+
+def test_cached_load_keeps_configuration(tmp_path, write_file):
+    root = tmp_path / 'root.txt'
+    write_file(root, _CONFIGURED)
+    cache_dir = tmp_path / 'cache'
+    parsed = Grammar()
+    assert parsed.parse_from_string(_CONFIGURED) == 0
+    for _ in range(2):
+        # The first load builds the cache entry, the second one uses it.
+        g = _load_configured(root, cache_dir)
+        assert g._explicit_stack
+        assert g._optimized
+        assert g._cache_settings == {'item': (2, 0.5), 'other': (3, 0)}
+        assert sorted(g.cache_stats()) == ['item', 'other']
+    # The configuration doesn't end up in the cache entry.
+    plain = _load_cached(root, cache_dir)
+    assert not plain._explicit_stack
+    assert not plain._optimized
+    assert plain._cache_settings == {'item': (2, 0.5)}
+    assert sorted(plain.cache_stats()) == ['item']
+    parsed.cache_symbol('other', 3, 0)
+    parsed.use_explicit_stack()
+    parsed.optimize()
+    g = _load_configured(root, cache_dir)
+    random.seed(1)
+    expected = [parsed.generate_root() for _ in range(20)]
+    random.seed(1)
+    assert [g.generate_root() for _ in range(20)] == expected
+
+
+def test_cached_shipped_grammar_sees_common_changes(tmp_path, grammar_path):
+    rules = tmp_path / 'rules'
+    shutil.copytree(grammar_path('rules'), str(rules))
+    cache_dir = tmp_path / 'cache'
+    cold = _load_cached(rules / 'html.txt', cache_dir)
+    assert 'cachetestsymbol' not in cold._creators
+    with open(str(rules / 'common.txt'), 'a') as f:
+        f.write('\n<cachetestsymbol> = cachetest\n')
+    changed = _load_cached(rules / 'html.txt', cache_dir)
+    assert changed.generate_symbol('cachetestsymbol') == 'cachetest'
+    cached = _load_cached(rules / 'html.txt', cache_dir)
+    assert cached.generate_symbol('cachetestsymbol') == 'cachetest'
+    css = grammar.registry.get_grammar(str(rules / 'css.txt'))
+    cached.add_import('cssgrammar', css)
+    changed.add_import('cssgrammar', css)
+    assert (_generate(cached, 'bodyelements', 2) ==
+            _generate(changed, 'bodyelements', 2))
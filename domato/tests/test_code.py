@@ -0,0 +1,320 @@
+#   Domato - code generation tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import copy
+import pickle
+import random
+import re
+
+from grammar import Grammar
+from grammar_compiler import load_grammar_module, write_grammar_module
+
+
+# Lines that use <Qux> always fail, after adding a helper line and its
+# variable to the context and expanding <a>.
+_FAILING_GRAMMAR = """
+!max_recursion 6
+<a> = <b>
+<a> = y
+<b> = <b>x
+!begin helperlines
+<new Baz> = new Baz();
+!end helperlines
+!begin lines
+<new Foo> = new Foo();
+<new Bar> = f(<Baz>, <a>);
+<Foo>.g(<Bar>);
+<new Qux> = h(<Baz>, <a>, <b>);
+<Qux>.i();
+!end lines
+"""
+
+
+def _grammar(source):
+    g = Grammar()
+    assert g.parse_from_string(source) == 0
+    return g
+
+
+def _js_grammar(grammar_path):
+    """Parses the shipped JavaScript grammar, importing the CSS grammar."""
+    css = Grammar()
+    assert css.parse_from_file(grammar_path('rules/css.txt')) == 0
+    g = Grammar()
+    assert g.parse_from_file(grammar_path('rules/js.txt')) == 0
+    g.add_import('cssgrammar', css)
+    return g
+
+
+def _checked_roll_backs(g):
+    """Makes _roll_back() check that it restores the saved context."""
+    snapshots = []
+    roll_backs = []
+    save_point = g._save_point
+    roll_back = g._roll_back
+
+    def checked_save_point(context):
+        snapshots.append(copy.deepcopy(context))
+        return save_point(context)
+
+    def checked_roll_back(context, point):
+        roll_back(context, point)
+        assert context == snapshots[-1]
+        roll_backs.append(point)
+
+    g._save_point = checked_save_point
+    g._roll_back = checked_roll_back
+    return roll_backs
+
+
+def test_failed_lines_are_rolled_back(capsys):
+    g = _grammar(_FAILING_GRAMMAR)
+    roll_backs = _checked_roll_backs(g)
+    for seed in range(20):
+        random.seed(seed)
+        code = g._generate_code(20)
+        assert 'Qux' not in code
+        defined = set(['document', 'window'])
+        for line in code.split('\n'):
+            created = re.match(r'/\* newvar\{(var\d+):', line)
+            used = set(re.findall(r'var\d+', line))
+            if created:
+                used.discard(created.group(1))
+                defined.add(created.group(1))
+            assert used <= defined
+        # Variable numbers taken by failed lines are given out again.
+        numbers = sorted(int(name[3:]) for name in defined
+                         if name.startswith('var'))
+        assert numbers == list(range(1, len(numbers) + 1))
+    assert roll_backs
+    assert 'Maximum recursion level' in capsys.readouterr().out
+
+
+def test_failed_lines_remove_their_cache_additions(tmp_path, capsys):
+    # The cache never fills up, so every <a> is added to it, but only the
+    # ones in f() lines are kept.
+    g = _grammar('!cache a 1000 0\n' + _FAILING_GRAMMAR)
+    explicit = pickle.loads(pickle.dumps(g))
+    explicit.use_explicit_stack()
+    path = str(tmp_path / 'failing_grammar.py')
+    write_grammar_module(g, path)
+    module = load_grammar_module(path)
+    for generator, cache in (
+            (g, g._lowered_caches[g._symbol_ids['a']]),
+            (explicit, explicit._lowered_caches[g._symbol_ids['a']]),
+            (module, module._CACHES['a'])):
+        random.seed(1)
+        code = generator._generate_code(50)
+        assert len(cache._expansions) == code.count('f(')
+        assert cache.lookups > len(cache._expansions)
+    assert 'Maximum recursion level' in capsys.readouterr().out
+
+
+def test_roll_back_removes_variables_of_ancestor_types():
+    g = _grammar("""
+!extends Child Parent
+<new Parent> = new Parent();
+!begin lines
+<Parent>.f();
+!end lines
+""")
+    context = {
+        'lastvar': 0,
+        'lines': ['first'],
+        'variables': {},
+        'interesting_lines': [],
+        'interesting_line_set': set(),
+        'force_var_reuse': False,
+        'journal': []
+    }
+    g._add_variable('a', 'Parent', context)
+    expected = copy.deepcopy(context)
+    save_point = g._save_point(context)
+    g._add_variable('b', 'Child', context)
+    g._add_variable('c', 'Other', context)
+    context['lines'].append('second')
+    context['lastvar'] = 2
+    context['force_var_reuse'] = True
+    assert context['variables'] == {
+        'Parent': ['a', 'b'], 'Child': ['b'], 'Other': ['c']}
+    g._roll_back(context, save_point)
+    assert context == expected
+
+
+def _check_interesting_lines(g, context):
+    interesting_lines = context['interesting_lines']
+    assert len(interesting_lines) == len(set(interesting_lines))
+    assert context['interesting_line_set'] == set(interesting_lines)
+    expected = set()
+    for var_type in context['variables']:
+        expected.update(g._interesting_lines.get(var_type, ()))
+    assert context['interesting_line_set'] == expected
+
+
+def _checked_interesting_lines(g):
+    """Makes _save_point() and _roll_back() check the interesting lines."""
+    save_point = g._save_point
+    roll_back = g._roll_back
+
+    def checked_save_point(context):
+        _check_interesting_lines(g, context)
+        return save_point(context)
+
+    def checked_roll_back(context, point):
+        roll_back(context, point)
+        _check_interesting_lines(g, context)
+
+    g._save_point = checked_save_point
+    g._roll_back = checked_roll_back
+
+
+def test_interesting_lines_of_types():
+    g = _grammar("""
+!begin lines
+<new Foo> = new Foo();
+<Foo>.f(<Foo>);
+<Bar>.g(<Foo>);
+<new Bar> = <Foo>.h();
+!end lines
+""")
+    assert g._interesting_lines == {'Foo': [1, 2, 3], 'Bar': [2]}
+
+
+def test_interesting_lines_are_added_in_order():
+    g = _grammar(_FAILING_GRAMMAR)
+    context = {
+        'variables': {},
+        'interesting_lines': [],
+        'interesting_line_set': set()
+    }
+    g._add_variable('a', 'Baz', context)
+    g._add_variable('b', 'Foo', context)
+    g._add_variable('c', 'Foo', context)
+    assert context['interesting_lines'] == [1, 3, 2]
+
+
+def test_interesting_lines_match_the_variables(capsys):
+    g = _grammar(_FAILING_GRAMMAR)
+    _checked_interesting_lines(g)
+    for seed in range(20):
+        random.seed(seed)
+        g._generate_code(20)
+    assert 'Maximum recursion level' in capsys.readouterr().out
+
+
+def test_interesting_lines_of_shipped_grammar(grammar_path):
+    g = _js_grammar(grammar_path)
+    _checked_interesting_lines(g)
+    random.seed(1)
+    g._generate_code(100, [{'name': 'htmlvar00001',
+                            'type': 'HTMLDivElement'}])
+
+
+def _old_ancestors(g, var_type):
+    """Walks !extends the way _add_variable() used to for every variable."""
+    types = [var_type]
+    for parent_type in g._inheritance.get(var_type, ()):
+        types.extend(_old_ancestors(g, parent_type))
+    return types
+
+
+def test_variable_ancestors():
+    g = _grammar("""
+!extends Child Parent
+!extends Child Mixin
+!extends Parent Base
+!extends Mixin Base
+!extends Loop Cycle
+!extends Cycle Loop
+<new Child> = new Child();
+""")
+    assert g._variable_ancestors['Child'] == (
+        'Child', 'Parent', 'Base', 'Mixin', 'Base')
+    assert g._variable_ancestors['Parent'] == ('Parent', 'Base')
+    assert g._variable_ancestors['Loop'] == ('Loop', 'Cycle')
+    assert g._variable_ancestors['Cycle'] == ('Cycle', 'Loop')
+    assert 'Base' not in g._variable_ancestors
+    context = {
+        'variables': {},
+        'interesting_lines': [],
+        'interesting_line_set': set()
+    }
+    g._add_variable('a', 'Child', context)
+    g._add_variable('b', 'Base', context)
+    g._add_variable('c', 'Loop', context)
+    assert context['variables'] == {
+        'Child': ['a'], 'Parent': ['a'], 'Mixin': ['a'],
+        'Base': ['a', 'a', 'b'], 'Loop': ['c'], 'Cycle': ['c']}
+
+
+def test_variable_ancestors_of_shipped_grammar(tmp_path, grammar_path):
+    g = _js_grammar(grammar_path)
+    assert g._variable_ancestors
+    for var_type in g._inheritance:
+        assert list(g._variable_ancestors[var_type]) == _old_ancestors(
+            g, var_type)
+    path = str(tmp_path / 'js.image')
+    g.save_image(path)
+    image = Grammar()
+    image.load_image(path)
+    copied = pickle.loads(pickle.dumps(g))
+    assert image._variable_ancestors == g._variable_ancestors
+    assert copied._variable_ancestors == g._variable_ancestors
+
+
+def _old_setter_line(g, var_name, var_type):
+    """Builds a variable registration line the way it used to be built."""
+    setters = ''.join(
+        "SetVariable(fuzzervars, %s, '%s'); " % (var_name, ancestor)
+        for ancestor in _old_ancestors(g, var_type))
+    return ("if (!" + var_name + ") { " + var_name +
+            " = GetVariable(fuzzervars, '" + var_type + "'); } else { " +
+            setters + " }")
+
+
+def test_setter_templates_of_shipped_grammar(grammar_path):
+    g = _js_grammar(grammar_path)
+    var_types = g._variable_types()
+    assert set(var_types) <= set(g._setter_templates)
+    for var_type in var_types:
+        assert 'var00001'.join(g._setter_templates[var_type]) == (
+            _old_setter_line(g, 'var00001', var_type))
+
+
+def test_setter_templates_of_new_types():
+    g = _grammar('!extends Child Parent\n<new Child> = new Child();\n')
+    assert 'Unknown' not in g._setter_templates
+    template = g._setter_template('Unknown')
+    assert g._setter_templates['Unknown'] is template
+    assert 'v'.join(template) == _old_setter_line(g, 'v', 'Unknown')
+    assert 'v'.join(g._setter_templates['Child']) == (
+        _old_setter_line(g, 'v', 'Child'))
+
+
+def test_generated_setter_lines(tmp_path):
+    g = _grammar(_FAILING_GRAMMAR)
+    path = str(tmp_path / 'grammar.image')
+    g.save_image(path)
+    image = Grammar()
+    image.load_image(path)
+    for generator in (g, image):
+        random.seed(1)
+        lines = generator._generate_code(20).split('\n')
+        for line, next_line in zip(lines, lines[1:]):
+            created = re.match(r'/\* newvar\{(var\d+):(\w+)\}', line)
+            if created:
+                assert next_line == _old_setter_line(g, *created.groups())
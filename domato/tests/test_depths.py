@@ -0,0 +1,177 @@
+#   Domato - recursion depth tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import random
+
+import pytest
+
+import grammar
+from grammar import Grammar
+
+_GRAMMAR = """
+<root root=true> = <a>
+<a> = x
+<a> = <b>
+<b> = <c><a>
+<c> = y
+<loop> = <loop>
+<broken> = <a><loop>
+<broken> = z
+"""
+
+
+def _depths(g, depths):
+    return dict((symbol, depths[g._symbol_ids[symbol]])
+                for symbol in ('root', 'a', 'b', 'c', 'loop', 'broken'))
+
+
+def test_min_and_max_depths():
+    g = Grammar()
+    assert g.parse_from_string(_GRAMMAR) == 0
+    unbounded = grammar._UNBOUNDED_DEPTH
+    assert _depths(g, g._lowered_min_depths) == {
+        'root': 2, 'a': 1, 'b': 2, 'c': 1, 'loop': unbounded, 'broken': 1}
+    assert _depths(g, g._lowered_max_depths) == {
+        'root': 2, 'a': 3, 'b': 2, 'c': 1, 'loop': unbounded,
+        'broken': unbounded}
+
+
+def test_analyzer_min_depths_skip_nonterminating_symbols():
+    g = Grammar()
+    assert g.parse_from_string(_GRAMMAR) == 0
+    assert g._compute_min_depths() == {
+        'root': 2, 'a': 1, 'b': 2, 'c': 1, 'broken': 1}
+
+
+def test_max_depths_match_rule_depths(grammar_path):
+    for optimize in (False, True):
+        g = Grammar()
+        assert g.parse_from_file(grammar_path('rules/css.txt')) == 0
+        if optimize:
+            g.optimize()
+        for creators, max_depth in zip(g._lowered_creators,
+                                       g._lowered_max_depths):
+            if creators is None:
+                assert max_depth == grammar._UNBOUNDED_DEPTH
+            else:
+                assert max_depth == max(g._rule_depth(rule)
+                                        for rule in creators)
+
+
+_SELECTION_GRAMMAR = """
+!max_recursion 6
+<root root=true> = <s>
+<s> = <s><t>
+<s p=0.1> = <t><t>
+<s nonrecursive p=0.1> = z
+<t> = <u>
+<t p=0.2> = y
+<u> = x
+"""
+
+
+def _restricted(g, symbol, depth):
+    """Returns the restricted creators as rule sources, and probabilities."""
+    creators, alias_table = g._restrict_creators(g._symbol_ids[symbol],
+                                                 depth)
+    if creators is None:
+        return None
+    sources = []
+    for _, ops in creators:
+        sources.append(''.join(
+            arg if opcode == grammar._OP_TEXT else '<%s>' % tag['tagname']
+            for opcode, arg, tag in ops))
+    if alias_table is None:
+        return sources, None
+    return sources, _alias_probabilities(alias_table)
+
+
+def _alias_probabilities(alias_table):
+    thresholds, aliases = alias_table
+    n = len(thresholds)
+    probabilities = [0.0] * n
+    for i, threshold in enumerate(thresholds):
+        p = threshold - i
+        probabilities[i] += p / n
+        probabilities[aliases[i]] += (1 - p) / n
+    return probabilities
+
+
+def test_creators_are_restricted_near_the_maximum_depth():
+    g = Grammar()
+    assert g.parse_from_string(_SELECTION_GRAMMAR) == 0
+    # Everything fits, the nonrecursive creator isn't preferred.
+    sources, probabilities = _restricted(g, 's', 4)
+    assert sources == ['<s><t>', '<t><t>', 'z']
+    assert probabilities == pytest.approx([0.8, 0.1, 0.1])
+    assert _restricted(g, 's', 5) == (['z'], [1.0])
+    sources, probabilities = _restricted(g, 't', 4)
+    assert sources == ['<u>', 'y']
+    assert probabilities == pytest.approx([0.8, 0.2])
+    assert _restricted(g, 't', 5) == (['y'], [1.0])
+    assert _restricted(g, 't', 6) is None
+    assert _restricted(g, 'u', 6) is None
+
+
+_PARTIAL_GRAMMAR = """
+!max_recursion 6
+<root root=true> = <a>
+<a> = <a>x
+<a p=0.2> = <b>
+<a nonrecursive p=0.1> = z
+<b> = <c>
+<c> = y
+"""
+
+
+def test_only_creators_that_dont_fit_are_left_out():
+    g = Grammar()
+    assert g.parse_from_string(_PARTIAL_GRAMMAR) == 0
+    # <b> needs one level more than <a>x, the recursive creator that
+    # still fits keeps its share next to the nonrecursive one.
+    sources, probabilities = _restricted(g, 'a', 4)
+    assert sources == ['<a>x', 'z']
+    assert probabilities == pytest.approx([0.875, 0.125])
+    assert _restricted(g, 'a', 5) == (['z'], [1.0])
+
+
+def test_restricted_selection_keeps_the_unrestricted_distribution():
+    g = Grammar()
+    assert g.parse_from_string(_PARTIAL_GRAMMAR) == 0
+    symbol_id = g._symbol_ids['a']
+    creators = g._lowered_creators[symbol_id]
+    # Unrestricted at depth 0, restricted at depth 4 where <b> is left out.
+    random.seed(3)
+    unrestricted = [creators.index(g._select_creator(symbol_id, 0, False))
+                    for _ in range(20000)]
+    restricted = [creators.index(g._select_creator(symbol_id, 4, False))
+                  for _ in range(20000)]
+    assert 1 not in restricted
+    fitting = [i for i in unrestricted if i != 1]
+    for i in (0, 2):
+        assert (restricted.count(i) / len(restricted) ==
+                pytest.approx(fitting.count(i) / len(fitting), abs=0.02))
+
+
+def test_generation_never_runs_out_of_depth(capsys):
+    g = Grammar()
+    assert g.parse_from_string(_SELECTION_GRAMMAR) == 0
+    random.seed(1)
+    outputs = set(g.generate_root() for _ in range(2000))
+    assert 'Warning' not in capsys.readouterr().out
+    assert 'z' in outputs and 'xx' in outputs
+    assert max(len(output) for output in outputs) <= 5
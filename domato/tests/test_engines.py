@@ -0,0 +1,270 @@
+#   Domato - generation engine equivalence tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import pickle
+import random
+import struct
+import sys
+
+import pytest
+
+import grammar
+from grammar import Grammar, GrammarError
+from grammar_compiler import load_grammar_module, write_grammar_module
+
+
+def _image(tmp_path):
+    def convert(name, g):
+        path = str(tmp_path / (name + '.image'))
+        g.save_image(path)
+        mapped = Grammar()
+        mapped.load_image(path)
+        return mapped
+    return convert
+
+
+def _compiled(tmp_path):
+    def convert(name, g):
+        path = str(tmp_path / (name + '_grammar.py'))
+        write_grammar_module(g, path)
+        return load_grammar_module(path)
+    return convert
+
+
+def _explicit_stack(name, g):
+    copied = pickle.loads(pickle.dumps(g))
+    copied.use_explicit_stack()
+    return copied
+
+
+def _optimized(name, g):
+    copied = pickle.loads(pickle.dumps(g))
+    copied.optimize()
+    return copied
+
+
+def test_image_generates_like_grammar(tmp_path, shipped_grammars,
+                                      generate_samples):
+    for seed in (1, 2):
+        assert (generate_samples(shipped_grammars(_image(tmp_path)), seed) ==
+                generate_samples(shipped_grammars(), seed))
+
+
+def test_image_with_small_rule_cache(tmp_path, monkeypatch, shipped_grammars,
+                                     generate_samples):
+    monkeypatch.setattr(grammar, '_IMAGE_RULE_CACHE_SIZE', 2)
+    grammars = shipped_grammars()
+    mapped = shipped_grammars(_image(tmp_path))
+    for name in ('css', 'js'):
+        assert (generate_samples({name: mapped[name]}) ==
+                generate_samples({name: grammars[name]}))
+
+
+def test_image_of_small_grammar(tmp_path):
+    g = Grammar()
+    assert g.parse_from_string("""
+!varformat v%d
+!begin function twice
+  ret_val = ret_val * 2
+!end function
+<root root=true> = <a beforeoutput=twice><int min=3 max=3><lines count=2>
+<a> = a
+!begin lines
+<new A> = A();
+<A>.f();
+!end lines
+""") == 0
+    path = str(tmp_path / 'small.image')
+    g.save_image(path)
+    mapped = Grammar()
+    mapped.load_image(path)
+    output = mapped.generate_root()
+    assert output.startswith('aa3')
+    assert 'v1 = A();' in output
+
+
+def test_invalid_images_are_rejected(tmp_path):
+    g = Grammar()
+    assert g.parse_from_string('<root root=true> = a') == 0
+    path = str(tmp_path / 'small.image')
+    g.save_image(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    header = struct.pack(grammar._IMAGE_HEADER_FORMAT, grammar._IMAGE_MAGIC,
+                         grammar._IMAGE_VERSION + 1, 0)
+    with open(path, 'wb') as f:
+        f.write(header + data[len(header):])
+    with pytest.raises(GrammarError, match='Incompatible'):
+        Grammar().load_image(path)
+
+    with open(path, 'wb') as f:
+        f.write(b'NOTANIMAGE' + data[10:])
+    with pytest.raises(GrammarError, match='Incompatible'):
+        Grammar().load_image(path)
+
+    with open(path, 'wb') as f:
+        f.write(data[:4])
+    with pytest.raises(GrammarError, match='Not a grammar image'):
+        Grammar().load_image(path)
+
+
+def test_optimized_image_generates_like_optimized_grammar(
+        tmp_path, shipped_grammars, generate_samples):
+    image = _image(tmp_path)
+    mapped = shipped_grammars(lambda name, g: image(name, _optimized(name, g)))
+    assert (generate_samples(mapped) ==
+            generate_samples(shipped_grammars(_optimized)))
+
+
+def test_compiled_module_generates_like_grammar(
+        tmp_path, shipped_grammars, generate_samples):
+    compiled = shipped_grammars(_compiled(tmp_path))
+    for seed in (1, 2):
+        assert (generate_samples(compiled, seed) ==
+                generate_samples(shipped_grammars(), seed))
+
+
+def test_optimized_compiled_module_generates_like_optimized_grammar(
+        tmp_path, shipped_grammars, generate_samples):
+    compile_module = _compiled(tmp_path)
+    compiled = shipped_grammars(
+        lambda name, g: compile_module(name, _optimized(name, g)))
+    assert (generate_samples(compiled) ==
+            generate_samples(shipped_grammars(_optimized)))
+
+
+def test_compiled_module_of_small_grammar(tmp_path):
+    g = Grammar()
+    assert g.parse_from_string("""
+!begin function twice
+  ret_val = ret_val * 2
+!end function
+<root root=true> = <a beforeoutput=twice><b id=1><b id=1><import from=x>
+<a> = a
+<b> = <int min=0 max=1000000>
+""") == 0
+    path = str(tmp_path / 'small_grammar.py')
+    write_grammar_module(g, path)
+    module = load_grammar_module(path)
+    with pytest.raises(GrammarError, match='unknown import'):
+        module.generate_root()
+    imported = Grammar()
+    assert imported.parse_from_string('<x root=true> = X') == 0
+    module.add_import('x', imported)
+    output = module.generate_root()
+    assert output.startswith('aa') and output.endswith('X')
+    number = output[2:-1]
+    assert number[:len(number) // 2] == number[len(number) // 2:]
+    with pytest.raises(GrammarError):
+        module.generate_symbol('missing')
+
+
+def _compile(tmp_path, source):
+    g = Grammar()
+    assert g.parse_from_string(source) == 0
+    path = str(tmp_path / 'compiled_grammar.py')
+    write_grammar_module(g, path)
+    return g, load_grammar_module(path)
+
+
+def test_compiled_module_keeps_the_builtin_recursion_error(tmp_path):
+    _, module = _compile(tmp_path, '<root root=true> = a')
+    assert 'RecursionError' not in vars(module)
+    assert module.GrammarRecursionError is grammar.RecursionError
+
+
+@pytest.mark.parametrize('n', [1, 2, 3, 7, 8, 9, 256, 1000, 2 ** 31 - 1,
+                               2 ** 32, 2 ** 64 + 3])
+def test_compiled_randbelow_draws_like_randint(tmp_path, n):
+    # Compiled modules copy the private Random._randbelow(). If this fails,
+    # the random module of this Python version draws differently.
+    _, module = _compile(tmp_path, '<root root=true> = a')
+    random.seed(n)
+    expected = [random.randint(0, n - 1) for _ in range(50)]
+    expected.append(random.random())
+    random.seed(n)
+    drawn = [module._randbelow(n) for _ in range(50)]
+    drawn.append(random.random())
+    assert drawn == expected
+
+
+def test_compiled_module_at_the_recursion_limit(tmp_path):
+    source = _DEEP_GRAMMAR % (grammar._MAX_RECURSIVE_DEPTH, '0.000001')
+    g, module = _compile(tmp_path, source)
+    for generator in (g, module):
+        random.seed(1)
+        samples = [generator.generate_root() for _ in range(5)]
+        samples.append(generator._generate_code(5))
+        if generator is g:
+            expected = samples
+    assert samples == expected
+    assert max(len(sample) for sample in samples[:-1]) > 400
+
+
+def test_deep_grammars_are_not_compiled(tmp_path):
+    g = Grammar()
+    assert g.parse_from_string(
+        _DEEP_GRAMMAR % (grammar._MAX_RECURSIVE_DEPTH + 1, '0.01')) == 0
+    with pytest.raises(GrammarError, match='maximum recursion depth'):
+        write_grammar_module(g, str(tmp_path / 'deep_grammar.py'))
+
+
+def test_explicit_stack_generates_like_recursion(shipped_grammars,
+                                                 generate_samples):
+    stack = shipped_grammars(_explicit_stack)
+    for seed in (1, 2):
+        assert (generate_samples(stack, seed) ==
+                generate_samples(shipped_grammars(), seed))
+
+
+_DEEP_GRAMMAR = """
+!max_recursion %d
+<root root=true> = <a>
+<a> = (<a>)
+<a p=%s> = x<int min=0 max=9>
+!begin lines
+<new A> = <a>;
+<A>.f(<a>);
+!end lines
+"""
+
+
+@pytest.mark.parametrize('max_recursion', [5, 100])
+def test_engines_agree_near_the_recursion_limit(capsys, max_recursion):
+    source = _DEEP_GRAMMAR % (max_recursion, '0.01')
+    recursive = Grammar()
+    assert recursive.parse_from_string(source) == 0
+    stack = Grammar()
+    assert stack.parse_from_string(source) == 0
+    stack.use_explicit_stack()
+    for g in (recursive, stack):
+        random.seed(1)
+        samples = [g.generate_root() for _ in range(20)]
+        samples.append(g._generate_code(20))
+        if g is recursive:
+            expected = samples
+    assert samples == expected
+    assert max(len(sample) for sample in samples[:-1]) <= 2 * max_recursion
+
+
+def test_deep_grammars_use_the_explicit_stack():
+    g = Grammar()
+    assert g.parse_from_string(_DEEP_GRAMMAR % (5000, '0.0002')) == 0
+    random.seed(1)
+    lengths = [len(g.generate_root()) for _ in range(5)]
+    assert max(lengths) > 2 * sys.getrecursionlimit()
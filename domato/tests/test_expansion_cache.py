@@ -0,0 +1,197 @@
+#   Domato - expansion cache tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import random
+
+import pytest
+
+import grammar
+from grammar import Grammar, GrammarError
+from grammar_compiler import load_grammar_module, write_grammar_module
+
+
+_GRAMMAR = """
+!cache item %s
+<root root=true> = <item>
+<item> = <int>
+<item> = <item><int>
+"""
+
+_CONTEXT_GRAMMAR = """
+<root root=true> = <item>
+<item> = <new Foo>
+<item> = x
+<Foo> = new Foo()
+!begin lines
+<new Foo> = <Foo>;
+!end lines
+"""
+
+
+def _cached(settings):
+    g = Grammar()
+    assert g.parse_from_string(_GRAMMAR % settings) == 0
+    return g
+
+
+def test_full_cache_without_refresh_repeats_expansions():
+    g = _cached('3 0')
+    random.seed(1)
+    outputs = [g.generate_root() for _ in range(100)]
+    stats = g.cache_stats()['item']
+    # Nested lookups can miss while the cache is still filling up.
+    assert stats['fresh'] < 10
+    assert stats['hits'] == stats['lookups'] - stats['fresh']
+    assert len(set(outputs[10:])) <= 3
+
+
+def test_refresh_probability_one_never_hits():
+    g = _cached('3 1')
+    random.seed(1)
+    for _ in range(50):
+        g.generate_root()
+    stats = g.cache_stats()['item']
+    assert stats['hits'] == 0
+    assert stats['distinct_rate'] == 1.0
+
+
+def test_default_refresh_probability():
+    g = _cached('3')
+    random.seed(1)
+    for _ in range(2000):
+        g.generate_root()
+    stats = g.cache_stats()['item']
+    assert 0.85 < stats['hit_rate'] < 0.95
+
+
+def test_least_recently_used_expansion_is_replaced():
+    cache = grammar._ExpansionCache(2, 0)
+    assert cache.get(0) is None
+    cache.add('a', 0)
+    cache.add('b', 0)
+    random.seed(1)
+    used = cache.get(0)
+    assert used in ('a', 'b')
+    cache.add('c', 0)
+    random.seed(1)
+    assert set(cache.get(0) for _ in range(20)) == set([used, 'c'])
+    assert cache.stats()['max_reuse'] >= 2
+
+
+def test_hits_fit_into_the_remaining_depth():
+    cache = grammar._ExpansionCache(2, 0)
+    cache.add('deep', 5)
+    cache.add('shallow', 1)
+    random.seed(1)
+    assert set(cache.get(1) for _ in range(20)) == set(['deep', 'shallow'])
+    assert set(cache.get(3) for _ in range(20)) == set(['deep'])
+    assert cache.get(6) is None
+
+
+_DEPTH_GRAMMAR = """
+!max_recursion 6
+%s
+<root root=true> = <item>
+<root> = <d1>
+<d1> = <d2>
+<d2> = <d3>
+<d3> = d<item>
+<item> = x
+<item> = <item>x
+"""
+
+
+def test_cached_expansions_respect_the_maximum_depth():
+    # <item> fits two levels below <d3>, so at most xx follows d there,
+    # even when the cache is full of longer expansions from the top.
+    g = Grammar()
+    assert g.parse_from_string(_DEPTH_GRAMMAR % '!cache item 4 0') == 0
+    cache = g._lowered_caches[g._symbol_ids['item']]
+    for _ in range(4):
+        cache.add('xxxxx', 1)
+    random.seed(1)
+    outputs = [g.generate_root() for _ in range(2000)]
+    assert 'xxxxx' in outputs
+    assert max(len(output) for output in outputs
+               if output.startswith('d')) == 3
+
+
+def test_undone_additions_restore_the_cache():
+    cache = grammar._ExpansionCache(2, 0)
+    cache.add('a', 0)
+    cache.add('b', 1)
+    journal = []
+    cache.add('c', 2, journal)
+    cache.add('d', 3, journal)
+    random.seed(1)
+    cache.get(0)
+    for _, expansion, evicted in reversed(journal):
+        cache.undo_add(expansion, evicted)
+    assert sorted(zip(cache._expansions, cache._depths)) == [('a', 0),
+                                                             ('b', 1)]
+
+
+def test_size_zero_stops_caching():
+    g = _cached('3 0')
+    g.cache_symbol('item', 0)
+    assert g.cache_stats() == {}
+    assert '!cache' not in g.to_string()
+
+
+@pytest.mark.parametrize('args', ['', '3 0.5 1', 'x', '3 y', '-1', '3 2'])
+def test_invalid_cache_directives(args):
+    g = Grammar()
+    with pytest.raises(GrammarError):
+        g._set_cache(('item ' + args).strip())
+
+
+def test_context_dependent_symbols_are_not_cached(capsys):
+    g = Grammar()
+    assert g.parse_from_string('!cache item 2\n' + _CONTEXT_GRAMMAR) == 0
+    assert 'Can\'t cache symbol item' in capsys.readouterr().out
+    assert g.cache_stats() == {}
+    with pytest.raises(GrammarError, match='depends on the context'):
+        g.cache_symbol('item')
+    with pytest.raises(GrammarError, match='undefined symbol'):
+        g.cache_symbol('missing')
+
+
+def test_caches_survive_round_trips():
+    g = _cached('3 0.25')
+    assert '!cache item 3 0.25' in g.to_string()
+    assert '!cache item 3 0.25' in g.extract(['item']).to_string()
+    copy = Grammar()
+    assert copy.parse_from_string(g.to_string()) == 0
+    assert list(copy.cache_stats()) == ['item']
+
+
+def test_images_and_modules_keep_caches(tmp_path):
+    path = str(tmp_path / 'grammar.img')
+    _cached('3 0.25').save_image(path)
+    image = Grammar()
+    image.load_image(path)
+    with pytest.raises(GrammarError, match='grammar image'):
+        image.cache_symbol('item', 0)
+    module_path = str(tmp_path / 'grammar_module.py')
+    write_grammar_module(_cached('3 0.25'), module_path)
+    module = load_grammar_module(module_path)
+    outputs = []
+    for g in (_cached('3 0.25'), image, module):
+        random.seed(3)
+        outputs.append([g.generate_root() for _ in range(50)])
+        assert g.cache_stats()['item']['hits'] > 0
+    assert outputs[0] == outputs[1] == outputs[2]
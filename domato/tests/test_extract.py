@@ -0,0 +1,149 @@
+#   Domato - sub-grammar extraction tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+
+import grammar
+from grammar import Grammar
+
+
+def _write_text(g, out_dir, filename, write_file):
+    """Writes a grammar and its imports like grammar_tool.py extract -t."""
+    write_file(os.path.join(str(out_dir), filename), g.to_string())
+    for name, subgrammar in g._imports.items():
+        _write_text(subgrammar, out_dir, name, write_file)
+
+
+def _same_rules(one, two):
+    assert (grammar._rule_keys(one._all_rules) ==
+            grammar._rule_keys(two._all_rules))
+    assert one._creator_cdfs == two._creator_cdfs
+    assert one._inheritance == two._inheritance
+    assert one._root == two._root
+
+
+def test_to_string_round_trip(tmp_path, shipped_grammars, generate_samples,
+                              write_file):
+    grammars = shipped_grammars()
+    reparsed = {}
+    for name, g in grammars.items():
+        out_dir = tmp_path / name
+        out_dir.mkdir()
+        _write_text(g, out_dir, 'root.txt', write_file)
+        reparsed[name] = Grammar()
+        assert reparsed[name].parse_from_file(str(out_dir / 'root.txt')) == 0
+        _same_rules(g, reparsed[name])
+        for import_name, subgrammar in g._imports.items():
+            _same_rules(subgrammar, reparsed[name]._imports[import_name])
+    assert generate_samples(reparsed) == generate_samples(grammars)
+
+
+def test_extract_generates_like_the_full_grammar(shipped_grammars,
+                                                 generate_samples):
+    grammars = shipped_grammars()
+    extracted = {}
+    for name in ('css', 'html', 'mathml'):
+        extracted[name] = grammars[name].extract()
+        assert (len(extracted[name]._all_rules) <
+                len(grammars[name]._all_rules))
+    extracted['html'] = grammars['html'].extract(['bodyelements'])
+    extracted['mathml'] = grammars['mathml'].extract(['mathelement_math'])
+    # The CSS grammar imported by the extracted grammars is pruned too.
+    assert (len(extracted['html']._imports['cssgrammar']._all_rules) <
+            len(grammars['css']._all_rules))
+    full = dict((name, grammars[name]) for name in extracted)
+    assert generate_samples(extracted) == generate_samples(full)
+
+
+_GRAMMAR = """
+!varformat v%d
+!max_recursion 20
+!extends B A
+!extends C A
+!cache slow 4 0.5
+!begin function upper
+  ret_val = ret_val.upper()
+!end function
+<root root=true> = <slow><a><b beforeoutput=upper>
+<slow> = <b><b>
+<a> = a
+<b> = b
+<unused> = <b>
+!begin lines
+<new A> = A();
+<new B> = B(<A>);
+<C>.f();
+!end lines
+!begin helperlines
+<new C> = C();
+<new D> = D();
+!end helperlines
+"""
+
+
+def test_extract_follows_the_start_symbols():
+    g = Grammar()
+    assert g.parse_from_string(_GRAMMAR) == 0
+    pruned = g.extract()
+    assert set(pruned._creators) == set(['root', 'slow', 'a', 'b'])
+    assert pruned._inheritance == {}
+    assert pruned._cache_settings == {'slow': (4, 0.5)}
+    assert pruned.generate_root() == 'bbaB'
+    assert pruned._root == 'root'
+
+    lines = g.extract(['line'])
+    assert set(lines._creators) == set(['line', 'A', 'B', 'C'])
+    assert lines._inheritance == {'B': ['A'], 'C': ['A']}
+    assert lines._var_format == 'v%d'
+    assert lines._recursion_max == 20
+    assert lines._root == 'line'
+
+    b = g.extract(['b'])
+    assert set(b._creators) == set(['b'])
+    assert b._cache_settings == {}
+
+
+def test_extracted_text_can_be_parsed_again(tmp_path):
+    g = Grammar()
+    assert g.parse_from_string(_GRAMMAR) == 0
+    text = g.extract(['root', 'line']).to_string()
+    reparsed = Grammar()
+    assert reparsed.parse_from_string(text) == 0
+    assert reparsed.generate_root() == 'bbaB'
+    assert reparsed._var_format == 'v%d'
+    assert reparsed._cache_settings == {'slow': (4, 0.5)}
+    assert reparsed.to_string() == text
+
+
+def test_extract_prunes_imports(tmp_path, write_file):
+    write_file(tmp_path / 'sub.txt',
+               '<s root=true> = s<t>\n<t> = t\n<u> = u\n<v> = v\n')
+    write_file(tmp_path / 'root.txt',
+               '!import sub.txt\n'
+               '<root root=true> = <import from=sub.txt><import from=sub.txt '
+               'symbol=u>\n')
+    g = Grammar()
+    assert g.parse_from_file(str(tmp_path / 'root.txt')) == 0
+    pruned = g.extract()
+    assert set(pruned._imports['sub.txt']._creators) == set(['s', 't', 'u'])
+    assert pruned.generate_root() == 'stu'
+    # Compiled extracted grammars keep their imports.
+    pruned.save_compiled(str(tmp_path / 'pruned.grammar'))
+    grammar.registry.clear()
+    loaded = Grammar()
+    loaded.load_compiled(str(tmp_path / 'pruned.grammar'))
+    assert loaded.generate_root() == 'stu'
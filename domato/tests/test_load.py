@@ -0,0 +1,100 @@
+#   Domato - parallel loading tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+import random
+
+import pytest
+
+from grammar import GrammarError, load_grammars
+
+
+def _write_roots(tmp_path, write_file, *names):
+    filenames = []
+    for name in names:
+        filename = str(tmp_path / (name + '.txt'))
+        write_file(filename, '<root root=true> = %s\n' % name)
+        filenames.append(filename)
+    return filenames
+
+
+def _generate(g):
+    random.seed(1)
+    return [g.generate_root() for _ in range(3)]
+
+
+def test_parallel_load_matches_serial_load(grammar_path):
+    filenames = [grammar_path('rules/css.txt'),
+                 grammar_path('mathml/mathml.txt')]
+    serial = load_grammars(filenames, processes=1)
+    parallel = load_grammars(filenames, processes=2)
+    for one, two in zip(serial, parallel):
+        assert _generate(one) == _generate(two)
+
+
+def test_parallel_load_keeps_order_and_uses_cache(tmp_path, write_file):
+    filenames = []
+    for name in ('a', 'b', 'c'):
+        filename = str(tmp_path / (name + '.txt'))
+        write_file(filename, '<root root=true> = %s<int min=1 max=1>\n' % name)
+        filenames.append(filename)
+    cache_dir = str(tmp_path / 'cache')
+    grammars = load_grammars(filenames, cache_dir, processes=3)
+    assert [g.generate_root() for g in grammars] == ['a1', 'b1', 'c1']
+    assert len(os.listdir(cache_dir)) == 3
+    grammars = load_grammars(filenames, cache_dir, processes=2)
+    assert [g.generate_root() for g in grammars] == ['a1', 'b1', 'c1']
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_load_errors_raise(tmp_path, processes, write_file):
+    write_file(tmp_path / 'good.txt', '<root root=true> = a\n')
+    write_file(tmp_path / 'bad.txt', '<root root=true> = a\n!unknown\n')
+    with pytest.raises(GrammarError, match='bad.txt'):
+        load_grammars([str(tmp_path / 'good.txt'),
+                       str(tmp_path / 'bad.txt')], processes=processes)
+
+
+@pytest.mark.parametrize('processes', [None, 1])
+def test_grammars_are_loaded_in_process_by_default(tmp_path, monkeypatch,
+                                                    write_file, processes):
+    import concurrent.futures
+
+    def executor(*args):
+        raise AssertionError('worker processes were started')
+
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', executor)
+    filenames = _write_roots(tmp_path, write_file, 'a', 'b')
+    grammars = load_grammars(filenames, processes=processes)
+    assert [g.generate_root() for g in grammars] == ['a', 'b']
+
+
+def test_zero_processes_start_one_per_cpu(tmp_path, monkeypatch, write_file):
+    import concurrent.futures
+    started = []
+    executor_class = concurrent.futures.ProcessPoolExecutor
+
+    def executor(processes):
+        started.append(processes)
+        return executor_class(processes)
+
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', executor)
+    monkeypatch.setattr(os, 'cpu_count', lambda: 2)
+    filenames = _write_roots(tmp_path, write_file, 'a', 'b', 'c')
+    grammars = load_grammars(filenames, processes=0)
+    assert [g.generate_root() for g in grammars] == ['a', 'b', 'c']
+    assert started == [2]
@@ -0,0 +1,52 @@
+#   Domato - rule lowering tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import random
+
+from grammar import Grammar
+
+_GRAMMAR = """
+<root root=true> = <a><b>
+<a> = x<c>
+<a> = y
+<b> = x<c>
+<b> = x<int min=0 max=3>
+<c> = z
+"""
+
+
+def _lowered(g, symbol):
+    return g._lowered_creators[g._symbol_ids[symbol]]
+
+
+def test_identical_rules_are_lowered_once():
+    g = Grammar()
+    assert g.parse_from_string(_GRAMMAR) == 0
+    a = _lowered(g, 'a')
+    b = _lowered(g, 'b')
+    assert a[0] is b[0]
+    assert a[1] is not b[1]
+    assert b[0] is not b[1]
+
+
+def test_shared_rules_generate_alike():
+    g = Grammar()
+    assert g.parse_from_string(_GRAMMAR) == 0
+    random.seed(1)
+    outputs = set(g.generate_symbol('root') for _ in range(100))
+    assert outputs == set(['xzxz', 'yxz', 'xzx0', 'xzx1', 'xzx2', 'xzx3',
+                           'yx0', 'yx1', 'yx2', 'yx3'])
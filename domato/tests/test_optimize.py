@@ -0,0 +1,99 @@
+#   Domato - grammar optimizer tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import collections
+import math
+import random
+
+import grammar
+from grammar import Grammar
+
+_GRAMMAR = """
+!extends B A
+<root root=true> = <a><B>
+<a> = x<b>y<c>
+<a> = <d>
+<a> = <d>
+<b> = z
+<c> = <e>
+<e> = <int min=1 max=2>
+<d> = w
+<B> = q
+"""
+
+
+def _ops(g, symbol):
+    return [ops for _, ops in g._lowered_creators[g._symbol_ids[symbol]]]
+
+
+def test_optimizer_passes():
+    g = Grammar()
+    assert g.parse_from_string(_GRAMMAR) == 0
+    g.optimize()
+    (fused, d), = [_ops(g, 'a')]
+    # Inlined symbols keep their tags, which still count towards depth.
+    assert [op[0] for op in fused] == [
+        grammar._OP_TEXT, grammar._OP_INLINED_TEXT, grammar._OP_TEXT,
+        grammar._OP_INLINED_SYMBOL]
+    assert fused[1][1][0] == 'z'
+    assert fused[3][2] == {'tagname': 'c'}
+    assert d[0][0] == grammar._OP_INLINED_TEXT
+    # The two <d> rules are merged.
+    assert g._lowered_cdfs[g._symbol_ids['a']] == [1.0 / 3, 1.0]
+    # Variable types are never inlined.
+    assert _ops(g, 'root')[0][1][0] == grammar._OP_SYMBOL
+    # The parsed rules are left alone.
+    assert len(g._creators['a']) == 3
+    assert g._creator_cdfs['a'] == []
+
+
+_RECURSIVE_GRAMMAR = """
+!max_recursion 7
+<root root=true> = <s>
+<s> = (<s><t>)
+<s p=0.6> = <u>
+<t> = <v>
+<v> = x
+<v p=0.3> = y
+<u> = <w>
+<w> = z
+<w> = z
+"""
+
+
+def _frequencies(g, count, seed):
+    random.seed(seed)
+    return collections.Counter(g.generate_root() for _ in range(count))
+
+
+def test_optimized_grammar_keeps_the_distribution():
+    plain = Grammar()
+    assert plain.parse_from_string(_RECURSIVE_GRAMMAR) == 0
+    optimized = Grammar()
+    assert optimized.parse_from_string(_RECURSIVE_GRAMMAR) == 0
+    optimized.optimize()
+    assert _frequencies(plain, 100, 1) != _frequencies(optimized, 100, 1)
+
+    expected = _frequencies(plain, 20000, 2)
+    actual = _frequencies(optimized, 20000, 3)
+    # Outputs that need more than the maximum depth are never generated.
+    assert max(len(output) for output in actual) == max(
+        len(output) for output in expected)
+    for output, count in expected.items():
+        if count >= 50:
+            assert (abs(actual[output] - count) <=
+                    5 * math.sqrt(actual[output] + count)), output
@@ -0,0 +1,225 @@
+#   Domato - grammar parsing tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import random
+
+import grammar
+from grammar import Grammar
+from grammar_compiler import load_grammar_module, write_grammar_module
+
+_RULES = """
+<root root=true> = <lines count=5>
+<a> = x
+<a p=0.25> = y
+"""
+
+_LINES = """
+!begin lines
+<new A> = 1;
+<new B> = <A>.b();
+<A>.f(<a>);
+!end lines
+"""
+
+_MORE_LINES = """
+<a> = z
+!begin lines
+<B>.g();
+!end lines
+!begin helperlines
+<new A> = 2;
+!end helperlines
+"""
+
+
+def _tables(g):
+    return (sorted(g._creators), g._creator_cdfs,
+            g._nonrecursivecreator_cdfs, list(g._all_nonhelper_lines),
+            g._interesting_lines)
+
+
+def _generate(g, seed=1):
+    random.seed(seed)
+    return [g.generate_root() for _ in range(5)]
+
+
+def test_included_sources_are_finalized_once():
+    whole = Grammar()
+    assert whole.parse_from_string(_RULES + _LINES + _MORE_LINES) == 0
+    combined = Grammar()
+    for source in (_RULES, _LINES, _MORE_LINES):
+        assert combined.include_from_string(source) == 0
+    combined.finalize()
+    assert _tables(combined) == _tables(whole)
+    assert _generate(combined) == _generate(whole)
+
+
+def test_lines_before_an_include_are_counted_once(tmp_path, write_file):
+    write_file(tmp_path / 'more.txt', _MORE_LINES)
+    write_file(tmp_path / 'root.txt', _RULES + _LINES + '!include more.txt\n')
+    g = Grammar()
+    assert g.parse_from_file(str(tmp_path / 'root.txt')) == 0
+    assert list(g._all_nonhelper_lines) == [0, 1, 2, 3]
+    assert g._interesting_lines == {'A': [1, 2], 'B': [3], 'a': [2]}
+    assert g._creator_cdfs['a'] == [0.375, 0.625, 1.0]
+
+
+def test_finalize_can_be_repeated():
+    g = Grammar()
+    assert g.parse_from_string(_RULES + _LINES + _MORE_LINES) == 0
+    tables = _tables(g)
+    output = _generate(g)
+    g.finalize()
+    assert _tables(g) == tables
+    assert _generate(g) == output
+
+
+_TOKENIZED = """# A comment
+<a> = x # trailing comment
+
+!!not a command
+!include other.txt
+!begin function f
+  # kept verbatim
+  ret_val = 'f'
+!end function
+!begin function bad name
+"""
+
+
+def test_tokenizer():
+    tokens = [(kind, lineno, value)
+              for kind, lineno, value, _ in grammar._tokenize(_TOKENIZED)]
+    assert tokens == [
+        (grammar._TOKEN_RULE, 2, '<a> = x'),
+        (grammar._TOKEN_RULE, 4, '!!not a command'),
+        (grammar._TOKEN_COMMAND, 5, ('include', 'other.txt')),
+        (grammar._TOKEN_FUNCTION, 6,
+         ('f', "  # kept verbatim\n  ret_val = 'f'\n")),
+        (grammar._TOKEN_ERROR, 10, None),
+    ]
+
+
+def test_tokenizer_rejects_nested_functions():
+    source = '!begin function f\n!begin function g\n!end function\n'
+    kinds = [kind for kind, _, _, _ in grammar._tokenize(source)]
+    assert kinds == [grammar._TOKEN_ERROR, grammar._TOKEN_FUNCTION]
+
+
+def test_unterminated_functions_are_dropped():
+    source = '<a> = x\n!begin function f\nret_val = 1\n'
+    kinds = [kind for kind, _, _, _ in grammar._tokenize(source)]
+    assert kinds == [grammar._TOKEN_RULE]
+
+
+def test_functions_are_called():
+    g = Grammar()
+    assert g.parse_from_string("""
+!begin function twice
+  ret_val = attributes['text'] * 2
+!end function
+<root root=true> = <call function=twice text=ab>
+""") == 0
+    assert g.generate_root() == 'abab'
+
+
+def test_errors_report_file_and_line(tmp_path, capsys, write_file):
+    write_file(tmp_path / 'bad.txt', '<a> = x\n\nnot a rule\n!unknown\n')
+    g = Grammar()
+    assert g.parse_from_file(str(tmp_path / 'bad.txt')) == 2
+    out = capsys.readouterr().out
+    assert 'bad.txt:3' in out
+    assert 'Unknown command: unknown (%s:4)' % (tmp_path / 'bad.txt') in out
+
+
+def test_tags_and_texts_are_interned():
+    one = Grammar()
+    assert one.parse_from_string('<a> = x<b id=1>y\n<b> = x<b id=1>y') == 0
+    two = Grammar()
+    assert two.parse_from_string('<c> = <b id=1>y\n<b> = z') == 0
+    one_parts = one._creators['a'][0].parts
+    two_parts = two._creators['c'][0].parts
+    assert one_parts[0] == 'x'
+    assert one_parts[1] is one._creators['b'][0].parts[1]
+    assert one_parts[1] == {'tagname': 'b', 'id': '1'}
+    # Every grammar has its own tags.
+    assert one_parts[1] == two_parts[0]
+    assert one_parts[1] is not two_parts[0]
+    assert one_parts[2] is two_parts[1]
+
+
+_MUTATING_FUNCTION = """
+!begin function mark
+  ret_val = attributes.get('marked', 'no')
+  attributes['marked'] = 'yes'
+!end function
+<root root=true> = <call function=mark><a>
+<a> = <call function=mark>
+"""
+
+
+def test_functions_get_a_copy_of_the_tag(tmp_path):
+    one = Grammar()
+    assert one.parse_from_string(_MUTATING_FUNCTION) == 0
+    two = Grammar()
+    assert two.parse_from_string(_MUTATING_FUNCTION) == 0
+    assert one.generate_root() == 'nono'
+    assert one.generate_root() == 'nono'
+    assert two.generate_root() == 'nono'
+    path = str(tmp_path / 'mark_grammar.py')
+    write_grammar_module(one, path)
+    module = load_grammar_module(path)
+    assert module.generate_root() == 'nono'
+    assert module.generate_root() == 'nono'
+
+
+def test_rule_layout():
+    g = Grammar()
+    assert g.parse_from_string("""
+<a> = x<b>y
+<b> = <int min=1 max=2>
+!begin lines
+<new A> = f(<a>);
+!end lines
+!begin helperlines
+<new B> = g();
+!end helperlines
+""") == 0
+    rule = g._creators['a'][0]
+    assert isinstance(rule, grammar._GrammarRule)
+    assert not hasattr(rule, '__dict__')
+    assert rule.creates == {'tagname': 'a'}
+    assert rule.parts == ('x', {'tagname': 'b'}, 'y')
+    assert not rule.recursive
+    line, helper = g._creators['A'][0], g._creators['B'][0]
+    assert isinstance(line, grammar._CodeRule)
+    assert not hasattr(line, '__dict__')
+    assert not line.helper and helper.helper
+    assert line.creates == ({'tagname': 'A', 'new': 'true'},)
+    assert line.parts == ({'tagname': 'A', 'new': 'true'}, ' = f(',
+                          {'tagname': 'a'}, ');')
+    assert g._creators['line'] == [line]
+    assert helper not in g._creators['line']
+
+
+def test_recursive_and_nonrecursive_rules():
+    g = Grammar()
+    assert g.parse_from_string(
+        '<a> = <a>x\n<a nonrecursive> = <b>\n<b> = y') == 0
+    assert [rule.recursive for rule in g._creators['a']] == [True, False]
+    assert [rule.parts for rule in g._nonrecursive_creators['a']] == [
+        ({'tagname': 'b'},)]
@@ -0,0 +1,118 @@
+#   Domato - finite symbol pool tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import random
+
+from grammar import Grammar
+
+_GRAMMAR = """
+<root root=true> = <pair>
+<pair> = <bit><bit>
+<pair> = -
+<bit p=0.25> = 0
+<bit> = 1
+<word> = <letter><word>
+<word> = <letter>
+<letter> = a
+<tagged> = <bit id=x>
+<nonrecursive> = a
+<nonrecursive nonrecursive> = b
+"""
+
+
+def _load():
+    g = Grammar()
+    assert g.parse_from_string(_GRAMMAR) == 0
+    return g
+
+
+def _pool(g, symbol):
+    return g._lowered_pools[g._symbol_ids[symbol]]
+
+
+def _pool_distribution(g, symbol):
+    """Returns the exact probability of every output of a pooled symbol."""
+    symbol_id = g._symbol_ids[symbol]
+    pool = g._lowered_pools[symbol_id]
+    table = g._lowered_pool_alias_tables[symbol_id]
+    distribution = {}
+    for column, output in enumerate(pool):
+        if table is None:
+            probability = 1.0 / len(pool)
+            distribution[output] = distribution.get(output, 0) + probability
+            continue
+        thresholds, aliases = table
+        own = thresholds[column] - column
+        distribution[output] = (distribution.get(output, 0) +
+                                own / len(pool))
+        alias = pool[aliases[column]]
+        distribution[alias] = (distribution.get(alias, 0) +
+                               (1 - own) / len(pool))
+    return distribution
+
+
+def _assert_distribution(actual, expected):
+    assert sorted(actual) == sorted(expected)
+    for output, probability in expected.items():
+        assert abs(actual[output] - probability) < 1e-9
+
+
+def test_pools_have_the_exact_distribution():
+    g = _load()
+    _assert_distribution(_pool_distribution(g, 'bit'),
+                         {'0': 0.25, '1': 0.75})
+    _assert_distribution(_pool_distribution(g, 'pair'), {
+        '00': 0.5 * 0.25 * 0.25,
+        '01': 0.5 * 0.25 * 0.75,
+        '10': 0.5 * 0.75 * 0.25,
+        '11': 0.5 * 0.75 * 0.75,
+        '-': 0.5})
+
+
+def test_symbols_that_cant_be_pooled():
+    g = _load()
+    assert _pool(g, 'word') is None
+    assert _pool(g, 'tagged') is None
+    assert _pool(g, 'nonrecursive') is None
+
+
+def test_text_pools_draw_like_expansion():
+    pooled = _load()
+    expanded = _load()
+    expanded._lowered_pools = [None] * len(expanded._lowered_pools)
+    samples = []
+    for g in (pooled, expanded):
+        random.seed(3)
+        samples.append([g.generate_symbol('bit') for _ in range(200)])
+    assert samples[0] == samples[1]
+
+
+def test_pooled_and_expanded_frequencies_agree():
+    pooled = _load()
+    expanded = _load()
+    expanded._lowered_pools = [None] * len(expanded._lowered_pools)
+    counts = []
+    for g in (pooled, expanded):
+        random.seed(5)
+        count = {}
+        for _ in range(20000):
+            output = g.generate_symbol('pair')
+            count[output] = count.get(output, 0) + 1
+        counts.append(count)
+    for output, probability in _pool_distribution(pooled, 'pair').items():
+        for count in counts:
+            assert abs(count.get(output, 0) / 20000.0 - probability) < 0.02
@@ -0,0 +1,127 @@
+#   Domato - NumPy random pool tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import collections
+import pickle
+import random
+import sys
+
+import pytest
+
+from grammar import Grammar, GrammarError
+
+pytest.importorskip('numpy')
+
+from random_pools import RandomPools  # noqa: E402
+
+
+@pytest.mark.parametrize('min_value, max_value', [
+    (0, 0),
+    (-5, 5),
+    (-2 ** 63, 2 ** 63 - 1),
+    (2 ** 63, 2 ** 64 - 1),
+    (-2 ** 70, 2 ** 70),
+])
+def test_integer_ranges(min_value, max_value):
+    pools = RandomPools(1)
+    values = [pools.integer(min_value, max_value) for _ in range(1000)]
+    assert all(min_value <= value <= max_value for value in values)
+    assert all(isinstance(value, int) for value in values)
+    if max_value > min_value:
+        assert len(set(values)) > 1
+
+
+def test_integer_frequencies():
+    pools = RandomPools(1)
+    counts = collections.Counter(pools.integer(0, 3) for _ in range(20000))
+    assert sorted(counts) == [0, 1, 2, 3]
+    assert all(abs(count / 20000.0 - 0.25) < 0.015
+               for count in counts.values())
+
+
+def test_floats():
+    pools = RandomPools(1)
+    values = [pools.random() for _ in range(10000)]
+    assert all(0 <= value < 1 for value in values)
+    assert abs(sum(values) / len(values) - 0.5) < 0.02
+
+
+def test_strings():
+    pools = RandomPools(1)
+    for length in (0, 1, 5, 500):
+        string = pools.string(0x41, 0x43, length)
+        assert len(string) == length
+        assert set(string) <= set('ABC')
+    # Surrogates are passed through like chr() does.
+    string = pools.string(0xd800, 0xdfff, 10)
+    assert all(0xd800 <= ord(char) <= 0xdfff for char in string)
+    with pytest.raises(ValueError):
+        pools.string(0x110000, 0x110001, 1)
+
+
+def test_batches_grow_to_the_batch_size():
+    pools = RandomPools(1, batch_size=200)
+    sizes = [pools._next_size('key') for _ in range(4)]
+    assert sizes == [64, 128, 200, 200]
+    assert pools._next_size('other', 1000) == 1000
+
+
+def test_pools_are_reproducible():
+    one = RandomPools(7)
+    two = RandomPools(7)
+    assert ([one.integer(0, 100) for _ in range(100)] ==
+            [two.integer(0, 100) for _ in range(100)])
+    assert one.string(0, 255, 50) == two.string(0, 255, 50)
+
+
+_GRAMMAR = """
+<root root=true> = <int min=5 max=7>,<float min=2 max=3>,<char min=65 max=66>,<string min=97 max=98 minlength=1 maxlength=3>,<hex up>
+"""
+
+
+def test_grammar_with_random_pools():
+    g = Grammar()
+    assert g.parse_from_string(_GRAMMAR) == 0
+    random.seed(1)
+    g.use_random_pools()
+    outputs = [g.generate_root() for _ in range(200)]
+    for output in outputs:
+        number, real, char, string, digit = output.split(',')
+        assert 5 <= int(number) <= 7
+        assert 2 <= float(real) < 3
+        assert char in 'AB'
+        assert 1 <= len(string) <= 3 and set(string) <= set('ab')
+        assert digit in '0123456789ABCDEF'
+    random.seed(1)
+    g.use_random_pools()
+    assert [g.generate_root() for _ in range(200)] == outputs
+
+    # Pickled grammars and disabled pools use the random module again.
+    copied = pickle.loads(pickle.dumps(g))
+    g.use_random_pools(False)
+    random.seed(2)
+    expected = [g.generate_root() for _ in range(10)]
+    random.seed(2)
+    assert [copied.generate_root() for _ in range(10)] == expected
+
+
+def test_random_pools_need_numpy(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'random_pools', None)
+    g = Grammar()
+    assert g.parse_from_string(_GRAMMAR) == 0
+    with pytest.raises(GrammarError, match='NumPy'):
+        g.use_random_pools()
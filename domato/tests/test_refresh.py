@@ -0,0 +1,215 @@
+#   Domato - grammar refresh tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+import random
+import shutil
+
+import pytest
+
+import grammar
+from grammar import Grammar
+
+_MAIN = """
+!include sub.txt
+<root root=true> = <a> <b>
+<b> = b1
+<b> = b2
+"""
+
+_SUB = """
+<a> = <c>
+<a> = x
+<c> = c1
+<e> = e1
+"""
+
+_NEW_SUB = """
+<a> = <c><c>
+<a p=0.5> = y
+<a> = <d>
+<c> = c2
+<c> = c3<a>
+<d> = <b>!
+<e> = e1
+"""
+
+
+def _load(path, optimize=False):
+    g = Grammar()
+    assert g.parse_from_file(path) == 0
+    if optimize:
+        g.optimize()
+    return g
+
+
+def _assert_lowered_alike(g, reparsed):
+    """Checks that the depths and pools of defined symbols are the same."""
+    for name in ('_lowered_min_depths', '_lowered_max_depths',
+                 '_lowered_pools', '_lowered_pool_depths'):
+        values = [
+            dict((symbol, getattr(each, name)[symbol_id])
+                 for symbol, symbol_id in each._symbol_ids.items()
+                 if each._lowered_creators[symbol_id] is not None)
+            for each in (g, reparsed)]
+        assert values[0] == values[1], name
+
+
+def _samples(generate, seed=7, count=50):
+    random.seed(seed)
+    return [generate() for _ in range(count)]
+
+
+@pytest.fixture
+def fragments(tmp_path, write_file):
+    main = str(tmp_path / 'main.txt')
+    write_file(main, _MAIN)
+    write_file(str(tmp_path / 'sub.txt'), _SUB)
+    return main
+
+
+def test_refresh_matches_reparse(fragments, monkeypatch, write_file):
+    g = _load(fragments)
+    unchanged = g._lowered_creators[g._symbol_ids['e']]
+    write_file(os.path.join(os.path.dirname(fragments), 'sub.txt'), _NEW_SUB)
+
+    def lower(self):
+        raise AssertionError('the whole grammar was lowered again')
+
+    monkeypatch.setattr(Grammar, '_lower', lower)
+    assert g.refresh() == 0
+    monkeypatch.undo()
+    # Symbols whose rules are the same are not lowered again.
+    assert g._lowered_creators[g._symbol_ids['e']] is unchanged
+
+    reparsed = _load(fragments)
+    assert sorted(g._creators) == sorted(reparsed._creators)
+    _assert_lowered_alike(g, reparsed)
+    assert (_samples(g.generate_root) ==
+            _samples(reparsed.generate_root))
+
+
+def test_refresh_of_removed_symbols(fragments, write_file):
+    g = _load(fragments)
+    write_file(os.path.join(os.path.dirname(fragments), 'sub.txt'),
+               '<a> = z\n')
+    assert g.refresh() == 0
+    assert 'c' not in g._creators
+    assert g._lowered_creators[g._symbol_ids['c']] is None
+    assert _samples(g.generate_root) == _samples(
+        _load(fragments).generate_root)
+
+
+def test_refresh_of_optimized_grammar(fragments, write_file):
+    g = _load(fragments, optimize=True)
+    write_file(os.path.join(os.path.dirname(fragments), 'sub.txt'), _NEW_SUB)
+    assert g.refresh() == 0
+    reparsed = _load(fragments, optimize=True)
+    assert (_samples(g.generate_root) ==
+            _samples(reparsed.generate_root))
+
+
+def test_refresh_with_changed_commands(fragments, write_file):
+    g = _load(fragments)
+    write_file(os.path.join(os.path.dirname(fragments), 'sub.txt'),
+               '!include other.txt\n' + _NEW_SUB)
+    write_file(os.path.join(os.path.dirname(fragments), 'other.txt'),
+               '<c> = other\n')
+    assert g.refresh() == 0
+    assert (_samples(g.generate_root) ==
+            _samples(_load(fragments).generate_root))
+
+
+_TWICE = """
+<t> = t1
+!var_reuse_prob 0.5
+<u> = u1
+"""
+
+
+def test_refresh_of_fragment_included_twice(tmp_path, monkeypatch,
+                                            write_file):
+    main = str(tmp_path / 'main.txt')
+    write_file(main, '!include twice.txt\n<root root=true> = <t><u>\n'
+               '!include twice.txt\n')
+    write_file(str(tmp_path / 'twice.txt'), _TWICE)
+    g = _load(main)
+    write_file(str(tmp_path / 'twice.txt'),
+               _TWICE.replace('t1', 't2').replace('u1', 'u2<t>'))
+
+    def reload(self):
+        raise AssertionError('the grammar was built again')
+
+    monkeypatch.setattr(Grammar, '_reload', reload)
+    assert g.refresh() == 0
+    monkeypatch.undo()
+    reparsed = _load(main)
+    assert ([grammar._rule_keys(segment.rules) for segment in g._segments] ==
+            [grammar._rule_keys(segment.rules)
+             for segment in reparsed._segments])
+    assert (_samples(g.generate_root) ==
+            _samples(reparsed.generate_root))
+
+
+def test_splicing_mismatched_segments_fails(fragments, write_file):
+    g = _load(fragments)
+    path = os.path.join(os.path.dirname(fragments), 'sub.txt')
+    old = grammar.registry.get_fragment(path, g)
+    segments = [list(segment.rules) for segment in g._segments]
+    write_file(path, _NEW_SUB + '!var_reuse_prob 0.5\n<e> = e2\n')
+    new = grammar.registry.get_fragment(path, g)
+    assert g._splice_fragment(old, new) is None
+    assert [segment.rules for segment in g._segments] == segments
+
+
+def test_refresh_of_shipped_grammar(tmp_path, grammar_path, monkeypatch,
+                                    write_file):
+    rules_dir = str(tmp_path / 'rules')
+    shutil.copytree(grammar_path('rules'), rules_dir)
+    css = _load(os.path.join(rules_dir, 'css.txt'))
+    js = _load(os.path.join(rules_dir, 'js.txt'))
+    js.add_import('cssgrammar', css)
+
+    common = os.path.join(rules_dir, 'common.txt')
+    with open(common) as f:
+        content = f.read()
+    write_file(common, content +
+               '\n<fuzzint> = 31337\n<newsymbol> = <fuzzint>\n')
+    js_file = os.path.join(rules_dir, 'js.txt')
+    with open(js_file) as f:
+        content = f.read()
+    write_file(js_file, content.replace(
+        '!begin lines\n',
+        '!begin lines\n<new element=HTMLElement> = <newsymbol>;\n', 1))
+
+    def reload(self):
+        raise AssertionError('the grammar was built again')
+
+    monkeypatch.setattr(Grammar, '_reload', reload)
+    assert js.refresh() == 0
+    monkeypatch.undo()
+
+    reparsed = _load(js_file)
+    reparsed.add_import('cssgrammar', css)
+    _assert_lowered_alike(js, reparsed)
+
+    def generate(g):
+        return lambda: g._generate_code(
+            100, [{'name': 'htmlvar00001', 'type': 'HTMLDivElement'}])
+
+    assert (_samples(generate(js), count=5) ==
+            _samples(generate(reparsed), count=5))
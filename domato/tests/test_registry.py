@@ -0,0 +1,113 @@
+#   Domato - grammar registry tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+
+import pytest
+
+from grammar import Grammar, GrammarError, registry
+
+
+@pytest.fixture
+def grammar_dir(tmp_path, write_file):
+    write_file(tmp_path / 'common.txt', '<common> = a\n', 1000)
+    write_file(tmp_path / 'one.txt',
+               '<root root=true> = 1<common>\n!include common.txt\n')
+    write_file(tmp_path / 'two.txt',
+               '<root root=true> = 2<common>\n!include common.txt\n')
+    return tmp_path
+
+
+def test_included_fragments_are_shared(grammar_dir):
+    one = Grammar()
+    assert one.parse_from_file(str(grammar_dir / 'one.txt')) == 0
+    two = Grammar()
+    assert two.parse_from_file(str(grammar_dir / 'two.txt')) == 0
+    assert one.generate_root() == '1a'
+    assert two.generate_root() == '2a'
+    assert one._creators['common'][0] is two._creators['common'][0]
+
+
+def test_fragments_are_keyed_by_real_path(grammar_dir):
+    link = grammar_dir / 'link.txt'
+    os.symlink(str(grammar_dir / 'common.txt'), str(link))
+    fragment = registry.get_fragment(str(grammar_dir / 'common.txt'),
+                                     Grammar())
+    relative = os.path.join(str(grammar_dir), '.', 'common.txt')
+    assert registry.get_fragment(relative, Grammar()) is fragment
+    assert registry.get_fragment(str(link), Grammar()) is fragment
+
+
+def test_fragments_are_parsed_again_after_modification(grammar_dir,
+                                                      write_file):
+    path = str(grammar_dir / 'common.txt')
+    fragment = registry.get_fragment(path, Grammar())
+    write_file(path, '<common> = b\n', 2000)
+    assert registry.get_fragment(path, Grammar()) is not fragment
+    g = Grammar()
+    assert g.parse_from_file(str(grammar_dir / 'one.txt')) == 0
+    assert g.generate_root() == '1b'
+
+
+def test_missing_fragments_raise(grammar_dir):
+    with pytest.raises(IOError):
+        registry.get_fragment(str(grammar_dir / 'missing.txt'), Grammar())
+
+
+def test_grammars_are_built_once(grammar_dir):
+    one = registry.get_grammar(str(grammar_dir / 'one.txt'))
+    relative = os.path.join(str(grammar_dir), '.', 'one.txt')
+    assert registry.get_grammar(relative) is one
+    assert one.generate_root() == '1a'
+
+
+def test_grammars_are_rebuilt_after_included_file_changes(grammar_dir,
+                                                          write_file):
+    one = registry.get_grammar(str(grammar_dir / 'one.txt'))
+    write_file(grammar_dir / 'common.txt', '<common> = b\n', 2000)
+    rebuilt = registry.get_grammar(str(grammar_dir / 'one.txt'))
+    assert rebuilt is not one
+    assert rebuilt.generate_root() == '1b'
+    assert one.generate_root() == '1a'
+    os.remove(str(grammar_dir / 'one.txt'))
+    with pytest.raises(GrammarError):
+        registry.get_grammar(str(grammar_dir / 'one.txt'))
+
+
+def test_imported_grammars_are_shared(grammar_dir, write_file):
+    write_file(grammar_dir / 'importer.txt',
+               '<root root=true> = <import from=one.txt>\n!import one.txt\n')
+    importer = Grammar()
+    assert importer.parse_from_file(str(grammar_dir / 'importer.txt')) == 0
+    assert importer.generate_root() == '1a'
+    assert (importer._imports['one.txt'] is
+            registry.get_grammar(str(grammar_dir / 'one.txt')))
+
+
+def test_grammar_errors_raise(grammar_dir, write_file):
+    write_file(grammar_dir / 'broken.txt', '<root root=true> = a\n!unknown\n')
+    with pytest.raises(GrammarError):
+        registry.get_grammar(str(grammar_dir / 'broken.txt'))
+
+
+def test_clear_forgets_everything(grammar_dir):
+    path = str(grammar_dir / 'common.txt')
+    fragment = registry.get_fragment(path, Grammar())
+    one = registry.get_grammar(str(grammar_dir / 'one.txt'))
+    registry.clear()
+    assert registry.get_fragment(path, Grammar()) is not fragment
+    assert registry.get_grammar(str(grammar_dir / 'one.txt')) is not one
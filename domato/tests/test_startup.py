@@ -0,0 +1,75 @@
+#   Domato - startup import tests
+#   --------------------------------------
+#
+#   Copyright 2017 Google Inc. All Rights Reserved.
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import builtins
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from grammar import Grammar
+
+DOMATO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CHECK_IMPORTS = """
+import json, sys
+before = set(sys.modules)
+import %s
+print(json.dumps(sorted(set(sys.modules) - before)))
+"""
+
+
+def _imported_modules(module):
+    output = subprocess.check_output(
+        [sys.executable, '-c', _CHECK_IMPORTS % module], cwd=DOMATO_DIR)
+    return set(json.loads(output.decode('utf-8')))
+
+
+@pytest.mark.parametrize('module, lazy', [
+    ('generator', ['grammar', 'argparse', 'grammar_analyzer']),
+    ('grammar', ['hashlib', 'pickle', 'array', 'mmap', 'heapq', 'html',
+                 'concurrent.futures', 'numpy', 'random_pools']),
+])
+def test_modules_are_imported_lazily(module, lazy):
+    imported = _imported_modules(module)
+    assert module in imported
+    assert imported.isdisjoint(lazy)
+
+
+def test_generator_help():
+    output = subprocess.check_output(
+        [sys.executable, 'generator.py', '--help'], cwd=DOMATO_DIR)
+    assert b'--cache_dir' in output
+
+
+def test_html_escape_is_imported_once(monkeypatch):
+    g = Grammar()
+    assert g.parse_from_string('<root root=true> = <htmlsafestring>') == 0
+    g.generate_root()
+    imports = []
+    import_module = builtins.__import__
+
+    def counting_import(name, *args, **kwargs):
+        imports.append(name)
+        return import_module(name, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, '__import__', counting_import)
+    for _ in range(10):
+        g.generate_root()
+    assert imports == []